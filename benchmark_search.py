@@ -0,0 +1,168 @@
+'''
+This module is a load generator for the relation search.
+
+It sends queries from a number of concurrent clients and reports the latency distribution (p50/p90/p99) and
+throughput. By default each query is the msearch which web_app.py sends for a results page, awaited through
+search_service.SearchService, so it measures the search layer against the elasticsearch server at ES_HOST
+(a local Elasticsearch or OpenSearch stand-in works) with as many connections as ES_POOL_SIZE allows.
+With --url, results pages are requested from a running web app instead, which adds Flask, templating and the
+result cache.
+
+Queries are the default list below, or predicate/argument pairs sampled from a relations file.
+
+'''
+import argparse
+import asyncio
+import os
+import random
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from scheduler import Latency
+
+# (predicate, arguments) queries used when no relations file is given.
+default_queries = [
+    ('bind', ['ACE2']),
+    ('inhibit', ['protease']),
+    ('express', ['TMPRSS2']),
+    ('activate', ['interferon']),
+    ('cleave', ['spike']),
+    ('bind', ['spike', 'receptor']),
+    ('reduce', ['viral replication']),
+    ('induce', ['cytokine']),
+]
+
+
+def sample_queries(relations_file, num_queries, seed=0):
+    """
+    Sample queries from the predicates and first arguments of relations.
+    :param relations_file: .parquet, .arrow or .csv relations filepath.
+    :param num_queries: number of queries to sample.
+    :param seed: random seed.
+    :return: list of (predicate, arguments) tuples.
+    """
+    from relations_store import read_relations
+
+    # Reservoir sample, so the relations file is read once without being held in memory.
+    rng = random.Random(seed)
+    queries = []
+    for num_seen, relation in enumerate(read_relations(relations_file, columns=('predicate', 'arguments'))):
+        query = (relation['predicate'], list(relation['arguments'] or [])[:1])
+        if num_seen < num_queries:
+            queries.append(query)
+        else:
+            n = rng.randrange(num_seen + 1)
+            if n < num_queries:
+                queries[n] = query
+
+    return queries
+
+
+def service_search():
+    """
+    :return: coroutine function sending the msearch of a results page for a query through web_app's SearchService,
+             whose pool size is set with the ES_POOL_SIZE environment variable.
+    """
+    from pagination import page_search
+    from web_app import facet_search, relation_search, service
+
+    async def search(predicate, args, search_type):
+        s = relation_search(predicate, args, search_type)
+        await service.amsearch([page_search(s.extra(track_total_hits=False), 'rel_id', size=10), facet_search(s)])
+
+    return search
+
+
+def http_search(url, executor):
+    """
+    :param url: base url of a running web app.
+    :param executor: executor the blocking requests run on.
+    :return: coroutine function requesting the first results page for a query.
+    """
+    def get(predicate, args, search_type):
+        values = {'predicate': predicate, 'search-type': search_type}
+        values.update({f'arg{arg_num + 1}': arg for arg_num, arg in enumerate(args)})
+        with urllib.request.urlopen(url.rstrip('/') + '/results?' + urllib.parse.urlencode(values)) as response:
+            response.read()
+
+    async def search(predicate, args, search_type):
+        await asyncio.get_event_loop().run_in_executor(executor, get, predicate, args, search_type)
+
+    return search
+
+
+async def run(search, queries, num_requests, concurrency, search_type, latency):
+    """
+    Send num_requests queries, cycling through queries, with at most concurrency in flight.
+    :return: (seconds taken, number of failed requests)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def one(n):
+        nonlocal failures
+        predicate, args = queries[n % len(queries)]
+        async with semaphore:
+            start_time = time.perf_counter()
+            try:
+                await search(predicate, args, search_type)
+            except Exception:
+                failures += 1
+                return
+            latency.add([predicate, args], len(predicate) + sum(len(arg) for arg in args),
+                        time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(num_requests)))
+    return time.perf_counter() - start_time, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the relation search and report its latency.')
+    parser.add_argument('--url', type=str, default=None,
+                        help='Base url of a running web app to request results pages from, '
+                             'instead of searching elasticsearch directly.')
+    parser.add_argument('--relations_file', type=str, default=None,
+                        help='Relations file to sample queries from, instead of the default queries.')
+    parser.add_argument('--num_queries', type=int, default=200,
+                        help='Number of distinct queries sampled from the relations file.')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='Number of requests sent.')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Number of requests in flight at once.')
+    parser.add_argument('--warmup', type=int, default=100,
+                        help='Number of requests sent before measuring.')
+    parser.add_argument('--search_type', type=str, default='and', choices=['and', 'or'],
+                        help='Operator between query terms.')
+    args = parser.parse_args()
+
+    queries = sample_queries(args.relations_file, args.num_queries) if args.relations_file else default_queries
+
+    if args.url:
+        executor = ThreadPoolExecutor(max_workers=args.concurrency)
+        search = http_search(args.url, executor)
+        target = args.url
+    else:
+        search = service_search()
+        target = os.environ.get('ES_HOST', '127.0.0.1')
+
+    loop = asyncio.get_event_loop()
+    print(f'Sending {args.requests} requests over {len(queries)} queries to {target} '
+          f'with concurrency {args.concurrency}')
+    loop.run_until_complete(run(search, queries, args.warmup, args.concurrency, args.search_type, Latency()))
+
+    latency = Latency()
+    elapsed, failures = loop.run_until_complete(run(search, queries, args.requests, args.concurrency,
+                                                    args.search_type, latency))
+    print(f'{len(latency.seconds)} requests in {elapsed:.2f} s ({len(latency.seconds) / elapsed:.1f} requests/sec), '
+          f'{failures} failed')
+    latency.report()
+
+    if args.url:
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
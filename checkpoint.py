@@ -0,0 +1,166 @@
+'''
+This module keeps track of how far the NER filtering scripts got through each of their input files,
+so that a crashed run can be resumed instead of starting over.
+
+Each input file is written to its own shard file, named after the file and a hash of its full path
+so that same-named inputs from different folders get different shards.
+The checkpoint manifest is a json file mapping every input file to a dictionary such that:
+> manifest[doc_file].keys()
+dict_keys(
+  ['shard', 'offset', 'shard_offset', 'docs', 'size', 'mtime', 'done']
+)
+where offset is the byte offset in doc_file up to which documents have been processed and
+shard_offset is the byte offset in the shard up to which their output has been written.
+
+'''
+
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+
+
+def read_jsonl(doc_file, offset=0):
+    """
+    Read a jsonl file line by line starting at a byte offset.
+    :param doc_file: jsonl filepath.
+    :param offset: byte offset of the first line to read.
+    :return: generator of (end_offset, line) tuples where end_offset is the byte offset after the line.
+    """
+    with open(doc_file, 'rb') as fp:
+        fp.seek(offset)
+        for raw_line in iter(fp.readline, b''):
+            offset += len(raw_line)
+            if raw_line.strip():
+                yield offset, json.loads(raw_line)
+
+
+def load_manifest(manifest_file):
+    """
+    Load a checkpoint manifest, or an empty one if it doesn't exist yet.
+    :param manifest_file: json filepath of the manifest.
+    :return: dictionary mapping input filepaths to their checkpoint entries.
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+
+    with open(manifest_file, encoding='utf-8') as fp:
+        return json.load(fp)
+
+
+def save_manifest(manifest, manifest_file):
+    """
+    Atomically replace the checkpoint manifest on disk.
+    :param manifest: dictionary mapping input filepaths to their checkpoint entries.
+    :param manifest_file: json filepath of the manifest.
+    :return: None
+    """
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as fp:
+        json.dump(manifest, fp, indent=2)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    os.replace(tmp_file, manifest_file)
+
+
+def shard_path(shard_folder, doc_file, extension):
+    """
+    Get the shard filepath which stores the output for an input file.
+    :param shard_folder: folder which stores the shards.
+    :param doc_file: input filepath.
+    :param extension: file extension of the shard, e.g. '.jsonl'.
+    :return: shard filepath.
+    """
+    name = os.path.splitext(os.path.basename(doc_file))[0]
+    # Inputs with the same name in different folders need different shards.
+    path_hash = hashlib.blake2b(os.path.abspath(doc_file).encode('utf-8'), digest_size=4).hexdigest()
+
+    return os.path.join(shard_folder, f'{name}-{path_hash}{extension}')
+
+
+def start_entry(manifest, doc_file, shard_file, resume):
+    """
+    Get the checkpoint entry of an input file, starting a fresh one unless a valid one can be resumed.
+    An entry is only resumed if the input file has not changed since it was recorded.
+    :param manifest: dictionary mapping input filepaths to their checkpoint entries.
+    :param doc_file: input filepath.
+    :param shard_file: shard filepath which stores the output for doc_file.
+    :param resume: whether to continue from a previous run's checkpoint.
+    :return: the checkpoint entry of doc_file, which is also stored in manifest.
+    """
+    stat = os.stat(doc_file)
+    entry = manifest.get(doc_file)
+
+    if not (resume and entry
+            and entry['shard'] == shard_file
+            and entry['size'] == stat.st_size
+            and entry['mtime'] == stat.st_mtime
+            and os.path.exists(shard_file)):
+        entry = {
+            'shard': shard_file,
+            'offset': 0,
+            'shard_offset': 0,
+            'docs': 0,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'done': False,
+        }
+        manifest[doc_file] = entry
+
+    return entry
+
+
+def open_shard(entry, mode='a'):
+    """
+    Open the shard of a checkpoint entry for writing, discarding any output written after its last checkpoint.
+    :param entry: checkpoint entry returned by start_entry.
+    :param mode: 'a' to open the shard as text, 'ab' to open it as bytes.
+    :return: the open shard file object.
+    """
+    pathlib.Path(entry['shard']).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(entry['shard'], 'ab') as fp:
+        fp.truncate(entry['shard_offset'])
+
+    if 'b' in mode:
+        return open(entry['shard'], mode)
+
+    return open(entry['shard'], mode, encoding='utf-8')
+
+
+def checkpoint(entry, offset, shard_fp, num_docs, manifest, manifest_file, done=False):
+    """
+    Record that an input file has been processed up to a byte offset.
+    :param entry: checkpoint entry of the input file.
+    :param offset: byte offset in the input file up to which documents have been processed.
+    :param shard_fp: open shard file object which holds their output.
+    :param num_docs: number of documents processed since the last checkpoint.
+    :param manifest: dictionary mapping input filepaths to their checkpoint entries.
+    :param manifest_file: json filepath of the manifest.
+    :param done: whether the whole input file has been processed.
+    :return: None
+    """
+    shard_fp.flush()
+    os.fsync(shard_fp.fileno())
+
+    entry['offset'] = offset
+    entry['shard_offset'] = shard_fp.tell()
+    entry['docs'] += num_docs
+    entry['done'] = done
+
+    save_manifest(manifest, manifest_file)
+
+
+def merge_shards(shard_files, out_file):
+    """
+    Concatenate shard files byte for byte into a single output file, overwriting it.
+    :param shard_files: list of shard filepaths in output order.
+    :param out_file: filepath of the merged output.
+    :return: None
+    """
+    with open(out_file, 'wb') as out_fp:
+        for shard_file in shard_files:
+            with open(shard_file, 'rb') as shard_fp:
+                shutil.copyfileobj(shard_fp, out_fp)
@@ -9,22 +9,38 @@ dict_keys(
   ['doc_id', 'sent', 'source', 'doi', 'pmcid', 'pubmed_id', 'publish_time', 'authors', 'journal']
 )
 
+Each input file is first filtered into its own shard in --shard_folder, and the shards are then
+concatenated into --out_file. A crashed run can be continued with --resume, which skips finished
+input files and picks up partially filtered ones from their last checkpoint.
+
 '''
 
 
 import jsonlines
 import argparse
 import spacy
-import copy
+import os.path
 import re
+import time
+from functools import partial
 
 from tqdm import tqdm
 
+import checkpoint
+from ner_cache import NerCache
+from scheduler import Latency, pipe_by_length, split_sents
+
 
 # Load SciSpacy's JNLPBA NER model.
 # It tags entities with the ontology [DNA, CELL_TYPE, CELL_LINE, RNA, PROTEIN].
 nlp = spacy.load('en_ner_jnlpba_md')
 
+# The PROTEIN check only needs sentence boundaries (parser) and entities (ner),
+# so every other pipeline component is switched off while tagging without the cache.
+# The cache tags with the full pipeline, so that its entries are shared with the other scripts.
+needed_pipes = ['parser', 'ner']
+disabled_pipes = [name for name in nlp.pipe_names if name not in needed_pipes]
+
 # Command line arguments.
 parser = argparse.ArgumentParser(description='Filter relevant documents with'
                                              ' SciSpacy\'s en_ner_jnlpba_md NER model.')
@@ -35,9 +51,44 @@ parser.add_argument('--doc_files', type=str, nargs='+',
 parser.add_argument('--out_file', type=str, default='data/CORD-NER-PROTEIN-corpus.jsonl',
                     help='jsonl output file to which CORD-NER protein entity-containing documents'
                          'will be written.')
+parser.add_argument('--batch_size', type=int, default=64,
+                    help='Number of documents spaCy tags per batch.')
+parser.add_argument('--n_process', type=int, default=1,
+                    help='Number of processes spaCy uses for tagging.')
+parser.add_argument('--bucket_window', type=int, default=1024,
+                    help='Number of documents sorted by length together so batches hold similarly sized texts.')
+parser.add_argument('--slow_threshold', type=float, default=None,
+                    help='Seconds above which a document is reported as slow. Slow documents are still tagged.')
+parser.add_argument('--slow_log', type=str, default=None,
+                    help='Optional jsonl file to which slow documents are appended.')
+parser.add_argument('--no_count', action='store_true',
+                    help='Skip counting input lines up front (tqdm shows no total).')
+parser.add_argument('--shard_folder', type=str, default='data/CORD-NER-PROTEIN-shards/',
+                    help='Folder which stores one jsonl shard per input file and the checkpoint manifest.')
+parser.add_argument('--checkpoint_every', type=int, default=1000,
+                    help='Number of documents tagged between checkpoints.')
+parser.add_argument('--resume', action='store_true',
+                    help='Continue from the checkpoint manifest instead of re-tagging finished work.')
+parser.add_argument('--ner_cache', type=str, default='data/ner_cache.sqlite',
+                    help='SQLite file which caches NER results across runs and scripts.')
+parser.add_argument('--ner_cache_mb', type=int, default=2048,
+                    help='Size in megabytes the NER cache may grow to before evicting old entries.')
+parser.add_argument('--no_ner_cache', action='store_true',
+                    help='Tag every document with the NER model without consulting the cache.')
 
 args = parser.parse_args()
 
+# Cache of previously tagged document texts.
+ner_cache = None
+if not args.no_ner_cache:
+    ner_cache = NerCache(args.ner_cache, nlp, max_bytes=args.ner_cache_mb * 1024 ** 2)
+
+# Per-document tagging latencies.
+latency = Latency(slow_threshold=args.slow_threshold, slow_log=args.slow_log)
+
+# Counts of documents which were too long for spaCy and had to be split.
+long_docs = {'split': 0, 'dropped_sents': 0}
+
 
 def sent_to_ent_types(doc):
     """
@@ -86,84 +137,204 @@ def get_text_from_sents(sents):
     return text
 
 
-def filter_file(doc_file):
+def tag_docs(records, batch_size=1, n_process=1, window=1):
+    """
+    Tag CORD-NER documents with the NER model in length-sorted batches.
+    A document longer than spaCy's max_length is split into pieces on its sentence boundaries,
+    and each piece is tagged as its own Spacy document.
+    :param records: iterable of (key, line) tuples where line is a CORD-NER document dictionary.
+    :param batch_size: number of documents spaCy tags per batch.
+    :param n_process: number of processes spaCy uses for tagging.
+    :param window: number of documents sorted by length together.
+    :return: generator of (key, line, docs) tuples where docs is the list of tagged Spacy documents of line.
+    """
+    def texts():
+        for key, line in records:
+            text = get_text_from_sents(line['sents'])
+
+            if len(text) <= nlp.max_length:
+                pieces = [text]
+            else:
+                # Tagging the whole text would raise a ValueError, so tag it a few sentences at a time.
+                pieces, num_dropped = split_sents(line['sents'], nlp.max_length)
+                long_docs['split'] += 1
+                long_docs['dropped_sents'] += num_dropped
+
+            for i, piece in enumerate(pieces):
+                yield piece, (key, line, i, len(pieces))
+
+    if ner_cache is not None:
+        # Only documents whose text hasn't been tagged before reach the model.
+        pipe = partial(ner_cache.pipe, as_tuples=True, batch_size=batch_size, n_process=n_process)
+    else:
+        pipe = partial(nlp.pipe, as_tuples=True, batch_size=batch_size,
+                       n_process=n_process, disable=disabled_pipes)
+
+    docs = []
+    tagged = pipe_by_length(pipe, texts(), window, latency, key=lambda context: context[1].get('doc_id'),
+                            batch_size=batch_size)
+    for doc, (key, line, i, num_pieces) in tagged:
+        docs.append(doc)
+        if i == num_pieces - 1:
+            yield key, line, docs
+            docs = []
+
+
+def count_lines(doc_file, chunk_size=1 << 20):
+    """
+    Count the lines of a file by scanning its raw bytes in fixed-size chunks.
+    :param doc_file: filepath of the file to count.
+    :param chunk_size: number of bytes read at a time.
+    :return: the number of newline-terminated lines in the file.
+    """
+    num_lines = 0
+    with open(doc_file, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            num_lines += chunk.count(b'\n')
+
+    return num_lines
+
+
+def project_metadata(line, sent):
+    """
+    Build an output dictionary holding a document's metadata and a single sentence.
+    The metadata values are shared with the input line rather than copied.
+    :param line: CORD-NER document dictionary.
+    :param sent: a Spacy span from the document.
+    :return: dictionary with every key of line except 'sents', plus the preprocessed 'sent'.
     """
-    Get a list of dictionaries which contain the relevant sentences along with metadata.
+    sent_dict = {key: value for key, value in line.items() if key != 'sents'}
+    sent_dict['sent'] = preprocess_sent(sent)
+
+    return sent_dict
+
+
+def filter_docs(doc_file, offset=0, batch_size=1, n_process=1, count=True):
+    """
+    Generate the relevant sentences of each document of a jsonl file, starting at a byte offset.
     :param doc_file: jsonl filepath which contains documents for tagging.
-    :return: List of dictionaries which contain documents which contain protein entities.
+    :param offset: byte offset of the first document to tag.
+    :param batch_size: number of documents spaCy tags per batch.
+    :param n_process: number of processes spaCy uses for tagging.
+    :param count: whether to count the file's lines first so tqdm can show a total.
+    :return: generator of (end_offset, sent_dicts) tuples, one per tagged document, where end_offset
+             is the byte offset after the document and sent_dicts its protein-containing sentences.
     """
 
-    protein_docs = []
     # Get number of lines in file for tqdm's sake
-    with open(doc_file) as fp:
-        num_lines = len(fp.readlines())
-
-    with jsonlines.open(doc_file) as reader:
-        # Loop through the JSON lines and collect the relevant documents.
-        for line in tqdm(reader, desc=f'Filtering from {doc_file}', total=num_lines):
-            sents = line['sents']
-
-            text = get_text_from_sents(sents)
-
-            try:
-                # Tag the document text with the NER model.
-                doc = nlp(text)
-            except ValueError:
-                # A value error may arise if the document is too long, so skip it.
-                continue
-
-            # Loop through the sentences of the document
-            for i, sent in enumerate(doc.sents):
-                # Get a set of the entity types in the sentence.
-                ent_types = sent_to_ent_types(sent)
-
-                # If one of the types is labeled protein, include it in the output list.
-                if 'PROTEIN' in ent_types:
-                    # > line.keys()
-                    # dict_keys(
-                    #   ['doc_id', 'sents', 'source', 'doi', 'pmcid', 'pubmed_id', 'publish_time', 'authors', 'journal']
-                    # )
-                    # > line['sents'][i].keys()
-                    # dict_keys(
-                    #   ['sent_id', 'sent_tokens']
-                    # )
-                    sent_dict = copy.deepcopy(line)
-                    # Delete the rest of the sentences.
-                    del sent_dict['sents']
-                    # Add only the current sentence.
-                    sent_dict['sent'] = preprocess_sent(sent)
-                    protein_docs.append(sent_dict)
-
-                    # Write to the file periodically and reset the list to save on memory.
-                    if len(protein_docs) > 1000:
-                        write_jsonl(protein_docs, args.out_file, mode='a')
-                        protein_docs = []
-
-    return protein_docs
-
-
-def write_jsonl(protein_docs, output_file, mode='w'):
-    """
-    Store relevant doucments in a pickle object.
-    :param protein_docs: List of dictionaries which contain relevant documents and metadata.
-    :param output_file: Jsonl filename of the output file.
+    num_lines = count_lines(doc_file) if count else None
+
+    num_docs = 0
+    num_sents = 0
+    start_time = time.time()
+
+    records = tqdm(checkpoint.read_jsonl(doc_file, offset), desc=f'Filtering from {doc_file}', total=num_lines)
+
+    # Loop through the tagged documents and collect the relevant sentences.
+    tagged = tag_docs(records, batch_size=batch_size, n_process=n_process, window=args.bucket_window)
+    for end_offset, line, docs in tagged:
+        num_docs += 1
+        sent_dicts = []
+
+        # Loop through the sentences of the document
+        for i, sent in enumerate(sent for doc in docs for sent in doc.sents):
+            num_sents += 1
+
+            # Get a set of the entity types in the sentence.
+            ent_types = sent_to_ent_types(sent)
+
+            # If one of the types is labeled protein, include it in the output list.
+            if 'PROTEIN' in ent_types:
+                # > line.keys()
+                # dict_keys(
+                #   ['doc_id', 'sents', 'source', 'doi', 'pmcid', 'pubmed_id', 'publish_time', 'authors', 'journal']
+                # )
+                # > line['sents'][i].keys()
+                # dict_keys(
+                #   ['sent_id', 'sent_tokens']
+                # )
+                # Keep the metadata and only the current sentence.
+                sent_dicts.append(project_metadata(line, sent))
+
+        yield end_offset, sent_dicts
+
+    print(f'batch_size={batch_size}, n_process={n_process}')
+    report_throughput(num_docs, num_sents, time.time() - start_time)
+    print(f'Split {long_docs["split"]} documents longer than {nlp.max_length} characters, '
+          f'dropping {long_docs["dropped_sents"]} sentences which were longer on their own')
+
+
+def filter_to_shard(doc_file, manifest, manifest_file, resume=False):
+    """
+    Write the relevant sentences of a jsonl file to its own shard, checkpointing as it goes.
+    :param doc_file: jsonl filepath which contains documents for tagging.
+    :param manifest: dictionary mapping input filepaths to their checkpoint entries.
+    :param manifest_file: json filepath of the manifest.
+    :param resume: whether to continue from a previous run's checkpoint.
+    :return: the shard filepath.
+    """
+    shard_file = checkpoint.shard_path(args.shard_folder, doc_file, '.jsonl')
+    entry = checkpoint.start_entry(manifest, doc_file, shard_file, resume)
+
+    if entry['done']:
+        print(f'Skipping {doc_file}, already filtered into {shard_file}')
+        return shard_file
+
+    if entry['offset'] > 0:
+        print(f'Resuming {doc_file} at byte {entry["offset"]} ({entry["docs"]} docs done)')
+
+    with checkpoint.open_shard(entry) as shard_fp:
+        writer = jsonlines.Writer(shard_fp)
+
+        offset = entry['offset']
+        num_docs = 0
+        docs = filter_docs(doc_file, offset, batch_size=args.batch_size, n_process=args.n_process,
+                           count=not args.no_count)
+        for offset, sent_dicts in docs:
+            writer.write_all(sent_dicts)
+            num_docs += 1
+
+            if num_docs == args.checkpoint_every:
+                checkpoint.checkpoint(entry, offset, shard_fp, num_docs, manifest, manifest_file)
+                num_docs = 0
+
+        # Trailing lines without a document still count as processed.
+        checkpoint.checkpoint(entry, entry['size'], shard_fp, num_docs, manifest, manifest_file, done=True)
+
+    return shard_file
+
+
+def report_throughput(num_docs, num_sents, elapsed):
+    """
+    Print how quickly documents and sentences were tagged so batch sizes can be tuned.
+    :param num_docs: number of documents tagged.
+    :param num_sents: number of sentences tagged.
+    :param elapsed: seconds spent tagging.
     :return: None
     """
-    with jsonlines.open(output_file, mode=mode) as writer:
-        writer.write_all(protein_docs)
+    elapsed = max(elapsed, 1e-9)
+    print(f'Tagged {num_docs} docs ({num_docs / elapsed:.1f} docs/sec), '
+          f'{num_sents} sentences ({num_sents / elapsed:.1f} sentences/sec)')
 
 
 if __name__ == '__main__':
     doc_files = args.doc_files
     out_file = args.out_file
 
-    protein_docs = []
-    # Filter out irrelevant documents in each provided file.
-    for doc_file in doc_files:
-        file_docs = filter_file(doc_file)
+    manifest_file = os.path.join(args.shard_folder, 'manifest.json')
+    manifest = checkpoint.load_manifest(manifest_file) if args.resume else {}
 
-        protein_docs.extend(file_docs)
+    # Filter out irrelevant documents in each provided file into its own shard.
+    shard_files = [filter_to_shard(doc_file, manifest, manifest_file, resume=args.resume)
+                   for doc_file in doc_files]
 
     print(f'Writing output file at {out_file}')
-    # Write to the jsonl output file.
-    write_jsonl(protein_docs, out_file, mode='a')
+    # Concatenate the shards into the jsonl output file.
+    checkpoint.merge_shards(shard_files, out_file)
+
+    latency.report()
+    latency.close()
+
+    if ner_cache is not None:
+        ner_cache.report()
+        ner_cache.close()
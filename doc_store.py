@@ -0,0 +1,201 @@
+'''
+This module stores the Spacy documents filtered by document_filter.py as chunked DocBin shards.
+
+A store is a folder such that:
+> os.listdir(folder)
+['index.jsonl', 'shards']
+where shards/ holds one .docbin shard per input file and index.jsonl holds a dictionary on each line:
+> line.keys()
+dict_keys(
+  ['id', 'label', 'shard', 'offset', 'position']
+)
+A shard is a sequence of chunks. Each chunk is a little-endian uint64 length followed by a json list of
+[id, label] pairs, then a uint64 length followed by a DocBin holding the chunk's documents in the same order.
+offset is the byte offset of a document's chunk in its shard and position its place within the chunk,
+so a single document can be read without deserializing the rest of the store.
+
+Usage:
+
+from doc_store import load_docs
+docs = load_docs('data/docbin/')
+for doc in docs:
+    ...
+docs.get(paper_sha)
+...
+
+'''
+
+import functools
+import json
+import os.path
+import struct
+
+from spacy.tokens import DocBin
+from spacy.vocab import Vocab
+
+from docbin import doc_attrs
+
+__all__ = ['load_docs', 'DocStore']
+
+length = struct.Struct('<Q')
+
+
+def write_chunk(fp, protein_docs):
+    """
+    Append a chunk of documents to an open shard.
+    :param fp: shard file object opened for binary writing.
+    :param protein_docs: list of dictionaries with 'id', 'label' and 'doc' (a Spacy document) keys.
+    :return: None
+    """
+    meta = json.dumps([[d['id'], d['label']] for d in protein_docs]).encode('utf-8')
+
+    doc_bin = DocBin(attrs=doc_attrs)
+    for d in protein_docs:
+        doc_bin.add(d['doc'])
+    data = doc_bin.to_bytes()
+
+    fp.write(length.pack(len(meta)))
+    fp.write(meta)
+    fp.write(length.pack(len(data)))
+    fp.write(data)
+
+
+def scan_shard(shard_filename):
+    """
+    Read the [id, label] pairs of each chunk of a shard, skipping over the documents themselves.
+    :param shard_filename: shard filepath.
+    :return: generator of (offset, meta) tuples where meta is the chunk's list of [id, label] pairs.
+    """
+    with open(shard_filename, 'rb') as fp:
+        while True:
+            offset = fp.tell()
+            header = fp.read(length.size)
+            if len(header) < length.size:
+                return
+
+            meta = json.loads(fp.read(length.unpack(header)[0]))
+            data_length = length.unpack(fp.read(length.size))[0]
+            fp.seek(data_length, os.SEEK_CUR)
+
+            yield offset, meta
+
+
+def read_chunk(shard_filename, offset, vocab):
+    """
+    Read the documents of a single chunk of a shard.
+    :param shard_filename: shard filepath.
+    :param offset: byte offset of the chunk in the shard.
+    :param vocab: Spacy vocab the documents are deserialized into.
+    :return: list of dictionaries with 'id', 'label' and 'doc' keys.
+    """
+    with open(shard_filename, 'rb') as fp:
+        fp.seek(offset)
+        meta = json.loads(fp.read(length.unpack(fp.read(length.size))[0]))
+        data = fp.read(length.unpack(fp.read(length.size))[0])
+
+    docs = DocBin(attrs=doc_attrs).from_bytes(data).get_docs(vocab)
+
+    return [{'id': sent_id, 'label': label, 'doc': doc} for (sent_id, label), doc in zip(meta, docs)]
+
+
+def write_index(shard_files, folder):
+    """
+    Write the id/label index of a store from its shards.
+    :param shard_files: list of shard filepaths in the store, in output order.
+    :param folder: folder of the store.
+    :return: the number of documents in the store.
+    """
+    num_docs = 0
+    with open(os.path.join(folder, 'index.jsonl'), 'w', encoding='utf-8') as fp:
+        for shard_file in shard_files:
+            shard = os.path.relpath(shard_file, folder)
+            for offset, meta in scan_shard(shard_file):
+                for position, (sent_id, label) in enumerate(meta):
+                    fp.write(json.dumps({'id': sent_id, 'label': label, 'shard': shard,
+                                         'offset': offset, 'position': position}) + '\n')
+                    num_docs += 1
+
+    return num_docs
+
+
+class DocStore:
+    """
+    A lazily loaded store of filtered documents.
+    Iterating over it streams documents one chunk at a time, and get() fetches the documents of a single id.
+    """
+
+    def __init__(self, folder, vocab=None):
+        """
+        Open a store by reading its index.
+        :param folder: folder of the store.
+        :param vocab: Spacy vocab the documents are deserialized into. A blank vocab is used by default.
+        """
+        self.folder = folder
+        self.vocab = vocab if vocab is not None else Vocab()
+        # The last few chunks read by get(), cached per store so that they go away with the store.
+        self._chunk = functools.lru_cache(maxsize=8)(self._read_chunk)
+
+        self.entries = []
+        self.by_id = {}
+        with open(os.path.join(folder, 'index.jsonl'), encoding='utf-8') as fp:
+            for line in fp:
+                entry = json.loads(line)
+                self.by_id.setdefault(entry['id'], []).append(len(self.entries))
+                self.entries.append(entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        chunks = []
+        for entry in self.entries:
+            chunk = (entry['shard'], entry['offset'])
+            if not chunks or chunks[-1] != chunk:
+                chunks.append(chunk)
+
+        for shard, offset in chunks:
+            yield from read_chunk(os.path.join(self.folder, shard), offset, self.vocab)
+
+    def __contains__(self, sent_id):
+        return sent_id in self.by_id
+
+    def ids(self):
+        """
+        Get the ids of the documents in the store.
+        :return: list of ids in store order, without repeats.
+        """
+        return list(self.by_id)
+
+    def get(self, sent_id):
+        """
+        Fetch the documents of a single id.
+        :param sent_id: paper SHA code.
+        :return: list of dictionaries with 'id', 'label' and 'doc' keys, empty if the id isn't stored.
+        """
+        docs = []
+        for i in self.by_id.get(sent_id, []):
+            entry = self.entries[i]
+            chunk = self._chunk(entry['shard'], entry['offset'])
+            docs.append(chunk[entry['position']])
+
+        return docs
+
+    def _read_chunk(self, shard, offset):
+        return read_chunk(os.path.join(self.folder, shard), offset, self.vocab)
+
+
+def load_docs(folder, vocab=None):
+    """
+    Open the docs stored by document_filter.py without loading them into memory.
+
+    Usage:
+
+    from doc_store import load_docs
+    docs = load_docs('data/docbin/')
+    ...
+
+    :param folder: folder where docs are stored.
+    :param vocab: Spacy vocab the documents are deserialized into. A blank vocab is used by default.
+    :return: a DocStore of dictionaries which contain relevant documents and their metadata.
+    """
+    return DocStore(folder, vocab)
@@ -0,0 +1,8 @@
+'''
+This module holds what ner_cache.py and doc_store.py share about serializing Spacy documents as DocBins.
+
+'''
+
+# Token attributes serialized with each document.
+# They cover what our scripts read: entities, sentence boundaries, dependencies, lemmas and POS tags.
+doc_attrs = ['ORTH', 'LEMMA', 'TAG', 'POS', 'HEAD', 'DEP', 'ENT_IOB', 'ENT_TYPE']
@@ -3,24 +3,27 @@ Author: Julian Fernandez
 
 This module is not used in our final app.
 
-This module can be run with two commandline arguments:
+This module can be run with the following commandline arguments:
     --doc_files a list containing jsonl CORD data
-    --out_folder a folder where the resulting pickle file should be stored
+    --out_folder a folder where the resulting DocBin shards and index should be stored
+    --resume continue from the checkpoint manifest of a crashed run
 
-The pickle file generated by running this module will contain a list of dictionaries
-which our NER system recognizes as containing protein entities.
+The folder generated by running this module will contain the Spacy documents of the sentences
+which our NER system recognizes as containing protein entities, stored as described in doc_store.py.
 """
 
-import jsonlines
 import argparse
 import spacy
-import pickle
 from tqdm import tqdm
-import pathlib
 import os.path
 
+import checkpoint
+import doc_store
+from doc_store import load_docs
+from ner_cache import NerCache
+
 # Export load_docs() for use in other modules.
-# This loads the docs from their pickle file which is the output
+# This lazily loads the docs from the DocBin shards which are the output
 # of running this file.
 # They have the form:
 # {
@@ -31,25 +34,6 @@ import os.path
 __all__ = ['load_docs']
 
 
-def load_docs(pickle_filename):
-    """
-    Load docs from pickle.
-
-    Usage:
-
-    from document_filter import load_docs
-    docs = load_docs('data/pickle/rel_docs.pickle')
-    ...
-
-    :param pickle_filename: pickle file were docs are stored.
-    :return: a list of dictionaries which contain relevant documents and their metadata.
-    """
-    with open(pickle_filename, 'rb') as fp:
-        docs = pickle.load(fp)
-
-    return docs
-
-
 # Load SciSpacy's JNLPBA NER model.
 # It tags entities with the ontology [DNA, CELL_TYPE, CELL_LINE, RNA, PROTEIN].
 nlp = spacy.load('en_ner_jnlpba_md')
@@ -63,11 +47,26 @@ parser.add_argument('--doc_files', type=str, nargs='+',
                              'data/tmnt/_comm_use_subset.jsonl',
                              'data/tmnt/_noncomm_use_subset.jsonl'],
                     help='List of filepaths to JSONL files which contain documents to be filtered.')
-parser.add_argument('--out_folder', type=str, default='data/pickle/',
-                    help='Folder which stores pickled relevant documents')
+parser.add_argument('--out_folder', type=str, default='data/docbin/',
+                    help='Folder which stores the DocBin shards and index of relevant documents')
+parser.add_argument('--checkpoint_every', type=int, default=1000,
+                    help='Number of sentences tagged between checkpoints.')
+parser.add_argument('--resume', action='store_true',
+                    help='Continue from the checkpoint manifest instead of re-tagging finished work.')
+parser.add_argument('--ner_cache', type=str, default='data/ner_cache.sqlite',
+                    help='SQLite file which caches NER results across runs and scripts.')
+parser.add_argument('--ner_cache_mb', type=int, default=2048,
+                    help='Size in megabytes the NER cache may grow to before evicting old entries.')
+parser.add_argument('--no_ner_cache', action='store_true',
+                    help='Tag every sentence with the NER model without consulting the cache.')
 
 args = parser.parse_args()
 
+# Cache of previously tagged sentences.
+ner_cache = None
+if not args.no_ner_cache:
+    ner_cache = NerCache(args.ner_cache, nlp, max_bytes=args.ner_cache_mb * 1024 ** 2)
+
 
 def sent_to_ent_types(doc):
     """
@@ -77,71 +76,103 @@ def sent_to_ent_types(doc):
     """
     return set(map(lambda e: e.label_, doc.ents))
 
-def filter_file(doc_file):
+def filter_file(doc_file, offset=0):
     """
-    Get a list of dictionaries which contain the relevant sentences along with metadata.
+    Generate the relevant sentences of a JSONL file, starting at a byte offset.
     :param doc_file: JSONL filepath which contains documents for tagging.
-    :return: List of dictionaries which contain Spacy documents which contain protein entities.
+    :param offset: byte offset of the first sentence to tag.
+    :return: generator of (end_offset, protein_doc) tuples, one per sentence, where end_offset is the byte
+             offset after the sentence and protein_doc a dictionary containing its Spacy document,
+             or None if it contains no protein entities.
     """
 
-    protein_docs = []
-    with jsonlines.open(doc_file) as reader:
-        # Loop through the JSON lines and collect the relevant documents.
-        for line in tqdm(list(reader), desc=f'Filtering from {doc_file}'):
-            sent_id = line['id']
-            sent_label = line['label']
-            sent = line['text']
-
-            # Tag the sentence with the NER model.
-            # NOTE: it's slow to tag each sentence as its own document,
-            # but Spacy can't handle the whole file's sentences as a document.
-            # NER tagging could be done in batches to speed up this function,
-            # but since we're pickling its output, it's okay that it's slow.
-            doc = nlp(sent)
-
-            # Get a set of the entity types in the sentence.
-            ent_types = sent_to_ent_types(doc)
-
-            # If one of the types is labeled protein, include it in the output list.
-            if 'PROTEIN' in ent_types:
-                # Store ID and label alongside Spacy document so we can later refer back
-                # to where the sentence came from.
-                protein_docs.append({
-                    'id': sent_id,
-                    'label': sent_label,
-                    'doc': doc
-                })
-
-    return protein_docs
-
-
-def pickle_docs(protein_docs, pickle_folder):
+    # Loop through the JSON lines and collect the relevant documents.
+    for end_offset, line in tqdm(checkpoint.read_jsonl(doc_file, offset), desc=f'Filtering from {doc_file}'):
+        sent_id = line['id']
+        sent_label = line['label']
+        sent = line['text']
+
+        # Tag the sentence with the NER model.
+        # NOTE: it's slow to tag each sentence as its own document,
+        # but Spacy can't handle the whole file's sentences as a document.
+        # NER tagging could be done in batches to speed up this function,
+        # but since we're storing its output, it's okay that it's slow.
+        # Sentences tagged in a previous run are read back from the cache instead.
+        doc = ner_cache.parse(sent) if ner_cache is not None else nlp(sent)
+
+        # Get a set of the entity types in the sentence.
+        ent_types = sent_to_ent_types(doc)
+
+        # If one of the types is labeled protein, include it in the output list.
+        if 'PROTEIN' in ent_types:
+            # Store ID and label alongside Spacy document so we can later refer back
+            # to where the sentence came from.
+            yield end_offset, {
+                'id': sent_id,
+                'label': sent_label,
+                'doc': doc
+            }
+        else:
+            yield end_offset, None
+
+
+def filter_to_shard(doc_file, manifest, manifest_file, resume=False):
     """
-    Store relevant doucments in a pickle object.
-    :param protein_docs: List of dictionaries which contain relevant documents and metadata.
-    :param pickle_filename: Filename where the pickle object will be stored.
-    :return: None
+    Store the relevant sentences of a JSONL file in its own DocBin shard, checkpointing as it goes.
+    The shard holds one chunk of documents per checkpoint.
+    :param doc_file: JSONL filepath which contains documents for tagging.
+    :param manifest: dictionary mapping input filepaths to their checkpoint entries.
+    :param manifest_file: json filepath of the manifest.
+    :param resume: whether to continue from a previous run's checkpoint.
+    :return: the shard filepath.
     """
-    # Make the folder if necessary.
-    pathlib.Path(pickle_folder).mkdir(parents=True, exist_ok=True)
+    shard_file = checkpoint.shard_path(os.path.join(args.out_folder, 'shards'), doc_file, '.docbin')
+    entry = checkpoint.start_entry(manifest, doc_file, shard_file, resume)
+
+    if entry['done']:
+        print(f'Skipping {doc_file}, already filtered into {shard_file}')
+        return shard_file
 
-    pickle_filename = os.path.join(pickle_folder, 'rel_docs.pickle')
+    if entry['offset'] > 0:
+        print(f'Resuming {doc_file} at byte {entry["offset"]} ({entry["docs"]} sentences done)')
 
-    print(f'Pickling docs at {pickle_filename}')
-    with open(pickle_filename, 'wb') as fp:
-        pickle.dump(protein_docs, fp)
+    with checkpoint.open_shard(entry, mode='ab') as shard_fp:
+        protein_docs = []
+        num_sents = 0
+        for offset, protein_doc in filter_file(doc_file, entry['offset']):
+            if protein_doc is not None:
+                protein_docs.append(protein_doc)
+            num_sents += 1
+
+            if num_sents == args.checkpoint_every:
+                if protein_docs:
+                    doc_store.write_chunk(shard_fp, protein_docs)
+                checkpoint.checkpoint(entry, offset, shard_fp, num_sents, manifest, manifest_file)
+                protein_docs = []
+                num_sents = 0
+
+        if protein_docs:
+            doc_store.write_chunk(shard_fp, protein_docs)
+        checkpoint.checkpoint(entry, entry['size'], shard_fp, num_sents, manifest, manifest_file, done=True)
+
+    return shard_file
 
 
 if __name__ == '__main__':
     doc_files = args.doc_files
     out_folder = args.out_folder
 
-    protein_docs = []
-    # Filter out irrelevant documents in each provided file.
-    for doc_file in doc_files:
-        file_docs = filter_file(doc_file)
+    manifest_file = os.path.join(out_folder, 'shards', 'manifest.json')
+    manifest = checkpoint.load_manifest(manifest_file) if args.resume else {}
+
+    # Filter out irrelevant documents in each provided file into its own shard.
+    shard_files = [filter_to_shard(doc_file, manifest, manifest_file, resume=args.resume)
+                   for doc_file in doc_files]
 
-        protein_docs.extend(file_docs)
+    # Index the ids and labels of the stored documents.
+    num_docs = doc_store.write_index(shard_files, out_folder)
+    print(f'Stored {num_docs} docs at {out_folder}')
 
-    # Pickle the relevant documents.
-    pickle_docs(protein_docs, out_folder)
+    if ner_cache is not None:
+        ner_cache.report()
+        ner_cache.close()
@@ -1,20 +1,185 @@
 '''
 Author: Kristen Sheets
 
-This module creates a merges .jsonl files created with document_parser.py
+This module merges .jsonl files created with document_parser.py
+
+Lines are copied as raw bytes. Optionally, duplicate (id, text) lines are dropped and the merged lines are shuffled
+and split into TMNT train and test files. Every output is written to a temporary file and renamed into place,
+so re-running the merge replaces its output instead of appending to it.
 
 '''
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import shutil
+from array import array
+from multiprocessing import Pool
 
-import jsonlines
 from tqdm import tqdm
 
 files = ['biorxiv_medrxiv.jsonl', 'comm_use_subset.jsonl', 'noncomm_use_subset.jsonl']
 directory = './data/tmnt/'
 
+parser = argparse.ArgumentParser(description='Merge jsonl files created with document_parser.py.')
+parser.add_argument('inputs', type=str, nargs='*', default=[directory + file for file in files],
+                    help='jsonl files or glob patterns to merge, in order.')
+parser.add_argument('--out_file', type=str, default=directory + 'covid.jsonl',
+                    help='Merged jsonl output file.')
+parser.add_argument('--dedup', action='store_true',
+                    help='Drop lines whose (id, text) pair has already been merged.')
+parser.add_argument('--shuffle', action='store_true',
+                    help='Shuffle the merged lines.')
+parser.add_argument('--test_fraction', type=float, default=0.0,
+                    help='Fraction of shuffled lines written to <out_file>_test.jsonl instead of '
+                         '<out_file>_train.jsonl. 0 writes a single merged file.')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Random seed for shuffling and splitting.')
+parser.add_argument('--workers', type=int, default=None,
+                    help='Number of processes which scan input files (defaults to the number of CPUs).')
+
+def expand_inputs(inputs):
+    paths = []
+    for pattern in inputs:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f'No input files match {pattern}')
+        paths.extend(matches)
+
+    return paths
+
+def line_hash(line):
+    # 8-byte digest of a line's (id, text) pair.
+    doc = json.loads(line)
+    key = json.dumps([doc['id'], doc['text']]).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+class HashSet:
+    # Open-addressing set of 8-byte hashes in a flat array, 16-32 bytes per hash instead of a set's 70-100.
+    def __init__(self, capacity=1 << 16):
+        size = 1
+        while size < capacity * 2:
+            size <<= 1
+        self.slots = array('Q', bytes(8 * size))
+        self.count = 0
+
+    def add(self, h):
+        # Returns False if h was already in the set. 0 marks an empty slot, so it is stored as 1.
+        h = h or 1
+        slots = self.slots
+        mask = len(slots) - 1
+        i = h & mask
+        while slots[i]:
+            if slots[i] == h:
+                return False
+            i = (i + 1) & mask
+        slots[i] = h
+        self.count += 1
+        if self.count * 2 > len(slots):
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self.slots
+        self.slots = array('Q', bytes(16 * len(old)))
+        self.count = 0
+        for h in old:
+            if h:
+                self.add(h)
+
+def scan_file(args):
+    # Record the byte offset and length of every line, and its hash if deduplicating.
+    path, dedup = args
+    offsets, lengths, hashes = array('Q'), array('Q'), array('Q')
+    with open(path, 'rb') as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                offsets.append(offset)
+                lengths.append(len(line))
+                if dedup:
+                    hashes.append(line_hash(line))
+            offset += len(line)
+
+    return offsets, lengths, hashes
+
+def atomic_open(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    return open(path + '.tmp', 'wb')
+
+def commit(path):
+    os.replace(path + '.tmp', path)
+
+def concatenate(paths, out_file):
+    # No transformation needed, so copy the files' bytes straight through.
+    with atomic_open(out_file) as out:
+        for path in tqdm(paths, desc='Merging'):
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        out.write(b'\n')
+    commit(out_file)
+
+def write_lines(paths, entries, order, out_file):
+    # Copy the raw bytes of the entries' lines in the given order.
+    file_indices, offsets, lengths = entries
+    handles = [open(path, 'rb') for path in paths]
+    try:
+        with atomic_open(out_file) as out:
+            for i in tqdm(order, desc=f'Writing {out_file}'):
+                f = handles[file_indices[i]]
+                f.seek(offsets[i])
+                line = f.read(lengths[i])
+                out.write(line if line.endswith(b'\n') else line + b'\n')
+        commit(out_file)
+    finally:
+        for f in handles:
+            f.close()
+
+def merge(paths, out_file, dedup=False, shuffle=False, test_fraction=0.0, seed=0, workers=None):
+    if not (dedup or shuffle or test_fraction):
+        concatenate(paths, out_file)
+        return
+
+    # Scan the inputs in parallel, then walk them in input order so the first copy of a duplicate is kept.
+    seen = HashSet()
+    # Parallel arrays of the kept lines' file index, byte offset and length.
+    entries = array('I'), array('Q'), array('Q')
+    num_lines = 0
+    with Pool(workers) as pool:
+        scans = pool.imap(scan_file, [(path, dedup) for path in paths])
+        for file_index, (offsets, lengths, hashes) in enumerate(tqdm(scans, desc='Scanning', total=len(paths))):
+            for i in range(len(offsets)):
+                num_lines += 1
+                if dedup and not seen.add(hashes[i]):
+                    continue
+                entries[0].append(file_index)
+                entries[1].append(offsets[i])
+                entries[2].append(lengths[i])
+    del seen
+
+    print(f'Keeping {len(entries[0])} of {num_lines} lines')
+
+    order = list(range(len(entries[0])))
+    if shuffle or test_fraction:
+        random.Random(seed).shuffle(order)
+
+    if test_fraction:
+        stem = os.path.splitext(out_file)[0]
+        num_test = int(round(len(order) * test_fraction))
+        write_lines(paths, entries, order[num_test:], stem + '_train.jsonl')
+        write_lines(paths, entries, order[:num_test], stem + '_test.jsonl')
+    else:
+        write_lines(paths, entries, order, out_file)
+
 if __name__ == '__main__':
+    args = parser.parse_args()
 
-    with jsonlines.open(directory + 'covid.jsonl', 'a') as writer:
-        for file in files:
-            with jsonlines.open(directory + file) as reader:
-                for line in tqdm(reader, desc=file):
-                    writer.write(line)
+    # A glob such as data/tmnt/*.jsonl would otherwise pick up a previous run's output.
+    paths = [path for path in expand_inputs(args.inputs) if os.path.abspath(path) != os.path.abspath(args.out_file)]
+    merge(paths, args.out_file, dedup=args.dedup, shuffle=args.shuffle,
+          test_fraction=args.test_fraction, seed=args.seed, workers=args.workers)
@@ -5,10 +5,17 @@ This module creates a preprocesses the data from the CORD-19 dataset. Removing n
 Data analysis for preprocessing was done using TF-IDF.
 
 '''
+import argparse
+import gzip
+import hashlib
+import io
 import json
+from multiprocessing import Pool
+import os
 from os import walk
 from string import punctuation
 import re
+import sys
 
 import jsonlines
 from nltk import word_tokenize
@@ -19,6 +26,8 @@ from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.feature_extraction.text import TfidfTransformer
 from tqdm import tqdm
 
+# Bump whenever pre_process changes so that incremental runs re-parse every paper.
+preprocess_version = 1
 folders = ['biorxiv_medrxiv', 'comm_use_subset', 'noncomm_use_subset', 'pmc_custom_liscence']
 directory = './data/2020-03-13/'
 stop_words = stopwords.words('english') + list(punctuation) + ['preprint', 'copyright', 'holder', 'license', 'cc', 'nc',
@@ -37,10 +46,31 @@ avail = 'It is made available under a'
 ch = 'The copyright holder for this preprint'
 doi = 'doi: medRxiv preprint'
 pr = '(which was not peer-reviewed)'
+# All of the boilerplate strings above, removed in a single pass.
+boilerplate = re.compile('|'.join(re.escape(b) for b in [cc, perp, avail, ch, doi, pr]))
+stop_word_set = frozenset(stop_words)
+
+parser = argparse.ArgumentParser(description='Preprocess the body text of CORD-19 papers into TMNT jsonl files.')
+parser.add_argument('--directory', type=str, default=directory,
+                    help='CORD-19 release directory which contains the paper json files.')
+parser.add_argument('--out_folder', type=str, default='./data/tmnt/',
+                    help='Folder to which the _<folder>.jsonl files are written.')
+parser.add_argument('--compress', type=str, choices=['none', 'gzip', 'zstd'], default='none',
+                    help='Compression of the jsonl output files (zstd requires the zstandard package).')
+parser.add_argument('--workers', type=int, default=None,
+                    help='Number of processes which parse papers (defaults to the number of CPUs).')
+parser.add_argument('--incremental', action='store_true',
+                    help='Only parse papers added or changed since the run recorded in the parse manifest, '
+                         'writing them to _<folder>.delta.jsonl files.')
+parser.add_argument('--merge', action='store_true',
+                    help='With --incremental, merge each delta into its _<folder>.jsonl file. Without it, the deltas '
+                         'are left pending and the parse manifest is only updated once they are merged.')
+parser.add_argument('--merge_only', action='store_true',
+                    help='Merge the deltas left pending by an earlier --incremental run, without re-reading the release.')
 
 def tokenize(text):
     words = [w.lower() for w in word_tokenize(text)]
-    return [w for w in words if w not in stop_words and not w.isdigit()]
+    return [w for w in words if w not in stop_word_set and not w.isdigit()]
 
 def tf_ifd(docs):
     cvec = CountVectorizer(stop_words=stop_words, min_df=3, max_df=0.5)
@@ -52,48 +82,208 @@ def tf_ifd(docs):
 
     return weights_df.sort_values(by='weight', ascending=False).head(50)
 
+def remove_boilerplate(text):
+    stripped = boilerplate.sub('', text)
+    # Removing one string can join its neighbours into another one. The sequential replaces
+    # catch that case, so fall back to them to keep the output unchanged.
+    if boilerplate.search(stripped):
+        for b in [cc, perp, avail, ch, doi, pr]:
+            text = text.replace(b, '')
+        return text
+
+    return stripped
+
 def pre_process(text):
     text = re.sub(url, '', text)
     text = re.sub(reference, '', text)
     text = re.sub(fig, '', text)
-    text = text.replace(cc, '')
-    text = text.replace(perp, '')
-    text = text.replace(avail, '')
-    text = text.replace(ch, '')
-    text = text.replace(doi, '')
-    text = text.replace(pr, '')
-    print(text)
+    text = remove_boilerplate(text)
     text = ' '.join(tokenize(text))
-    print(text)
 
     return text
 
+def paper_hash(paper):
+    return hashlib.sha1(json.dumps(paper['body_text'], sort_keys=True).encode('utf-8')).hexdigest()
+
+def hash_paper(args):
+    filepath, dirname = args
+    with open(filepath) as f:
+        paper = json.load(f)
+
+    return paper['paper_id'], paper_hash(paper)
+
+def parse_paper(args):
+    filepath, dirname = args
+    documents = []
+    with open(filepath) as f:
+        paper = json.load(f)
+        paper_id = paper['paper_id']
+        body_text = paper['body_text']
+        for t in body_text:
+            text = pre_process(t['text'])
+            if text:
+                documents.append({'id': paper_id,
+                                  'label': dirname,
+                                  'text': text})
+
+    return paper_id, paper_hash(paper), documents
+
+def open_jsonl(dataset, compress='none', mode='w'):
+    if compress == 'gzip':
+        return gzip.open(dataset + '.gz', mode + 't', encoding='utf-8')
+    if compress == 'zstd':
+        import zstandard
+        if mode == 'r':
+            return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(dataset + '.zst', 'rb')),
+                                    encoding='utf-8')
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(dataset + '.zst', 'wb')),
+                                encoding='utf-8')
+
+    return open(dataset, mode, encoding='utf-8')
+
+def load_manifest(manifest_file):
+    # The manifest maps paper_id to the hash of its body text and the folder it was found in.
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest['version'] != preprocess_version:
+            print(f'{manifest_file} was written by preprocess version {manifest["version"]}, re-parsing every paper')
+            # Keep the paper ids, so that papers dropped from the release are still deleted when merging,
+            # but no hash matches, so that every paper is re-parsed.
+            manifest = {'version': preprocess_version,
+                        'papers': {paper_id: {'hash': None, 'label': entry['label']}
+                                   for paper_id, entry in manifest['papers'].items()}}
+        return manifest
+
+    return {'version': preprocess_version, 'papers': {}}
+
+def save_manifest(manifest, manifest_file):
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+def parse_folder(papers, dirname, dataset, manifest, pool=None, compress='none', deleted=()):
+    num_documents = 0
+    with open_jsonl(dataset, compress) as fp:
+        jsonl = jsonlines.Writer(fp)
+        # Papers which were removed or changed are marked so that merge_delta drops their old paragraphs.
+        for paper_id in deleted:
+            jsonl.write({'id': paper_id, 'label': dirname, 'deleted': True})
+
+        # imap keeps the papers in input order however many workers parse them.
+        parsed = pool.imap(parse_paper, papers, chunksize=16) if pool else map(parse_paper, papers)
+        for paper_id, h, paper_documents in tqdm(parsed, desc=dirname, total=len(papers)):
+            # Write paragraphs as they are produced rather than holding the whole folder in memory.
+            jsonl.write_all(paper_documents)
+            num_documents += len(paper_documents)
+            manifest['papers'][paper_id] = {'hash': h, 'label': dirname}
+
+    return num_documents
+
+def diff_release(folder_papers, manifest, pool=None):
+    # Hash every paper of the new release and compare against the manifest.
+    papers = [paper for dirname in sorted(folder_papers) for paper in folder_papers[dirname]]
+    hashed = pool.imap(hash_paper, papers, chunksize=64) if pool else map(hash_paper, papers)
+
+    seen = set()
+    changed = {dirname: [] for dirname in folder_papers}
+    deleted = {dirname: [] for dirname in folder_papers}
+    for (filepath, dirname), (paper_id, h) in tqdm(zip(papers, hashed), desc='Hashing', total=len(papers)):
+        seen.add(paper_id)
+        old = manifest['papers'].get(paper_id)
+        if old is not None and old['hash'] == h and old['label'] == dirname:
+            continue
+
+        changed[dirname].append((filepath, dirname))
+        if old is not None:
+            deleted.setdefault(old['label'], []).append(paper_id)
+            del manifest['papers'][paper_id]
+
+    for paper_id in [p for p in manifest['papers'] if p not in seen]:
+        deleted.setdefault(manifest['papers'][paper_id]['label'], []).append(paper_id)
+        del manifest['papers'][paper_id]
+
+    return changed, deleted
+
+def merge_delta(dataset, delta, compress='none'):
+    # Rewrite dataset without the papers listed in delta, then append the delta's paragraphs.
+    replaced = set()
+    with open_jsonl(delta, compress, 'r') as fp:
+        for line in jsonlines.Reader(fp):
+            replaced.add(line['id'])
+
+    suffix = {'gzip': '.gz', 'zstd': '.zst'}.get(compress, '')
+    with open_jsonl(dataset + '.tmp', compress) as out:
+        jsonl = jsonlines.Writer(out)
+        if os.path.exists(dataset + suffix):
+            with open_jsonl(dataset, compress, 'r') as fp:
+                jsonl.write_all(line for line in jsonlines.Reader(fp) if line['id'] not in replaced)
+        with open_jsonl(delta, compress, 'r') as fp:
+            jsonl.write_all(line for line in jsonlines.Reader(fp) if not line.get('deleted'))
+    os.replace(dataset + '.tmp' + suffix, dataset + suffix)
+
+def merge_pending(pending, out_folder, compress='none'):
+    # Merge the deltas of a pending manifest, which then becomes the manifest of the merged output.
+    for dirname in pending.pop('deltas'):
+        merge_delta(out_folder + '_' + dirname + '.jsonl', out_folder + '_' + dirname + '.delta.jsonl', compress)
+
+    return pending
+
 if __name__ == '__main__':
+    args = parser.parse_args()
 
-    for (dirpath, dirnames, filenames) in walk(directory, topdown=True):
-        dirnames[:] = [d for d in dirnames if d in folders]
-        if len(dirnames) == 0 and filenames:
-            dirname = folder.findall(dirpath)[0]
-            documents = []
-            for filepath in tqdm(filenames, desc=dirname):
-                with open(dirpath + '/' + filepath) as f:
-                    paper = json.load(f)
-                    paper_id = paper['paper_id']
-                    body_text = paper['body_text']
-                    for t in body_text:
-                        text = pre_process(t['text'])
-                        if text:
-                            documents.append({'id': paper_id,
-                                              'label': dirname,
-                                              'text': text})
+    manifest_file = args.out_folder + 'parse_manifest.json'
+    # The manifest an --incremental run without --merge leaves for its deltas, until they are merged.
+    pending_file = args.out_folder + 'parse_manifest.pending.json'
 
-            dataset = './data/tmnt/_' + dirname + '.jsonl'
-            with jsonlines.open(dataset, 'w') as jsonl:
-                jsonl.write_all(documents)
+    if args.merge_only:
+        if not os.path.exists(pending_file):
+            parser.error(f'there are no pending deltas to merge in {args.out_folder}')
+        with open(pending_file) as f:
+            save_manifest(merge_pending(json.load(f), args.out_folder, args.compress), manifest_file)
+        os.remove(pending_file)
+        sys.exit()
 
-    # docs = [d['text'] for d in documents]
+    manifest = load_manifest(manifest_file) if args.incremental else {'version': preprocess_version, 'papers': {}}
 
+    folder_papers = {}
+    for (dirpath, dirnames, filenames) in walk(args.directory, topdown=True):
+        dirnames[:] = [d for d in dirnames if d in folders]
+        if len(dirnames) == 0 and filenames:
+            dirname = folder.findall(dirpath)[0]
+            folder_papers[dirname] = [(dirpath + '/' + filepath, dirname) for filepath in sorted(filenames)]
 
+    pool = Pool(args.workers) if args.workers != 1 else None
+    try:
+        if args.incremental:
+            # Diffs are always against the last merged manifest, so a delta which wasn't merged is rewritten
+            # with its changes and the new ones.
+            changed, deleted = diff_release(folder_papers, manifest, pool)
+            manifest['deltas'] = []
+            for dirname in sorted(changed.keys() | deleted.keys()):
+                papers = changed.get(dirname, [])
+                print(f'{dirname}: {len(papers)} added or changed papers, {len(deleted.get(dirname, []))} dropped')
 
+                dataset = args.out_folder + '_' + dirname + '.jsonl'
+                delta = args.out_folder + '_' + dirname + '.delta.jsonl'
+                parse_folder(papers, dirname, delta, manifest, pool, args.compress, deleted.get(dirname, []))
+                manifest['deltas'].append(dirname)
 
+            if args.merge:
+                merge_pending(manifest, args.out_folder, args.compress)
+        else:
+            for dirname, papers in folder_papers.items():
+                dataset = args.out_folder + '_' + dirname + '.jsonl'
+                parse_folder(papers, dirname, dataset, manifest, pool, args.compress)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
+    if args.incremental and not args.merge:
+        save_manifest(manifest, pending_file)
+        print('The deltas are pending until they are merged with --merge_only')
+    else:
+        save_manifest(manifest, manifest_file)
+        if os.path.exists(pending_file):
+            os.remove(pending_file)
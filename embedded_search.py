@@ -0,0 +1,770 @@
+"""
+This module is an embedded relation search engine, so that web_app.py can be run without an elasticsearch server,
+on a laptop or in CI. Build an index of a relations file with this module, then start the web app with
+SEARCH_BACKEND=embedded (and EMBEDDED_INDEX set to the index directory, if it isn't data/relation_index).
+
+The index mirrors the covid_relation_index mapping in index.py:
+- An inverted index over the predicate, stemmed as by covid_predicate_analyzer (whitespace tokenizer, lowercase and
+  porter stemmer, which nltk's Porter stemmer matches with Martin's extensions), and over the arguments, lowercased
+  as by covid_argument_analyzer.
+- Predicates and arguments are searched with the subset of query_string syntax web_app.py uses: terms, quoted
+  phrases, AND/OR/NOT (and &&, ||, !, + and -), parentheses and backslash escapes, with the 'and' or 'or'
+  default operator. Other syntax, such as wildcards, is searched as plain text.
+- Matches are scored with BM25 (k1 = 1.2, b = 0.75), as elasticsearch scores them, and sorted by score with ties
+  broken by relation id, so pages have the same search_after cursors as web_app.py's elasticsearch pages.
+  Documents are numbered in relation id order, so ties are broken by comparing doc numbers.
+- Per document keyword ordinals and years, like doc values, from which the facets of the results page are counted.
+
+Every part of the index is a flat file of fixed width integers or of strings stored back to back, which is memory
+mapped when the index is opened. Opening an index reads nothing but its meta.json, so the web app starts in
+milliseconds, and the operating system pages in the parts queries touch, so one process can serve millions of
+relations without loading them. Rebuilding an index replaces its directory once the new index is complete;
+processes which have the old index open keep reading it through their memory maps.
+"""
+
+import argparse
+import heapq
+import json
+import math
+import mmap
+import os
+import shutil
+import sys
+import time
+from array import array
+from collections import Counter
+from functools import lru_cache
+
+from nltk.stem.porter import PorterStemmer
+
+from pagination import encode_cursor
+from relations_store import load_paper_metadata, read_relations, relation_id
+
+# Version of the on-disk format.
+index_format = 2
+
+# BM25 parameters, elasticsearch's defaults.
+k1 = 1.2
+b = 0.75
+
+# Keyword values longer than this aren't counted in facets, like the ignore_above of the keyword subfields.
+ignore_above = 256
+
+# Ordinal of a missing keyword value.
+missing = 0xFFFFFFFF
+
+text_fields = ('predicate', 'arguments')
+# Facets of the results page, and the field of the relation each is counted from.
+keyword_facets = {'predicates': 'predicate', 'dois': 'doi', 'journals': 'journal'}
+
+# Like Lucene's PorterStemmer, Martin's extensions leave words of up to two letters alone and include the later
+# revisions of the algorithm, such as stemming -bli and -logi.
+stemmer = PorterStemmer(mode=PorterStemmer.MARTIN_EXTENSIONS)
+
+
+@lru_cache(maxsize=65536)
+def stem(token):
+    return stemmer.stem(token, to_lowercase=False)
+
+
+def analyze_predicate(text):
+    """
+    :param text: predicate text.
+    :return: list of tokens, as covid_predicate_analyzer produces them.
+    """
+    return [stem(token) for token in text.lower().split()]
+
+
+def analyze_argument(text):
+    """
+    :param text: argument text.
+    :return: list of tokens, as covid_argument_analyzer produces them.
+    """
+    return text.lower().split()
+
+
+analyzers = {'predicate': analyze_predicate, 'arguments': analyze_argument}
+
+
+def field_values(relation, field):
+    """
+    :return: list of the text values of a relation's field.
+    """
+    if field == 'predicate':
+        return [relation['predicate']] if relation['predicate'] else []
+    return [arg for arg in relation['arguments'] or [] if arg]
+
+
+def lex(query):
+    """
+    Split a query_string query into operator, parenthesis, term and phrase tokens.
+    :param query: query string.
+    :return: list of (kind, text) tuples, where text is None for operators and parentheses.
+    """
+    tokens = []
+    i = 0
+    while i < len(query):
+        char = query[i]
+        if char.isspace():
+            i += 1
+        elif char in '()':
+            tokens.append((char, None))
+            i += 1
+        elif char in '+-!':
+            tokens.append(('+' if char == '+' else 'NOT', None))
+            i += 1
+        elif query.startswith('&&', i) or query.startswith('||', i):
+            tokens.append(('AND' if char == '&' else 'OR', None))
+            i += 2
+        else:
+            # A phrase runs to the closing quote, a term to the next whitespace, parenthesis or quote.
+            phrase = char == '"'
+            i += phrase
+            text = []
+            while i < len(query):
+                char = query[i]
+                if char == '\\' and i + 1 < len(query):
+                    text.append(query[i + 1])
+                    i += 2
+                    continue
+                if char == '"' if phrase else char.isspace() or char in '()"':
+                    break
+                text.append(char)
+                i += 1
+            i += phrase
+            text = ''.join(text)
+            if not phrase and text in ('AND', 'OR', 'NOT'):
+                tokens.append((text, None))
+            else:
+                tokens.append(('phrase' if phrase else 'term', text))
+
+    return tokens
+
+
+def parse_query(query, field, default_operator='or'):
+    """
+    Parse a query_string query over one field into a tree of term, phrase and boolean nodes.
+    Clauses are combined as Lucene's classic query parser combines them.
+    :param query: query string.
+    :param field: 'predicate' or 'arguments'.
+    :param default_operator: 'and' or 'or', the operator between clauses without an explicit one.
+    :return: ('term', field, token), ('phrase', field, tokens) or ('bool', [(occur, node), ...]) node,
+             where occur is 'must', 'should' or 'must_not', or None if the query has no terms.
+    """
+    tokens = lex(query)
+    node, _ = _parse_clauses(tokens, 0, field, default_operator.lower() == 'and')
+    return node
+
+
+def _parse_clauses(tokens, pos, field, and_default):
+    clauses = []
+    while pos < len(tokens) and tokens[pos][0] != ')':
+        conjunction = None
+        if clauses and tokens[pos][0] in ('AND', 'OR'):
+            conjunction = tokens[pos][0]
+            pos += 1
+        modifier = None
+        if pos < len(tokens) and tokens[pos][0] in ('+', 'NOT'):
+            modifier = tokens[pos][0]
+            pos += 1
+        if pos >= len(tokens) or tokens[pos][0] == ')':
+            break
+
+        kind, text = tokens[pos]
+        pos += 1
+        if kind == '(':
+            node, pos = _parse_clauses(tokens, pos, field, and_default)
+            pos += 1
+        elif kind in ('term', 'phrase'):
+            node = _text_node(text, field, kind == 'phrase', and_default)
+        else:
+            # A stray operator.
+            continue
+
+        # Lucene's QueryParserBase.addClause.
+        if clauses and clauses[-1][0] != 'must_not':
+            if conjunction == 'AND':
+                clauses[-1] = ('must', clauses[-1][1])
+            elif conjunction == 'OR' and and_default:
+                clauses[-1] = ('should', clauses[-1][1])
+        if node is None:
+            continue
+        if modifier == 'NOT':
+            occur = 'must_not'
+        elif conjunction != 'OR' if and_default else modifier == '+' or conjunction == 'AND':
+            occur = 'must'
+        else:
+            occur = 'should'
+        clauses.append((occur, node))
+
+    if not clauses:
+        return None, pos
+    if len(clauses) == 1 and clauses[0][0] != 'must_not':
+        return clauses[0][1], pos
+    return ('bool', clauses), pos
+
+
+def _text_node(text, field, phrase, and_default):
+    tokens = analyzers[field](text)
+    if not tokens:
+        return None
+    if len(tokens) == 1:
+        return 'term', field, tokens[0]
+    if phrase:
+        return 'phrase', field, tokens
+    # An escaped space splits a term into several tokens, which are combined with the default operator.
+    return 'bool', [('must' if and_default else 'should', ('term', field, token)) for token in tokens]
+
+
+def map_file(path, typecode='B'):
+    """
+    Memory map a file read only.
+    :param path: filepath.
+    :param typecode: array typecode of the file's items.
+    :return: memoryview of the file's items.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(array(typecode))
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    return view if typecode == 'B' else view.cast(typecode)
+
+
+class Strings:
+    """
+    Strings stored back to back in a .bin file, with their offsets in an .off file, read through memory maps.
+    """
+
+    def __init__(self, path):
+        self.data = map_file(path + '.bin')
+        self.offsets = map_file(path + '.off', 'Q')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+    def __getitem__(self, i):
+        return self.raw(i).decode('utf-8')
+
+    def bisect(self, string):
+        """
+        Binary search strings written in sorted order.
+        :param string: string to look up.
+        :return: (index of the first stored string which isn't less than string, whether it equals string)
+        """
+        key = string.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo, lo < len(self) and self.raw(lo) == key
+
+    def find(self, string):
+        """
+        Binary search strings written in sorted order.
+        :param string: string to look up.
+        :return: index of the string, or -1 if it isn't stored.
+        """
+        i, found = self.bisect(string)
+        return i if found else -1
+
+
+class StringsWriter:
+    """
+    Writes strings back to back to a .bin file, and their offsets to an .off file on close.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path + '.bin', 'wb')
+        self.offsets = array('Q', [0])
+
+    def write(self, string):
+        data = string.encode('utf-8')
+        self.f.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def close(self):
+        self.f.close()
+        write_array(self.path + '.off', self.offsets)
+
+
+def write_array(path, values):
+    """
+    :param path: filepath.
+    :param values: array to write in native byte order.
+    :return: None
+    """
+    with open(path, 'wb') as f:
+        values.tofile(f)
+
+
+def build_index(relations_file='data/relations.parquet', index_dir='data/relation_index', metadata_file=None):
+    """
+    Build an embedded index of a relations file. The index replaces index_dir once it is complete.
+    :param relations_file: .parquet, .arrow or .csv relations file written by relation_extraction.py.
+    :param index_dir: directory to write the index to.
+    :param metadata_file: optional CORD-19 metadata file, from which relations get their paper's journal and year.
+    :return: number of indexed relations.
+    """
+    papers = load_paper_metadata(metadata_file)
+    building = index_dir.rstrip('/') + '.building'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    path = lambda name: os.path.join(building, name)
+
+    # term -> (doc numbers, term frequencies) for each text field.
+    postings = {field: {} for field in text_fields}
+    lengths = {field: array('I') for field in text_fields}
+
+    # value -> ordinal for each keyword facet, and the ordinal of each document's value.
+    keys = {name: {} for name in keyword_facets}
+    ordinals = {name: array('I') for name in keyword_facets}
+    argument_keys = {}
+    argument_ordinals = array('I')
+    argument_offsets = array('Q', [0])
+    years = array('H')
+
+    # Documents are numbered in file order while reading, and renumbered in relation id order afterwards.
+    docs = StringsWriter(path('docs.unsorted'))
+    rel_ids = []
+    seen = set()
+    num_docs = 0
+    for relation in read_relations(relations_file):
+        rel_id = relation_id(relation)
+        # A repeated relation is indexed once, as elasticsearch indexes it under the same id.
+        if rel_id in seen:
+            continue
+        seen.add(rel_id)
+        paper = papers.get((relation['doi'] or '').lower(), {})
+        source = {
+            'doi': relation['doi'],
+            'doc_id': relation['doc_id'],
+            'sent': relation['sent'],
+            'predicate': relation['predicate'],
+            'arguments': list(relation['arguments'] or []),
+            'rel_id': rel_id,
+            'journal': paper.get('journal'),
+            'publish_year': paper.get('publish_year'),
+        }
+        docs.write(json.dumps(source))
+        rel_ids.append(rel_id)
+
+        for field in text_fields:
+            tokens = [token for value in field_values(source, field) for token in analyzers[field](value)]
+            lengths[field].append(len(tokens))
+            for token, freq in Counter(tokens).items():
+                if token not in postings[field]:
+                    postings[field][token] = (array('I'), array('I'))
+                doc_nums, freqs = postings[field][token]
+                doc_nums.append(num_docs)
+                freqs.append(freq)
+
+        for name, key in keyword_facets.items():
+            value = source[key]
+            if isinstance(value, str) and value and len(value) <= ignore_above:
+                ordinals[name].append(keys[name].setdefault(value, len(keys[name])))
+            else:
+                ordinals[name].append(missing)
+
+        # Each distinct argument is counted once per document, as in a terms aggregation.
+        for value in dict.fromkeys(source['arguments']):
+            if value and len(value) <= ignore_above:
+                argument_ordinals.append(argument_keys.setdefault(value, len(argument_keys)))
+        argument_offsets.append(len(argument_ordinals))
+        years.append(source['publish_year'] or 0)
+
+        num_docs += 1
+
+    docs.close()
+    del seen
+
+    # order lists the documents in relation id order, and renumbered maps their file order numbers to their new ones,
+    # so that pages break ties in score by comparing doc numbers instead of relation ids.
+    order = sorted(range(num_docs), key=rel_ids.__getitem__)
+    renumbered = array('I', bytes(4 * num_docs))
+    for doc, old in enumerate(order):
+        renumbered[old] = doc
+
+    unsorted = Strings(path('docs.unsorted'))
+    docs = StringsWriter(path('docs'))
+    rel_id_writer = StringsWriter(path('rel_ids'))
+    for old in order:
+        docs.write(unsorted[old])
+        rel_id_writer.write(rel_ids[old])
+    docs.close()
+    rel_id_writer.close()
+    del unsorted
+    os.remove(path('docs.unsorted.bin'))
+    os.remove(path('docs.unsorted.off'))
+
+    lengths = {field: _reorder(lengths[field], order) for field in text_fields}
+    ordinals = {name: _reorder(ordinals[name], order) for name in keyword_facets}
+    years = _reorder(years, order)
+    sorted_ordinals = array('I')
+    sorted_offsets = array('Q', [0])
+    for old in order:
+        sorted_ordinals.extend(argument_ordinals[argument_offsets[old]:argument_offsets[old + 1]])
+        sorted_offsets.append(len(sorted_ordinals))
+    argument_ordinals, argument_offsets = sorted_ordinals, sorted_offsets
+
+    fields = {}
+    for field in text_fields:
+        terms = StringsWriter(path(f'{field}.terms'))
+        offsets = array('Q', [0])
+        with open(path(f'{field}.docs'), 'wb') as doc_file, open(path(f'{field}.freqs'), 'wb') as freq_file:
+            # Terms are sorted by their bytes, so that they can be binary searched.
+            for token in sorted(postings[field], key=lambda t: t.encode('utf-8')):
+                doc_nums, freqs = postings[field][token]
+                pairs = sorted(zip((renumbered[doc] for doc in doc_nums), freqs))
+                terms.write(token)
+                array('I', (doc for doc, _ in pairs)).tofile(doc_file)
+                array('I', (freq for _, freq in pairs)).tofile(freq_file)
+                offsets.append(offsets[-1] + len(pairs))
+        terms.close()
+        write_array(path(f'{field}.postings'), offsets)
+        write_array(path(f'{field}.lengths'), lengths[field])
+        fields[field] = {
+            'doc_count': sum(1 for length in lengths[field] if length),
+            'sum_length': sum(lengths[field]),
+            'num_terms': len(postings[field]),
+        }
+
+    for name in keyword_facets:
+        _write_keys(path(f'{name}.keys'), keys[name])
+        write_array(path(f'{name}.ords'), ordinals[name])
+    _write_keys(path('arguments.keys'), argument_keys)
+    write_array(path('arguments.ords'), argument_ordinals)
+    write_array(path('arguments.ord_offsets'), argument_offsets)
+    write_array(path('years'), years)
+
+    with open(path('meta.json'), 'w') as f:
+        json.dump({
+            'format': index_format,
+            'byteorder': sys.byteorder,
+            'relations_file': relations_file,
+            'built': time.strftime('%Y%m%d%H%M%S'),
+            'num_docs': num_docs,
+            'fields': fields,
+        }, f, indent=2)
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(building, index_dir)
+    return num_docs
+
+
+def _reorder(values, order):
+    # The values of an array of per document values, renumbered in the given order.
+    return array(values.typecode, (values[old] for old in order))
+
+
+def _write_keys(path, keys):
+    writer = StringsWriter(path)
+    # Dictionaries keep insertion order, which is the order of the ordinals.
+    for value in keys:
+        writer.write(value)
+    writer.close()
+
+
+class EmbeddedIndex:
+    """
+    A read-only, memory mapped embedded index, searched like web_app.py's elasticsearch backend.
+    Safe to share between threads.
+    """
+
+    def __init__(self, index_dir='data/relation_index'):
+        """
+        :param index_dir: directory written by build_index.
+        """
+        path = lambda name: os.path.join(index_dir, name)
+        with open(path('meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['format'] != index_format or self.meta['byteorder'] != sys.byteorder:
+            raise ValueError(f'{index_dir} was built in another format or byte order; '
+                             'rebuild it with embedded_search.py')
+
+        self.num_docs = self.meta['num_docs']
+        self.docs = Strings(path('docs'))
+        self.rel_ids = Strings(path('rel_ids'))
+
+        self.terms = {field: Strings(path(f'{field}.terms')) for field in text_fields}
+        self.postings = {field: map_file(path(f'{field}.postings'), 'Q') for field in text_fields}
+        self.postings_docs = {field: map_file(path(f'{field}.docs'), 'I') for field in text_fields}
+        self.postings_freqs = {field: map_file(path(f'{field}.freqs'), 'I') for field in text_fields}
+        self.lengths = {field: map_file(path(f'{field}.lengths'), 'I') for field in text_fields}
+
+        self.keys = {name: Strings(path(f'{name}.keys')) for name in keyword_facets}
+        self.ordinals = {name: map_file(path(f'{name}.ords'), 'I') for name in keyword_facets}
+        self.argument_keys = Strings(path('arguments.keys'))
+        self.argument_ordinals = map_file(path('arguments.ords'), 'I')
+        self.argument_offsets = map_file(path('arguments.ord_offsets'), 'Q')
+        self.years = map_file(path('years'), 'H')
+
+    def version(self):
+        """
+        :return: when the index was built, which keys web_app.py's result cache.
+        """
+        return self.meta['built']
+
+    def open_pit(self):
+        """
+        The index never changes under an open EmbeddedIndex, so pages need no point in time.
+        :return: None
+        """
+        return None
+
+    def close_pit(self, pit):
+        """
+        Nothing to close, since open_pit never opens a point in time.
+        :param pit: point in time id.
+        :return: None
+        """
+
+    def idf(self, field, doc_freq):
+        doc_count = self.meta['fields'][field]['doc_count']
+        return math.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def term_postings(self, field, token):
+        """
+        :return: (list of doc numbers, list of term frequencies) of a token.
+        """
+        i = self.terms[field].find(token)
+        if i < 0:
+            return [], []
+        start, end = self.postings[field][i], self.postings[field][i + 1]
+        return self.postings_docs[field][start:end].tolist(), self.postings_freqs[field][start:end].tolist()
+
+    def bm25(self, field, idf, freqs):
+        """
+        :param field: text field.
+        :param idf: inverse document frequency of the term or phrase.
+        :param freqs: dictionary mapping doc numbers to frequencies of the term or phrase.
+        :return: dictionary mapping doc numbers to scores.
+        """
+        if not freqs:
+            return {}
+        stats = self.meta['fields'][field]
+        avg_length = stats['sum_length'] / stats['doc_count']
+        norm, scale = k1 * (1 - b), k1 * b / avg_length
+        lengths = self.lengths[field]
+        return {doc: idf * freq / (freq + norm + scale * lengths[doc]) for doc, freq in freqs.items()}
+
+    def evaluate(self, node, top=False):
+        """
+        :param node: node from parse_query.
+        :param top: whether the node is the whole query. A whole query of only negated clauses matches every
+                    document without them, as in elasticsearch.
+        :return: dictionary mapping every matching doc number to its score.
+        """
+        if node is None:
+            return {}
+
+        kind = node[0]
+        if kind == 'term':
+            _, field, token = node
+            doc_nums, freqs = self.term_postings(field, token)
+            return self.bm25(field, self.idf(field, len(doc_nums)), dict(zip(doc_nums, freqs)))
+
+        if kind == 'phrase':
+            return self.phrase_scores(node[1], node[2])
+
+        clauses = node[1]
+        must = [self.evaluate(child) for occur, child in clauses if occur == 'must']
+        should = [self.evaluate(child) for occur, child in clauses if occur == 'should']
+        must_not = [child for occur, child in clauses if occur == 'must_not']
+        if must:
+            must.sort(key=len)
+            scores = dict(must[0])
+            for matched in must[1:]:
+                scores = {doc: score + matched[doc] for doc, score in scores.items() if doc in matched}
+            for matched in should:
+                for doc in scores:
+                    scores[doc] += matched.get(doc, 0.0)
+        elif should:
+            scores = Counter()
+            for matched in should:
+                scores.update(matched)
+            scores = dict(scores)
+        elif top:
+            scores = dict.fromkeys(range(self.num_docs), 0.0)
+        else:
+            return {}
+
+        for child in must_not:
+            for doc in self.evaluate(child):
+                scores.pop(doc, None)
+
+        return scores
+
+    def phrase_scores(self, field, tokens):
+        """
+        :return: dictionary mapping the doc numbers of documents with the phrase in one value of the field
+                 to their scores.
+        """
+        postings = [self.term_postings(field, token)[0] for token in tokens]
+        candidates = set(min(postings, key=len)).intersection(*postings)
+
+        freqs = {}
+        for doc in candidates:
+            freq = 0
+            for value in field_values(json.loads(self.docs[doc]), field):
+                value_tokens = analyzers[field](value)
+                freq += sum(value_tokens[i:i + len(tokens)] == tokens
+                            for i in range(len(value_tokens) - len(tokens) + 1))
+            if freq:
+                freqs[doc] = freq
+
+        idf = sum(self.idf(field, len(doc_nums)) for doc_nums in postings)
+        return self.bm25(field, idf, freqs)
+
+    def match(self, predicate, args, search_type):
+        """
+        Match a relation query like web_app.relation_search.
+        :param predicate: predicate query string.
+        :param args: list of argument query strings.
+        :param search_type: 'and' or 'or'.
+        :return: dictionary mapping every matching doc number to its score.
+        """
+        queries = []
+        if predicate != '':
+            queries.append(('predicate', predicate))
+        arg_query_string = ' '.join([arg for arg in args if arg != ''])
+        if arg_query_string != '':
+            queries.append(('arguments', arg_query_string))
+
+        if not queries:
+            return dict.fromkeys(range(self.num_docs), 1.0)
+
+        scores = None
+        for field, query in queries:
+            matched = self.evaluate(parse_query(query, field, search_type), top=True)
+            scores = matched if scores is None else {doc: score + matched[doc]
+                                                     for doc, score in scores.items() if doc in matched}
+        return scores
+
+    def page(self, scores, size=10, after=None, before=None):
+        """
+        Sort matches by score, with ties broken by relation id, and take the page after or before a cursor.
+        Doc numbers are in relation id order, so ties are broken by doc number and only the page's relation ids
+        are read.
+        :param scores: dictionary from match.
+        :param size: number of hits per page.
+        :param after: sort values of the last hit on the previous page, to page forwards.
+        :param before: sort values of the first hit on the next page, to page backwards.
+        :return: list of (score, rel_id, doc number) tuples in page order.
+        """
+        if after is not None:
+            score, rel_id = after
+            # Docs numbered from first on have a greater relation id than the cursor's.
+            i, found = self.rel_ids.bisect(rel_id)
+            first = i + 1 if found else i
+            hits = heapq.nsmallest(size, ((-s, doc) for doc, s in scores.items()
+                                          if s < score or s == score and doc >= first))
+        elif before is not None:
+            score, rel_id = before
+            # Docs numbered below first have a smaller relation id than the cursor's.
+            first, _ = self.rel_ids.bisect(rel_id)
+            hits = heapq.nlargest(size, ((-s, doc) for doc, s in scores.items()
+                                         if s > score or s == score and doc < first))
+            hits.reverse()
+        else:
+            hits = heapq.nsmallest(size, ((-s, doc) for doc, s in scores.items()))
+        return [(-s, self.rel_ids[doc], doc) for s, doc in hits]
+
+    def facets(self, docs, size=10):
+        """
+        :param docs: doc numbers of every match.
+        :param size: number of values per keyword facet.
+        :return: dictionary of facets like web_app.search_relations'.
+        """
+        facets = {}
+        for name in keyword_facets:
+            ordinals = self.ordinals[name]
+            counts = Counter(ordinals[doc] for doc in docs)
+            counts.pop(missing, None)
+            facets[name] = self._top(counts, self.keys[name], size)
+
+        offsets, ordinals = self.argument_offsets, self.argument_ordinals
+        counts = Counter()
+        for doc in docs:
+            counts.update(ordinals[offsets[doc]:offsets[doc + 1]].tolist())
+        facets['arguments'] = self._top(counts, self.argument_keys, size)
+
+        counts = Counter(self.years[doc] for doc in docs)
+        counts.pop(0, None)
+        facets['years'] = [[year, count] for year, count in sorted(counts.items())]
+        return facets
+
+    @staticmethod
+    def _top(counts, keys, size):
+        # Ordered like a terms aggregation: by count, then by value.
+        top = sorted(((-count, keys[ordinal]) for ordinal, count in counts.items()))[:size]
+        return [[key, -count] for count, key in top]
+
+    def search(self, predicate, args, search_type, after=None, before=None, pit=None, size=10, facet_size=10):
+        """
+        Search for a page of results, returned like web_app.search_relations.
+        :param predicate: predicate query string.
+        :param args: list of argument query strings.
+        :param search_type: 'and' or 'or'.
+        :param after: sort values of the last result on the previous page, or None.
+        :param before: sort values of the first result on the next page, or None.
+        :param pit: ignored.
+        :param size: number of results per page.
+        :param facet_size: number of values per keyword facet.
+        :return: ((dictionary of results for the page keyed by relation id, total number of results,
+                  cursor of the page's first result, cursor of its last result, dictionary of facets), None)
+        """
+        scores = self.match(predicate, args, search_type)
+        hits = self.page(scores, size, after, before)
+
+        result_list = {}
+        for score, rel_id, doc in hits:
+            source = json.loads(self.docs[doc])
+            result_list[rel_id] = {
+                'score': score,
+                'doi': source['doi'],
+                'sent': source['sent'],
+                'predicate': source['predicate'],
+                'arguments': source['arguments'],
+            }
+
+        first_cursor = encode_cursor(list(hits[0][:2])) if hits else ''
+        last_cursor = encode_cursor(list(hits[-1][:2])) if hits else ''
+
+        return (result_list, len(scores), first_cursor, last_cursor, self.facets(scores, facet_size)), None
+
+    def scan(self, predicate, args, search_type):
+        """
+        :param predicate: predicate query string.
+        :param args: list of argument query strings.
+        :param search_type: 'and' or 'or'.
+        :return: generator of the source dictionaries of every matching relation, in index order.
+        """
+        for doc in sorted(self.match(predicate, args, search_type)):
+            yield json.loads(self.docs[doc])
+
+
+# Command line arguments.
+parser = argparse.ArgumentParser(description='Build an embedded relation index, searched in process by web_app.py '
+                                             'with SEARCH_BACKEND=embedded.')
+parser.add_argument('--relations_file', type=str, default='data/relations.parquet',
+                    help='.parquet, .arrow or .csv relations file written by relation_extraction.py.')
+parser.add_argument('--metadata_file', type=str, default=None,
+                    help="Optional CORD-19 metadata.csv (or json lines) file, from which relations get their paper's "
+                         "journal and publication year by DOI.")
+parser.add_argument('--index_dir', type=str, default='data/relation_index',
+                    help='Directory to write the index to.')
+
+
+# Run this module to build the index.
+if __name__ == '__main__':
+    args = parser.parse_args()
+    start_time = time.time()
+    num_docs = build_index(args.relations_file, args.index_dir, args.metadata_file)
+    print(f'=== Indexed {num_docs} relations in {time.time() - start_time} seconds ===')
@@ -3,17 +3,26 @@ Author: Julian Fernandez
 
 This file generates an elasticsearch index. Run this before running web_app.py.
 Make sure that elasticsearch is running in the background beforehand.
+
+The web app searches the covid_relation_index alias. Each run builds a new, timestamped version of the index
+and swaps the alias to it once it is complete, so the web app keeps serving the previous version during a rebuild.
+Relations are indexed under ids hashed from their content, so --delta can instead update the live index in place,
+indexing only new or changed relations and deleting the ones which are no longer in the relations file.
 """
 
 
-import csv
+import argparse
 import time
 
 from elasticsearch import Elasticsearch
 from elasticsearch import helpers
-from elasticsearch_dsl import Index, Document, Text
+from elasticsearch_dsl import Index, Document, Text, Keyword, Integer
 from elasticsearch_dsl.connections import connections
 from elasticsearch_dsl.analysis import analyzer
+from tqdm import tqdm
+
+from index_versions import delete_old_versions, fingerprint, mark_updated, swap_alias, versioned_name
+from relations_store import load_paper_metadata, read_relations, relation_id
 
 # Connect to local host server
 connections.create_connection(hosts=['127.0.0.1'])
@@ -37,78 +46,304 @@ class RelationDocument(Document):
     A RelationDocument contains two text fields for querying over.
     predicate refers to the tuple's first element.
     arguments refers to the tuple's remaining elements.
+    Both have keyword subfields, and doi, journal and publish_year are keywords and integers,
+    so that web_app.py can aggregate over them.
     """
-    predicate = Text(analyzer=predicate_analyzer)
-    arguments = Text(analyzer=argument_analyzer)
+    predicate = Text(analyzer=predicate_analyzer, fields={'keyword': Keyword(ignore_above=256)})
+    arguments = Text(analyzer=argument_analyzer, fields={'keyword': Keyword(ignore_above=256)})
+    doi = Keyword()
+    # The journal and publication year of the relation's paper, from the CORD-19 metadata.
+    journal = Keyword()
+    publish_year = Integer()
+    # Hash of the indexed fields, compared by update_index to find changed relations.
+    fingerprint = Keyword()
+    # Copy of the document id, which breaks ties in score when paging with search_after.
+    rel_id = Keyword()
 
     def save(self, *args, **kwargs):
         return super(RelationDocument, self).save(*args, **kwargs)
 
 
-def build_index():
+def relation_actions(relations_file, index_name='covid_relation_index', existing=None, papers=None):
     """
-    Main function of this module. Build the covid relation index.
+    Lazily convert relations to bulk index actions, one row at a time.
+    :param relations_file: .parquet, .arrow or .csv relations file written by relation_extraction.py.
+    :param index_name: name of the index the actions target.
+    :param existing: optional dictionary mapping the ids of already indexed relations to their fingerprints.
+                     Unchanged relations are skipped, and every relation read is removed from the dictionary,
+                     leaving the ids of relations which are no longer in the file.
+    :param papers: optional dictionary from load_paper_metadata, which adds each relation's journal and year.
+    :return: generator of bulk action dictionaries. With existing, relations repeated in the file get a single action.
+    """
+    # A sentence parsed twice yields the same relation twice. A full build indexes the repeat again under the same
+    # id, which is harmless, but a delta has to skip it: it would no longer be in existing, and so would be
+    # indexed again on every delta. Only deltas, which hold every indexed id in existing anyway, keep the ids
+    # they have read.
+    seen = set() if existing is not None else None
+    for relation in read_relations(relations_file):
+        rel_id = relation_id(relation)
+        if seen is not None:
+            if rel_id in seen:
+                continue
+            seen.add(rel_id)
+        paper = papers.get((relation['doi'] or '').lower(), {}) if papers else {}
+        source = {
+            # The DOI allows us to link directly to the article's page where it's hosted.
+            'doi': relation['doi'],
+            # The doc_id refers to the CORD-NER-corpus.json dataset. This field is unused in our web app.
+            'doc_id': relation['doc_id'],
+            # Sent refers to the sentence from which the document was drawn.
+            'sent': relation['sent'],
+            # Predicate refers to the predicate as explained in the RelationDocument class
+            'predicate': relation['predicate'],
+            # Argument refers to the arguments as explained in the RelationDocument class
+            'arguments': relation['arguments'],
+            # Copy of the document id, which breaks ties in score when paging through results.
+            'rel_id': rel_id,
+            'journal': paper.get('journal'),
+            'publish_year': paper.get('publish_year'),
+        }
+        source['fingerprint'] = fingerprint(source)
+
+        if existing is not None and existing.pop(rel_id, None) == source['fingerprint']:
+            continue
+
+        yield {
+            '_index': index_name,
+            '_id': rel_id,
+            **source,
+        }
+
+
+def delta_actions(relations_file, index_name, existing, papers=None):
+    """
+    Bulk actions which bring an index up to date with a relations file.
+    New and changed relations are indexed, then relations which are no longer in the file are deleted.
+    :param relations_file: .parquet, .arrow or .csv relations file written by relation_extraction.py.
+    :param index_name: name of the index the actions target.
+    :param existing: dictionary mapping the ids of indexed relations to their fingerprints.
+    :param papers: optional dictionary from load_paper_metadata.
+    :return: generator of bulk action dictionaries.
+    """
+    yield from relation_actions(relations_file, index_name, existing, papers)
+
+    for rel_id in existing:
+        yield {
+            '_op_type': 'delete',
+            '_index': index_name,
+            '_id': rel_id,
+        }
+
+
+def indexed_fingerprints(client, index_name):
+    """
+    :param client: Elasticsearch client.
+    :param index_name: name of the index to read.
+    :return: dictionary mapping the id of every document in the index to its fingerprint.
+    """
+    hits = helpers.scan(client, index=index_name, query={'_source': ['fingerprint']}, size=5000)
+    return {hit['_id']: hit['_source'].get('fingerprint') for hit in tqdm(hits, desc='Reading index', unit='docs')}
+
+
+def tune_for_load(client, index_name):
+    """
+    Turn off refresh and replicas for the duration of a bulk load.
+    :param client: Elasticsearch client.
+    :param index_name: name of the index being loaded.
+    :return: dictionary of the index settings to restore afterwards.
+    """
+    current = client.indices.get_settings(index=index_name, flat_settings=True)[index_name]['settings']
+    # Settings which were never set explicitly are restored to their defaults with None.
+    previous = {
+        'index.refresh_interval': current.get('index.refresh_interval'),
+        'index.number_of_replicas': current.get('index.number_of_replicas'),
+    }
+    client.indices.put_settings(index=index_name, body={
+        'index.refresh_interval': '-1',
+        'index.number_of_replicas': 0,
+    })
+    return previous
+
+
+def restore_settings(client, index_name, previous):
+    """
+    Restore the settings changed by tune_for_load and make the loaded documents searchable.
+    :param client: Elasticsearch client.
+    :param index_name: name of the loaded index.
+    :param previous: dictionary returned by tune_for_load.
     :return: None
     """
-    covid_index = Index('covid_relation_index')
+    client.indices.put_settings(index=index_name, body=previous)
+    client.indices.refresh(index=index_name)
 
-    if covid_index.exists():
-        # Overwrite any previous version
-        covid_index.delete()
+
+def bulk_load(client, actions, chunk_size=500, threads=4, max_retries=3, max_errors=10):
+    """
+    Stream actions into elasticsearch and report throughput and failures.
+    :param client: Elasticsearch client.
+    :param actions: iterable of bulk action dictionaries.
+    :param chunk_size: number of documents sent per bulk request.
+    :param threads: number of threads sending bulk requests. With 1 thread, streaming_bulk is used,
+                    which retries requests rejected with 429 up to max_retries times.
+    :param max_retries: retries per rejected bulk request, for streaming_bulk.
+    :param max_errors: number of failed items to print.
+    :return: (number of indexed documents, number of failed documents)
+    """
+    if threads > 1:
+        results = helpers.parallel_bulk(client, actions, thread_count=threads, chunk_size=chunk_size,
+                                        queue_size=threads * 2, raise_on_error=False)
+    else:
+        results = helpers.streaming_bulk(client, actions, chunk_size=chunk_size, max_retries=max_retries,
+                                         raise_on_error=False)
+
+    num_ok = 0
+    num_failed = 0
+    start_time = time.time()
+    for ok, item in tqdm(results, desc='Indexing', unit='docs'):
+        if ok:
+            num_ok += 1
+            continue
+
+        num_failed += 1
+        if num_failed <= max_errors:
+            print(f'Failed to index: {item}')
+
+    elapsed = time.time() - start_time
+    print(f'Indexed {num_ok} documents in {elapsed:.1f} seconds ({num_ok / max(elapsed, 1e-9):.1f} docs/sec), '
+          f'{num_failed} failed')
+    return num_ok, num_failed
+
+
+def build_index(relations_file='data/relations.parquet', client=None, chunk_size=500, threads=4, max_retries=3,
+                tune=True, keep=1, metadata_file=None):
+    """
+    Main function of this module. Build the covid relation index.
+    The relations are loaded into a new version of the index while the web app keeps searching the current one.
+    Once the load has finished, the covid_relation_index alias is swapped to the new version.
+    If any relation fails to index, the new version is deleted and the alias is left on the current one.
+    :param relations_file: .parquet, .arrow or .csv relations file written by relation_extraction.py.
+    :param client: Elasticsearch client. Defaults to the local host server.
+    :param chunk_size: number of documents sent per bulk request.
+    :param threads: number of threads sending bulk requests.
+    :param max_retries: retries per rejected bulk request when using a single thread.
+    :param tune: turn off refresh and replicas during the load and restore them afterwards.
+    :param keep: number of previous versions of the index to keep.
+    :param metadata_file: optional CORD-19 metadata file from which relations get their paper's journal and year.
+    :return: (number of indexed documents, number of failed documents)
+    """
+    if client is None:
+        client = es
+    papers = load_paper_metadata(metadata_file)
+    alias = 'covid_relation_index'
+    index_name = versioned_name(alias)
+    covid_index = Index(index_name, using=client)
 
     covid_index.document(RelationDocument)
 
     covid_index.create()
 
-    metadata = {}
-    with open('data/relations.csv', newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        header = next(reader)
-
-        # For each value in the CSV file, create a dictionary entry to store
-        # it's information in the appropriate place.
-        for i, cols in enumerate(reader):
-            metadata[str(i+1)] = {}
-            for key, col in zip(header, cols):
-                # If the value type is triple, decompose the value
-                # into arg subcomponents.
-                if key == 'triple':
-                    # Get the predicate and the arguments.
-                    predicate, *args = col[2:-2].replace('\'', '').split(',')
-                    metadata[str(i+1)]['predicate'] = predicate
-                    metadata[str(i + 1)]['arguments'] = args
-                else:
-                    metadata[str(i+1)][key] = col
-
-    def actions():
-        for rel_id in range(1, len(metadata)+1):
-            dict_id = str(rel_id)
-            try:
-                yield {
-                    '_index': 'covid_relation_index',
-                    '_type': '_doc',
-                    '_id': rel_id,
-                    # The DOI allows us to link directly to the article's page where it's hosted.
-                    'doi': metadata[dict_id]['doi'],
-                    # The doc_id refers to the CORD-NER-corpus.json dataset. This field is unused in our web app.
-                    'doc_id': metadata[dict_id]['doc_id'],
-                    # Sent refers to the sentence from which the document was drawn.
-                    'sent': metadata[dict_id]['sent'],
-                    # Predicate refers to the predicate as explained in the RelationDocument class
-                    'predicate': metadata[dict_id]['predicate'],
-                    # Argument refers to the arguments as explained in the RelationDocument class
-                    'arguments': metadata[dict_id]['arguments'],
-                }
-            except ValueError:
-                continue
-            except KeyError:
-                continue
+    try:
+        previous = tune_for_load(client, index_name) if tune else None
+        try:
+            result = bulk_load(client, relation_actions(relations_file, index_name, papers=papers),
+                               chunk_size=chunk_size, threads=threads, max_retries=max_retries)
+        finally:
+            if tune:
+                restore_settings(client, index_name, previous)
+        client.cluster.health(index=index_name, wait_for_status='yellow')
+        if result[1]:
+            raise RuntimeError(f'{result[1]} relations failed to index into {index_name}')
+    except BaseException:
+        # Leave the alias on the current version and drop the partial one.
+        covid_index.delete()
+        raise
+
+    swap_alias(client, alias, index_name)
+    print(f'{alias} now points to {index_name}')
+    for name in delete_old_versions(client, alias, keep):
+        print(f'Deleted old version {name}')
+
+    return result
+
+
+def update_index(relations_file='data/relations.parquet', client=None, chunk_size=500, threads=4, max_retries=3,
+                 metadata_file=None):
+    """
+    Bring the live covid relation index up to date with a relations file in place.
+    Only new or changed relations are indexed and relations which are no longer in the file are deleted.
+    The index's mapping is then marked as updated, which clears the web app's result cache.
+    If there is no index yet, a full one is built.
+    :param relations_file: .parquet, .arrow or .csv relations file written by relation_extraction.py.
+    :param client: Elasticsearch client. Defaults to the local host server.
+    :param chunk_size: number of documents sent per bulk request.
+    :param threads: number of threads sending bulk requests.
+    :param max_retries: retries per rejected bulk request when using a single thread.
+    :param metadata_file: optional CORD-19 metadata file from which relations get their paper's journal and year.
+    :return: (number of indexed or deleted documents, number of failed documents)
+    """
+    if client is None:
+        client = es
+    alias = 'covid_relation_index'
+    if not client.indices.exists_alias(name=alias):
+        print(f'{alias} does not exist yet, building it')
+        return build_index(relations_file, client=client, chunk_size=chunk_size, threads=threads,
+                           max_retries=max_retries, metadata_file=metadata_file)
+
+    index_name, = client.indices.get_alias(name=alias)
+    existing = indexed_fingerprints(client, index_name)
+    num_indexed = len(existing)
+
+    papers = load_paper_metadata(metadata_file)
+    result = bulk_load(client, delta_actions(relations_file, index_name, existing, papers), chunk_size=chunk_size,
+                       threads=threads, max_retries=max_retries)
+    client.indices.refresh(index=index_name)
+    if result[0]:
+        # The index keeps its name, so the web app's result cache needs another way to tell it has changed.
+        mark_updated(client, index_name)
+
+    # Once the actions are exhausted, existing holds exactly the deleted relations.
+    num_deleted = len(existing)
+    print(f'{num_indexed - num_deleted} of {num_indexed} indexed relations kept, {num_deleted} deleted, '
+          f'{result[0] - num_deleted} new or changed relations indexed')
+    return result
+
 
-    helpers.bulk(es, actions())
+# Command line arguments.
+parser = argparse.ArgumentParser(description='Build the covid relation elasticsearch index.')
+parser.add_argument('--relations_file', type=str, default='data/relations.parquet',
+                    help='.parquet, .arrow or .csv relations file written by relation_extraction.py.')
+parser.add_argument('--metadata_file', type=str, default=None,
+                    help="Optional CORD-19 metadata.csv (or json lines) file, from which relations get their paper's "
+                         "journal and publication year by DOI.")
+parser.add_argument('--host', type=str, default=None,
+                    help='Elasticsearch host to index into, such as a local test instance (defaults to 127.0.0.1).')
+parser.add_argument('--chunk_size', type=int, default=500,
+                    help='Number of documents sent per bulk request.')
+parser.add_argument('--threads', type=int, default=4,
+                    help='Number of threads sending bulk requests. 1 streams requests from a single thread, '
+                         'retrying rejected requests.')
+parser.add_argument('--max_retries', type=int, default=3,
+                    help='Retries per rejected bulk request when using a single thread.')
+parser.add_argument('--keep_settings', action='store_true',
+                    help="Don't turn off refresh and replicas during the load.")
+parser.add_argument('--delta', action='store_true',
+                    help='Update the live index in place, indexing only new or changed relations and deleting '
+                         'relations which are no longer in the file, instead of building a new version.')
+parser.add_argument('--keep_versions', type=int, default=1,
+                    help='Number of previous versions of the index to keep after swapping the alias.')
 
 
 # Run this module to build the index.
 if __name__ == '__main__':
+    args = parser.parse_args()
+    client = Elasticsearch(hosts=[args.host]) if args.host else es
     start_time = time.time()
-    build_index()
-    print(f'=== Built index in {time.time() - start_time} seconds ===')
+    if args.delta:
+        update_index(args.relations_file, client=client, chunk_size=args.chunk_size, threads=args.threads,
+                     max_retries=args.max_retries, metadata_file=args.metadata_file)
+        print(f'=== Updated index in {time.time() - start_time} seconds ===')
+    else:
+        build_index(args.relations_file, client=client, chunk_size=args.chunk_size, threads=args.threads,
+                    max_retries=args.max_retries, tune=not args.keep_settings, keep=args.keep_versions,
+                    metadata_file=args.metadata_file)
+        print(f'=== Built index in {time.time() - start_time} seconds ===')
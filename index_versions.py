@@ -0,0 +1,101 @@
+'''
+This module manages the versions of an elasticsearch index which are served behind an alias.
+
+Each build loads a new physical index named after the alias and swaps the alias to it once the load is complete,
+so searches keep being served by the previous version in the meantime. Indexed documents carry a fingerprint of
+their fields, so that an update in place can tell which documents have changed, and an updated index records when it
+was updated in its mapping's _meta, so that caches of its results can tell it has changed. It is shared by index.py and
+metadata_browser/covid_index.py, and importing it doesn't connect to elasticsearch.
+
+Usage:
+
+from index_versions import versioned_name, swap_alias, delete_old_versions
+index_name = versioned_name('covid_relation_index')
+...
+swap_alias(client, 'covid_relation_index', index_name)
+delete_old_versions(client, 'covid_relation_index', keep=1)
+
+'''
+import hashlib
+import json
+import secrets
+import time
+
+__all__ = ['versioned_name', 'swap_alias', 'delete_old_versions', 'fingerprint', 'mark_updated', 'updated_marker']
+
+
+def versioned_name(alias):
+    """
+    :param alias: alias which is searched.
+    :return: name of a new physical index behind the alias, suffixed with the current time in microseconds
+             and a random tag, so that builds started within the same second don't collide.
+    """
+    now = time.time()
+    stamp = time.strftime('%Y%m%d%H%M%S', time.localtime(now))
+    return f'{alias}-{stamp}{int(now % 1 * 1e6):06d}-{secrets.token_hex(2)}'
+
+
+def swap_alias(client, alias, index_name):
+    """
+    Atomically point an alias at a new index, removing it from any index it pointed at before.
+    An index from before aliases were used, which has the alias's own name, is deleted in the same request.
+    :param client: Elasticsearch client.
+    :param alias: alias to swap.
+    :param index_name: fully built index the alias should point at.
+    :return: None
+    """
+    actions = []
+    if client.indices.exists_alias(name=alias):
+        for old_index in client.indices.get_alias(name=alias):
+            actions.append({'remove': {'index': old_index, 'alias': alias}})
+    elif client.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+
+    actions.append({'add': {'index': index_name, 'alias': alias}})
+    client.indices.update_aliases(body={'actions': actions})
+
+
+def delete_old_versions(client, alias, keep=1):
+    """
+    Delete versions of an index which the alias no longer points at.
+    :param client: Elasticsearch client.
+    :param alias: alias whose versions are deleted.
+    :param keep: number of the most recent previous versions to keep for rolling back.
+    :return: list of deleted index names.
+    """
+    live = set(client.indices.get_alias(name=alias)) if client.indices.exists_alias(name=alias) else set()
+    # Version suffixes start with a timestamp, so sorting by name sorts by age.
+    versions = sorted(name for name in client.indices.get(index=f'{alias}-*') if name not in live)
+    old_versions = versions[:max(len(versions) - keep, 0)]
+    for name in old_versions:
+        client.indices.delete(index=name)
+
+    return old_versions
+
+
+def fingerprint(source):
+    """
+    :param source: document fields to be indexed.
+    :return: short hash of the fields, used to tell whether an indexed document has changed.
+    """
+    return hashlib.blake2b(json.dumps(source, sort_keys=True).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def mark_updated(client, index_name):
+    """
+    Record in the index's mapping that its documents were updated in place, for updated_marker to read.
+    :param client: Elasticsearch client.
+    :param index_name: name of the updated index.
+    :return: the new marker.
+    """
+    marker = f'{time.time():.6f}'
+    client.indices.put_mapping(index=index_name, body={'_meta': {'updated': marker}})
+    return marker
+
+
+def updated_marker(mapping):
+    """
+    :param mapping: an index's entry in a get_mapping response.
+    :return: the marker left by the last mark_updated call, or None if the index was never updated in place.
+    """
+    return mapping.get('mappings', {}).get('_meta', {}).get('updated')
@@ -1,22 +1,36 @@
+import argparse
+import csv
+import hashlib
 import json
 import math
+import os
 import re
+import sys
 import time
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
 
-from elasticsearch import Elasticsearch
 from elasticsearch import helpers
 from elasticsearch_dsl import Index, Document, Text, Keyword, Integer
-from elasticsearch_dsl.connections import connections
 from elasticsearch_dsl.analysis import tokenizer, analyzer
 from elasticsearch_dsl.query import MultiMatch, Match
 
+# the index versioning, fingerprint and search service helpers are shared with the relation index and web app
+# at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from index_versions import delete_old_versions, fingerprint, mark_updated, swap_alias, versioned_name
+from search_service import SearchService
+
 year = re.compile(r'(\d\d\d\d)') #regex pattern for year
+corpus_file = 'covid_comm_use_subset_meta.json'
 
-# Connect to local host server
-connections.create_connection(hosts=['127.0.0.1'])
+# Connect to the server at ES_HOST (defaults to the local host server) through the search service shared with
+# web_app.py, whose pool of keep-alive connections serves the bulk loader's threads and covid_query's request threads.
+service = SearchService(pool_size=int(os.environ.get('ES_POOL_SIZE', 25)))
 
 # Create elasticsearch object
-es = Elasticsearch()
+es = service.client
 
 # Define analyzers appropriate for your data.
 # You can create a custom analyzer by choosing among elasticsearch options
@@ -24,23 +38,26 @@ es = Elasticsearch()
 # Elasticsearch also has default analyzers that might be appropriate.
 
 #used of simple text
-basic_analyzer = analyzer('custom',
+basic_analyzer = analyzer('covid_basic_analyzer',
                           tokenizer='classic',
                           filter=['lowercase'])
 
 #used for robust text
-ks_analyzer = analyzer('custom',
+ks_analyzer = analyzer('covid_ks_analyzer',
                         tokenizer='standard',
                         filter=['lowercase', 'asciifolding', 'porter_stem'])
 
 
 # Define document mapping (schema) by defining a class as a subclass of Document.
 # This defines fields and their properties (type and analysis applied).
+# The fields match what buildIndex sends and covid_query searches: the abstract is indexed as text.
 class CovidDoc(Document):
     title = Text(analyzer=ks_analyzer)
-    abstract = Text(analyzer=ks_analyzer)
+    text = Text(analyzer=ks_analyzer)
     authors = Text(analyzer=basic_analyzer)
-    publish_time =  Text(analyzer='simple')
+    publish_time = Integer()  # publication year, with doc values for range filters and histograms
+    doc_id = Keyword()  # sortable, for paging with search_after
+    fingerprint = Keyword()  # hash of the indexed fields, compared by updateIndex
 
 
     # override the Document save method to include subclass field definitions
@@ -48,68 +65,228 @@ class CovidDoc(Document):
         return super(CovidDoc, self).save(*args, **kwargs)
 
 
+# The query app searches this alias, which points at the latest complete version of the index.
+alias = 'covid_doc_index'
+
+
+def readRecords(filename):
+    """
+    readRecords yields the raw records of the covid metadata corpus without parsing them,
+    so that parsing and normalizing can be spread over a worker pool.
+    json files (one doc per line, like covid_comm_use_subset_meta.json) yield lines,
+    csv files (like CORD-19's full metadata.csv) yield row dictionaries, since quoted fields can span lines.
+    """
+    if filename.endswith('.csv'):
+        with open(filename, 'r', encoding='utf-8', newline='') as data_file:
+            yield from csv.DictReader(data_file)
+    else:
+        with open(filename, 'r', encoding='utf-8') as data_file:
+            yield from data_file
+
+
+def docId(doc):
+    """
+    docId derives a stable id from the doc's paper id if it has one, otherwise from its title and authors,
+    so a doc keeps its id when the corpus is reordered or other docs are added and removed.
+    """
+    for key in ('cord_uid', 'sha', 'doi'):
+        if doc.get(key):
+            content = key + ':' + doc[key]
+            break
+    else:
+        content = json.dumps([doc.get('title'), doc.get('authors')])
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def normalizeRecord(record):
+    """
+    normalizeRecord turns a raw record into the indexed fields of a doc, or None if the record can't be parsed.
+    NaN values (json) and empty strings (csv) become None and publish times are shortened to their year, as an integer.
+    Runs in the worker pool.
+    """
+    if isinstance(record, str):
+        try:
+            doc = json.loads(record)
+        except json.decoder.JSONDecodeError:
+            return None
+    else:
+        doc = record
+    for key, value in doc.items():
+        if isinstance(value, float) and math.isnan(value) or value == '':
+            doc[key] = None
+
+    publish_time = doc.get('publish_time')
+    if publish_time is not None:
+        match = re.search(year, str(publish_time))
+        doc['publish_time'] = int(match.group(0)) if match else None
+
+    source = {
+        "title": doc.get('title'),
+        "text": doc.get('abstract'),  # the abstract is searched as the text field
+        "authors": doc.get('authors'),
+        "publish_time": doc.get('publish_time'),
+        "doc_id": docId(doc)  # copy of the id, which breaks ties in score when paging through results
+    }
+    source["fingerprint"] = fingerprint(source)
+    return source
+
+
+def normalizeChunk(records):
+    """
+    normalizeChunk normalizes a chunk of records in one task of the worker pool.
+    """
+    return [normalizeRecord(record) for record in records]
+
+
+def normalizedRecords(filename=corpus_file, workers=None, chunk_records=256):
+    """
+    normalizedRecords reads the corpus in chunks, normalizes them in a pool of workers and yields the docs in order.
+    At most two chunks per worker are in the pool at a time, and the next chunk is only read once parallel_bulk
+    has taken the docs of the oldest one, so memory stays bounded however fast the workers are.
+    With 0 workers, records are normalized in the loading thread.
+    """
+    records = readRecords(filename)
+    if workers == 0:
+        yield from map(normalizeRecord, records)
+        return
+
+    workers = workers or os.cpu_count()
+    with Pool(workers) as pool:
+        in_flight = deque()
+        while True:
+            while len(in_flight) < 2 * workers:
+                chunk = list(islice(records, chunk_records))
+                if not chunk:
+                    break
+                in_flight.append(pool.apply_async(normalizeChunk, (chunk,)))
+            if not in_flight:
+                return
+            yield from in_flight.popleft().get()
+
+
+def docActions(index_name, filename=corpus_file, existing=None, workers=None):
+    """
+    docActions streams the corpus through the worker pool and yields an index action for each doc, in corpus order.
+    If existing maps indexed ids to fingerprints, unchanged docs are skipped and each doc read is removed from it,
+    leaving the ids of docs which are no longer in the corpus.
+    Docs repeated in the corpus (metadata.csv lists some papers more than once) are indexed again under the same id
+    by a full build. A delta only indexes them the first time, since a repeat would no longer be in existing
+    and so would be indexed again on every delta.
+    """
+    # only deltas keep the ids they have read: they hold every indexed id in existing anyway
+    seen = set() if existing is not None else None
+    for source in normalizedRecords(filename, workers):
+        if source is None:
+            continue
+        doc_id = source["doc_id"]
+        if seen is not None:
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+            if existing.pop(doc_id, None) == source["fingerprint"]:
+                continue
+        yield dict(_index=index_name, _id=doc_id, **source)
+
+
+def bulkLoad(actions, threads=4, chunk_size=500):
+    """
+    bulkLoad indexes actions with parallel_bulk and reports throughput and failures.
+    Returns the number of indexed and failed actions.
+    """
+    num_ok, num_failed = 0, 0
+    start_time = time.time()
+    for ok, item in helpers.parallel_bulk(es, actions, thread_count=threads, chunk_size=chunk_size,
+                                          raise_on_error=False):
+        if ok:
+            num_ok += 1
+        else:
+            num_failed += 1
+            if num_failed <= 10:
+                print("Failed: %s" % item)
+    elapsed = max(time.time() - start_time, 1e-9)
+    print("Indexed %d docs (%.1f docs/sec), %d failed" % (num_ok, num_ok / elapsed, num_failed))
+    return num_ok, num_failed
+
+
 # Populate the index
-def buildIndex():
+def buildIndex(filename=corpus_file, keep=1, workers=None, threads=4, chunk_size=500):
     """
-    buildIndex creates a new film index, deleting any existing index of
-    the same name.
-    It loads a json file containing the covid doc metadata corpus and does bulk loading
-    using a generator function.
+    buildIndex creates a new, timestamped version of the covid doc index
+    and swaps the covid_doc_index alias to it once it is fully loaded,
+    so searches keep being served by the previous version during the rebuild.
+    If any doc fails to index, the new version is deleted and the alias stays where it was.
+    It streams the covid doc metadata corpus (json or csv) through a pool of workers which normalize the docs,
+    and bulk loads them with parallel_bulk as they come.
     """
-    doc_index = Index('covid_doc_index')
-    if doc_index.exists():
-        doc_index.delete()  # Overwrite any previous version
+    index_name = versioned_name(alias)
+    doc_index = Index(index_name)
     doc_index.analyzer(basic_analyzer)  # register your customized analyzer as the default analyzer
+    doc_index.document(CovidDoc)  # explicit mapping of the fields that covid_query searches
     doc_index.create()
 
-    # Open the covid metadata corpus
-    with open('covid_comm_use_subset_meta.json', 'r', encoding='utf-8') as data_file:
-        enum_id = 1
-        documents = {}
-        for line in data_file:
-            try:
-                doc = json.loads(line)
-                for key in doc.keys():
-                    if type(doc.get(key)) is not str:
-                        if math.isnan(doc.get(key)):
-                            doc.update({key: None})
-                    if key == "publish_time" and doc.get(key) and len(doc.get(key)) > 4:
-                        match = re.search(year, doc[key]).group(0)
-                        if match:
-                            doc.update({key: match})
-                documents.update({str(enum_id): doc})
-                enum_id+=1
-            except json.decoder.JSONDecodeError:
-                continue
-        # load doc metadata from json file into dictionary
-        size = len(documents)
-
-    # Action series for bulk loading with helpers.bulk function.
-    # Implemented as a generator, to return one movie with each call.
-    # Note that we include the index name here.
-    # The Document type is always 'doc'.
-    # Every item to be indexed must have a unique key.
-    def actions():
-        # enum_id is an enumerated id created when reading the json and used as key into covid metadata dictionary)
-        for enum_id in range(1, size + 1):
-            yield {
-                "_index": "covid_doc_index",
-                "_type": 'doc',
-                "_id": enum_id,
-                "title": documents[str(enum_id)].get('title', 'None'),
-                "text": documents[str(enum_id)].get('abstract', 'None'),
-                "authors": documents[str(enum_id)].get('authors', 'None'),
-                "publish_time": documents[str(enum_id)].get('publish_time', int(0000))
-            }
-
-    helpers.bulk(es, actions())
+    try:
+        _, num_failed = bulkLoad(docActions(index_name, filename, workers=workers), threads, chunk_size)
+        es.indices.refresh(index=index_name)
+        if num_failed:
+            raise RuntimeError("%d docs failed to index into %s" % (num_failed, index_name))
+    except BaseException:
+        doc_index.delete()  # leave the alias on the current version
+        raise
+
+    swap_alias(es, alias, index_name)
+    print("%s now points to %s" % (alias, index_name))
+    for name in delete_old_versions(es, alias, keep):
+        print("Deleted old version %s" % name)
+
+
+def updateIndex(filename=corpus_file, workers=None, threads=4, chunk_size=500):
+    """
+    updateIndex brings the live covid doc index up to date with the corpus in place.
+    New and changed docs are upserted and docs which are no longer in the corpus are deleted.
+    A full index is built if there is none yet.
+    """
+    if not es.indices.exists_alias(name=alias):
+        buildIndex(filename, workers=workers, threads=threads, chunk_size=chunk_size)
+        return
+    index_name, = es.indices.get_alias(name=alias)
+
+    # id -> fingerprint of every indexed doc
+    hits = helpers.scan(es, index=index_name, query={'_source': ['fingerprint']}, size=5000)
+    existing = {hit['_id']: hit['_source'].get('fingerprint') for hit in hits}
+    num_indexed = len(existing)
+
+    num_upserted, _ = bulkLoad(docActions(index_name, filename, existing, workers), threads, chunk_size)
+    # existing now only holds the docs which have vanished from the corpus
+    num_deleted, _ = bulkLoad(({"_op_type": 'delete', "_index": index_name, "_id": doc_id} for doc_id in existing),
+                              threads, chunk_size)
+    es.indices.refresh(index=index_name)
+    if num_upserted or num_deleted:
+        mark_updated(es, index_name)  # lets result caches keyed on the index version notice the change
+    print("%d new or changed docs upserted, %d of %d indexed docs deleted" % (num_upserted, num_deleted, num_indexed))
 
 
 # command line invocation builds index and prints the running time.
 def main():
+    parser = argparse.ArgumentParser(description='Build the covid doc elasticsearch index.')
+    parser.add_argument('--file', type=str, default=corpus_file,
+                        help='Metadata corpus to index: a json file with one doc per line, or CORD-19\'s metadata.csv.')
+    parser.add_argument('--delta', action='store_true',
+                        help='Update the live index in place instead of building a new version.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes which parse and normalize docs (defaults to the number of CPUs, '
+                             '0 normalizes them in the loading thread).')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Number of threads sending bulk requests.')
+    parser.add_argument('--chunk_size', type=int, default=500,
+                        help='Number of docs sent per bulk request.')
+    args = parser.parse_args()
+
     start_time = time.time()
-    buildIndex()
-    print("=== Built index in %s seconds ===" % (time.time() - start_time))
+    if args.delta:
+        updateIndex(args.file, args.workers, args.threads, args.chunk_size)
+    else:
+        buildIndex(args.file, workers=args.workers, threads=args.threads, chunk_size=args.chunk_size)
+    print("=== %s index in %s seconds ===" % ("Updated" if args.delta else "Built", time.time() - start_time))
 
 
 if __name__ == '__main__':
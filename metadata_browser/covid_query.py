@@ -5,22 +5,20 @@ You will need to rewrite and expand sections to support the types of queries ove
 
 import re
 from flask import *
-from covid_index import CovidDoc, ks_analyzer
+from covid_index import ks_analyzer, service
 from pprint import pprint
 from elasticsearch_dsl import Q
 from elasticsearch_dsl.utils import AttrList
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import TransportError
 from elasticsearch_dsl import Search
 
+# covid_index puts the top of the repository on the path, where pagination.py is shared with web_app.py.
+# Searches go through covid_index's SearchService, which also backs the elasticsearch_dsl default connection.
+from pagination import close_pit, decode_cursor, encode_cursor, open_pit, page_hits, page_search, pit_expired
+
 app = Flask(__name__)
 
-# Initialize global variables for rendering page
-tmp_text = ""
-tmp_title = ""
-tmp_auth = ""
-tmp_min = ""
-tmp_max = ""
-gresults = {}
 exact_match = re.compile(r'("(.*)")') #looks for quoted text in queries
 
 # display query page
@@ -29,67 +27,35 @@ def search():
     return render_template('page_query.html')
 
 
-# display results page for first set of results and "next" sets.
-@app.route("/results", defaults={'page': 1}, methods=['GET', 'POST'])
-@app.route("/results/<page>", methods=['GET', 'POST'])
-def results(page):
-    global tmp_text
-    global tmp_title
-    global tmp_auth
-    global tmp_min
-    global tmp_max
-    global tmp_type
-    global gresults
-
-    # convert the <page> parameter in url to integer.
-    if type(page) is not int:
-        page = int(page.encode('utf-8'))
-        # if the method of request is post (for initial query), store query in local global variables
-    # if the method of request is get (for "next" results), extract query contents from client's global variables
-    if request.method == 'POST':
-        text_query = request.form['query']
-        auth_query = request.form['author']
-        mintime_query = request.form['mintime']
-        search_type = request.form['type']
-        if len(mintime_query) is 0:
-            mintime = 0
-        else:
-            mintime = int(mintime_query)
-        maxtime_query = request.form['maxtime']
-        if len(maxtime_query) is 0:
-            maxtime = 99999
-        else:
-            maxtime = int(maxtime_query)
-
-        # update global variable template data
-        tmp_text = text_query
-        tmp_auth = auth_query
-        tmp_min = mintime
-        tmp_max = maxtime
-        tmp_type = search_type
-    else:
-        # use the current values stored in global variables.
-        text_query = tmp_text
-        auth_query = tmp_auth
-        search_type = tmp_type
-        mintime = tmp_min
-        if tmp_min > 0:
-            mintime_query = tmp_min
-        else:
-            mintime_query = ""
-        maxtime = tmp_max
-        if tmp_max < 99999:
-            maxtime_query = tmp_max
-        else:
-            maxtime_query = ""
-
-    # store query values to display in search boxes in UI
-    shows = {}
-    shows['text'] = text_query
-    shows['author'] = auth_query
-    shows['maxtime'] = maxtime_query
-    shows['mintime'] = mintime_query
-    shows['type'] = search_type
+def query_params():
+    """
+    Read the query from the request's url parameters (or form, for posted searches).
+    The query travels with every link instead of being kept in the process,
+    so any worker can serve any request.
+    """
+    values = request.values
+    return {
+        'query': values.get('query', ''),
+        'author': values.get('author', ''),
+        'mintime': values.get('mintime', ''),
+        'maxtime': values.get('maxtime', ''),
+        'type': values.get('type', 'conjunctive'),
+    }
+
+
+def build_search(params):
+    """
+    Build the highlighted search for the query in params.
+    """
+    text_query = params['query']
+    auth_query = params['author']
+    search_type = params['type']
+    # publication years bounding the search, if given
+    years = {}
+    if len(params['mintime']) > 0:
+        years['gte'] = int(params['mintime'])
+    if len(params['maxtime']) > 0:
+        years['lte'] = int(params['maxtime'])
 
     # Create a search object to query our index
     search = Search(index='covid_doc_index')
@@ -99,8 +65,11 @@ def results(page):
     # Each call to search.query method adds criteria to our growing elasticsearch query.
     # You will change this section based on how you want to process the query data input into your interface.
 
-    # search for publication time using a range query
-    s = search.query('range', publish_time={'gte': mintime, 'lte': maxtime})
+    # restrict publication years with a range filter on the integer year field.
+    # Filters don't affect scores and are cached, so year-bounded searches don't re-evaluate the range.
+    s = search
+    if years:
+        s = s.filter('range', publish_time=years)
 
     # Conjunctive search over multiple fields (title and text) using the text_query passed in
     if len(text_query) > 0:
@@ -125,44 +94,118 @@ def results(page):
     s = s.highlight('text', fragment_size=999999999, number_of_fragments=1)
     s = s.highlight('title', fragment_size=999999999, number_of_fragments=1)
 
-    # determine the subset of results to display (based on current <page> value)
-    start = 0 + (page - 1) * 10
-    end = 10 + (page - 1) * 10
+    return s
+
+
+def search_page(s, after=None, before=None, pit=None):
+    """
+    Execute one page of the search after (or before) a cursor with pagination.py, sorted by score with ties broken
+    by doc_id, together with a size 0 search for the total and year histogram.
+    Both go in one msearch round trip; the size 0 search can be answered from the shard request cache
+    for every page of the same query.
+    Returns the page's response, the total and year histogram response, the hits in page order and the point in time.
+    """
+    counts = s.extra(size=0, track_total_hits=True).params(request_cache=True)
+    # count matches per publication year from the year field's doc values
+    counts.aggs.bucket('years', 'histogram', field='publish_time', interval=1, min_doc_count=1)
+
+    page = s.extra(track_total_hits=False)
+    try:
+        response, count_response = service.msearch([page_search(page, 'doc_id', 10, after, before, pit), counts])
+    except TransportError as e:
+        if not pit or not pit_expired(e):
+            raise
+        # the point in time expired; the cursor doesn't depend on it, so use the live index
+        response, count_response = service.msearch([page_search(page, 'doc_id', 10, after, before), counts])
+    hits, pit = page_hits(response, before)
+    if pit and len(hits) < 10:
+        # the end of the results, so the point in time is no longer needed
+        close_pit(service.client, pit)
+        pit = None
+    return response, count_response, hits, pit
+
+
+def hit_result(hit):
+    """
+    Extract the highlighted title and text of a hit.
+    """
+    result = {}
+    result['score'] = hit.meta.score
+
+    if 'highlight' in hit.meta:
+        if 'title' in hit.meta.highlight:
+            result['title'] = hit.meta.highlight.title[0]
+        else:
+            result['title'] = hit.title
 
-    # execute search and return results in specified range.
-    response = s[start:end].execute()
+        if 'text' in hit.meta.highlight:
+            result['text'] = hit.meta.highlight.text[0]
+        else:
+            result['text'] = hit.text
 
-    # insert data into response
-    resultList = {}
-    for hit in response.hits:
-        result = {}
-        result['score'] = hit.meta.score
+    else:
+        result['title'] = hit.title
+        result['text'] = hit.text
+    return result
 
-        if 'highlight' in hit.meta:
-            if 'title' in hit.meta.highlight:
-                result['title'] = hit.meta.highlight.title[0]
-            else:
-                result['title'] = hit.title
 
-            if 'text' in hit.meta.highlight:
-                result['text'] = hit.meta.highlight.text[0]
-            else:
-                result['text'] = hit.text
+# display results page for first set of results and "next" sets.
+@app.route("/results", defaults={'page': 1}, methods=['GET', 'POST'])
+@app.route("/results/<page>", methods=['GET', 'POST'])
+def results(page):
+    # convert the <page> parameter in url to integer.
+    if type(page) is not int:
+        page = int(page.encode('utf-8'))
 
-        else:
-            result['title'] = hit.title
-            result['text'] = hit.text
-        resultList[hit.meta.id] = result
+    # the query comes from the url on every request, including "next" results
+    params = query_params()
+    text_query = params['query']
+    auth_query = params['author']
 
-    # make the result list available globally
-    gresults = resultList
+    # store query values to display in search boxes in UI
+    shows = {}
+    shows['text'] = text_query
+    shows['author'] = auth_query
+    shows['maxtime'] = params['maxtime']
+    shows['mintime'] = params['mintime']
+    shows['type'] = params['type']
+
+    s = build_search(params)
+
+    # pages after the first are found from a cursor on the neighbouring page rather than an offset
+    after = decode_cursor(request.values.get('after', ''))
+    before = decode_cursor(request.values.get('before', ''))
+    pit = request.values.get('pit') or None
+    if (after is not None or before is not None) and pit is None:
+        try:
+            pit = open_pit(service.client, 'covid_doc_index')
+        except TransportError:
+            pass  # page from the live index this time
+
+    # execute search and return the page of results.
+    response, count_response, hits, pit = search_page(s, after, before, pit)
+    year_counts = [(int(bucket.key), bucket.doc_count) for bucket in count_response.aggregations.years.buckets]
+
+    # insert data into response
+    resultList = {}
+    for hit in hits:
+        resultList[hit.meta.id] = hit_result(hit)
+
+    # cursors for the previous and next pages
+    cursors = {}
+    if hits:
+        cursors['before'] = encode_cursor(list(hits[0].meta.sort))
+        cursors['after'] = encode_cursor(list(hits[-1].meta.sort))
+    if pit:
+        cursors['pit'] = pit
 
     # get the total number of matching results
-    result_num = response.hits.total['value']
+    result_num = count_response.hits.total['value']
 
     # if we find the results, extract title and text information from doc_data, else do nothing
     if result_num > 0:
-        return render_template('page_SERP.html', results=resultList, res_num=result_num, page_num=page, queries=shows)
+        return render_template('page_SERP.html', results=resultList, res_num=result_num, page_num=page, queries=shows,
+                               params=params, cursors=cursors, year_counts=year_counts)
     else:
         message = []
         if len(text_query) > 0:
@@ -170,14 +213,25 @@ def results(page):
         if len(auth_query) > 0:
             message.append('Cannot find author: ' + auth_query)
 
-        return render_template('page_SERP.html', results=message, res_num=result_num, page_num=page, queries=shows)
+        return render_template('page_SERP.html', results=message, res_num=result_num, page_num=page, queries=shows,
+                               params=params, cursors=cursors, year_counts=year_counts)
 
 
 # display a particular document given a result number
 @app.route("/documents/<res>", methods=['GET'])
 def documents(res):
-    global gresults
-    covid_doc = gresults[res]
+    # re-run the query from the link's parameters on just this document to get its highlights,
+    # along with the rest of its fields
+    response = build_search(query_params()).filter('ids', values=[res]).execute()
+    if response.hits:
+        covid_doc = hit_result(response.hits[0])
+        covid_dic = response.hits[0].to_dict()
+    else:
+        # the link didn't carry a query matching the document, so fetch it by id
+        covid_dic, = service.mget('covid_doc_index', [res])
+        if covid_dic is None:
+            abort(404)
+        covid_doc = {'title': covid_dic.get('title'), 'text': covid_dic.get('text')}
     doctitle = covid_doc['title']
     for term in covid_doc:
         if type(covid_doc[term]) is AttrList:
@@ -185,10 +239,7 @@ def documents(res):
             for item in covid_doc[term]:
                 s += item + ",\n "
             covid_doc[term] = s
-    # fetch the result from the elasticsearch index using its id
-    result = CovidDoc.get(id=res, index='covid_doc_index')
-    covid_dic = result.to_dict()
-    covid_doc['publish_time'] = str(covid_dic['publish_time'])
+    covid_doc['publish_time'] = str(covid_dic.get('publish_time'))
     return render_template('page_targetArticle.html', film=covid_doc, title=doctitle)
 
 
@@ -0,0 +1,283 @@
+'''
+This module caches the output of SciSpacy's en_ner_jnlpba_md model on disk so that
+document_filter.py, cord_ner_filter.py and relation_extraction.py only tag text they haven't seen before.
+
+Results are stored in a SQLite database keyed by the SHA-1 hash of the tagged text together with the
+model's name and version and the spaCy version. Texts are always tagged with the full pipeline, so one entry
+serves all three scripts even though each of them switches off different components when running uncached.
+Each row holds the entities of the text as json and its DocBin-serialized parse:
+> cache.get(text)
+Doc
+> json.loads(row['entities'])
+[[start_char, end_char, label], ...]
+
+The database is bounded by size. Once it grows past max_bytes the least recently used rows are evicted.
+
+Usage:
+
+from ner_cache import NerCache
+cache = NerCache('data/ner_cache.sqlite', nlp)
+doc = cache.parse('ACE2 binds the spike protein.')
+...
+cache.close()
+
+'''
+
+import hashlib
+import json
+import pathlib
+import sqlite3
+import time
+from collections import deque
+
+import spacy
+from spacy.tokens import DocBin
+
+from docbin import doc_attrs
+
+__all__ = ['NerCache']
+
+
+class NerCache:
+    """
+    A persistent cache of tagged Spacy documents keyed by text content and model.
+    """
+
+    def __init__(self, db_filename, nlp, max_bytes=2 * 1024 ** 3, commit_every=1000):
+        """
+        Open (or create) a cache database.
+        :param db_filename: SQLite filepath of the cache.
+        :param nlp: loaded Spacy model used to tag texts which aren't cached yet, with its full pipeline.
+        :param max_bytes: size in bytes the cached parses may take up before rows are evicted.
+        :param commit_every: number of writes between commits.
+        """
+        pathlib.Path(db_filename).parent.mkdir(parents=True, exist_ok=True)
+
+        self.nlp = nlp
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+
+        self.model = f'{nlp.meta.get("name", "")}-{nlp.meta.get("version", "")}/spacy-{spacy.__version__}'
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+
+        self.db = sqlite3.connect(db_filename)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS ner ('
+                        ' hash TEXT NOT NULL,'
+                        ' model TEXT NOT NULL,'
+                        ' entities TEXT NOT NULL,'
+                        ' doc BLOB NOT NULL,'
+                        ' size INTEGER NOT NULL,'
+                        ' last_used REAL NOT NULL,'
+                        ' PRIMARY KEY (hash, model))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS ner_last_used ON ner (last_used)')
+
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM ner').fetchone()[0]
+
+    @staticmethod
+    def text_hash(text):
+        """
+        Hash a text for use as a cache key.
+        :param text: string which is tagged.
+        :return: hex digest of the text's SHA-1 hash.
+        """
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, text):
+        """
+        Look up the cached parse of a text.
+        :param text: string which is tagged.
+        :return: the cached Spacy document, or None if the text hasn't been tagged with this model.
+        """
+        key = self.text_hash(text)
+        row = self.db.execute('SELECT doc FROM ner WHERE hash = ? AND model = ?', (key, self.model)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.db.execute('UPDATE ner SET last_used = ? WHERE hash = ? AND model = ?', (time.time(), key, self.model))
+        self._written()
+
+        doc_bin = DocBin(attrs=doc_attrs).from_bytes(row[0])
+
+        return next(doc_bin.get_docs(self.nlp.vocab))
+
+    def put(self, text, doc):
+        """
+        Store the parse of a text.
+        :param text: string which was tagged.
+        :param doc: Spacy document of text.
+        :return: None
+        """
+        doc_bin = DocBin(attrs=doc_attrs)
+        doc_bin.add(doc)
+        doc_bytes = doc_bin.to_bytes()
+        entities = json.dumps([[ent.start_char, ent.end_char, ent.label_] for ent in doc.ents])
+        size = len(doc_bytes) + len(entities)
+
+        key = self.text_hash(text)
+        old = self.db.execute('SELECT size FROM ner WHERE hash = ? AND model = ?', (key, self.model)).fetchone()
+        if old is not None:
+            self.total_bytes -= old[0]
+
+        self.db.execute('INSERT OR REPLACE INTO ner VALUES (?, ?, ?, ?, ?, ?)',
+                        (key, self.model, entities, doc_bytes, size, time.time()))
+        self.total_bytes += size
+        self._written()
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self, target=0.9):
+        """
+        Delete the least recently used rows until the cache is back under a fraction of max_bytes.
+        :param target: fraction of max_bytes to shrink the cache to.
+        :return: None
+        """
+        rows = self.db.execute('SELECT hash, model, size FROM ner ORDER BY last_used')
+        stale = []
+        for key, model, size in rows:
+            if self.total_bytes <= self.max_bytes * target:
+                break
+            stale.append((key, model))
+            self.total_bytes -= size
+
+        self.db.executemany('DELETE FROM ner WHERE hash = ? AND model = ?', stale)
+        self.db.commit()
+        self.evictions += len(stale)
+
+    def parse(self, text):
+        """
+        Tag a text, reusing its cached parse if there is one.
+        :param text: string to tag.
+        :return: Spacy document of text.
+        """
+        doc = self.get(text)
+        if doc is None:
+            doc = self.nlp(text)
+            self.put(text, doc)
+
+        return doc
+
+    def pipe(self, texts, as_tuples=False, batch_size=64, n_process=1, max_pending=None):
+        """
+        Tag a stream of texts like nlp.pipe, only running the model over texts which aren't cached.
+        Misses are sent through a single nlp.pipe, which reads on from the input as it needs more texts,
+        so its worker processes are started once. Hits are held back until the misses before them are tagged,
+        and documents are yielded in input order.
+        If max_pending texts are waiting behind an untagged one, because misses have become rare, the model is
+        left to finish the misses it has, and a new nlp.pipe is started at the next miss.
+        :param texts: iterable of strings, or of (string, context) tuples if as_tuples is set.
+        :param as_tuples: whether texts holds (string, context) tuples.
+        :param batch_size: number of texts Spacy tags per batch.
+        :param n_process: number of processes Spacy uses for tagging.
+        :param max_pending: number of texts read ahead of the last yielded document. Defaults to
+                            batch_size * n_process * 16.
+        :return: generator of Spacy documents, or of (doc, context) tuples if as_tuples is set.
+        """
+        if max_pending is None:
+            max_pending = batch_size * n_process * 16
+
+        if not as_tuples:
+            texts = ((text, None) for text in texts)
+        texts = iter(texts)
+
+        # Texts read but not yielded yet, in input order, as [text, context, doc] lists whose doc is None until
+        # the text has been tagged. Misses are also queued in unsent until nlp.pipe takes them, and in untagged
+        # until it tags them.
+        pending = deque()
+        unsent = deque()
+        untagged = deque()
+
+        def read(item):
+            entry = [item[0], item[1], self.get(item[0])]
+            pending.append(entry)
+            if entry[2] is None:
+                unsent.append(entry[0])
+                untagged.append(entry)
+
+        def misses():
+            while True:
+                while unsent:
+                    yield unsent.popleft()
+                if len(pending) >= max_pending:
+                    return
+                item = next(texts, None)
+                if item is None:
+                    return
+                read(item)
+
+        tagged = None
+        while True:
+            while pending and pending[0][2] is not None:
+                text, context, doc = pending.popleft()
+                yield (doc, context) if as_tuples else doc
+
+            if untagged:
+                if tagged is None:
+                    tagged = self.nlp.pipe(misses(), batch_size=batch_size, n_process=n_process)
+                doc = next(tagged, None)
+                if doc is None:
+                    # misses() stopped at max_pending and the model has tagged everything it was sent.
+                    tagged = None
+                    continue
+                entry = untagged.popleft()
+                entry[2] = doc
+                self.put(entry[0], doc)
+                continue
+
+            item = next(texts, None)
+            if item is None:
+                break
+            read(item)
+
+        if tagged is not None:
+            # Let nlp.pipe see the end of its input, so that its worker processes exit.
+            for _ in tagged:
+                pass
+
+    def _written(self):
+        self._writes += 1
+        if self._writes % self.commit_every == 0:
+            self.db.commit()
+
+    def stats(self):
+        """
+        Get the cache's hit/miss statistics for this session.
+        :return: dictionary of hits, misses, hit_rate, evictions, rows and megabytes.
+        """
+        lookups = self.hits + self.misses
+        rows = self.db.execute('SELECT COUNT(*) FROM ner').fetchone()[0]
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'rows': rows,
+            'megabytes': self.total_bytes / 1024 ** 2,
+        }
+
+    def report(self):
+        """
+        Print the cache's hit/miss statistics.
+        :return: None
+        """
+        stats = self.stats()
+        print(f'NER cache: {stats["hits"]} hits, {stats["misses"]} misses '
+              f'({stats["hit_rate"]:.1%} hit rate), {stats["evictions"]} evictions, '
+              f'{stats["rows"]} rows ({stats["megabytes"]:.1f} MB)')
+
+    def close(self):
+        """
+        Commit pending writes and close the database.
+        :return: None
+        """
+        self.db.commit()
+        self.db.close()
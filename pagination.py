@@ -0,0 +1,120 @@
+"""
+This module pages through elasticsearch results with search_after cursors for web_app.py.
+
+Results are sorted by score, with ties broken by a keyword id field, so a page is found from the sort values of the
+last hit on the previous page rather than by skipping over every earlier hit. Deep pages cost the same as the first
+and aren't limited by max_result_window. The previous page is found the same way, by searching backwards from the
+first hit on the current page.
+
+Since the cursor only holds sort values, it stays valid across requests and workers. When the cluster supports
+point-in-time searches (elasticsearch 7.10 and later), pages after the first are read from a point in time so that
+paging stays consistent while the index is refreshed. Otherwise, or if the point in time has expired, the caller can
+read the same page from the live index. The caller closes a point in time once paging reaches the end of the results,
+and otherwise it expires keep_alive after its last search.
+"""
+
+import base64
+import json
+
+from elasticsearch.exceptions import NotFoundError, TransportError
+
+
+def encode_cursor(sort_values):
+    """
+    :param sort_values: sort values of a hit.
+    :return: url-safe cursor string.
+    """
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    :param cursor: cursor string from encode_cursor, or an empty string.
+    :return: list of sort values, or None.
+    """
+    if not cursor:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+        return None
+
+
+def open_pit(client, index, keep_alive='5m'):
+    """
+    Open a point in time over an index.
+    :param client: Elasticsearch client.
+    :param index: index or alias to open the point in time over.
+    :param keep_alive: how long the point in time is kept without being used.
+    :return: point in time id, or None if the cluster doesn't support points in time.
+    :raise TransportError: if the point in time couldn't be opened for another reason, such as a timeout.
+    """
+    try:
+        response = client.transport.perform_request('POST', f'/{index}/_pit', params={'keep_alive': keep_alive})
+    except TransportError as e:
+        # Clusters from before 7.10 reject the request as a bad request or a disallowed method.
+        if e.status_code in (400, 405):
+            return None
+        raise
+    return response['id']
+
+
+def close_pit(client, pit):
+    """
+    Close a point in time, freeing the resources it holds before it expires.
+    :param client: Elasticsearch client.
+    :param pit: point in time id.
+    :return: None
+    """
+    try:
+        client.transport.perform_request('DELETE', '/_pit', body={'id': pit})
+    except TransportError:
+        # It has already expired, or will expire on its own.
+        pass
+
+
+def pit_expired(error):
+    """
+    :param error: TransportError raised by a search of a point in time.
+    :return: whether the point in time was not found, because it expired or was closed.
+    """
+    return isinstance(error, NotFoundError) or error.error == 'search_context_missing_exception'
+
+
+def page_search(s, id_field, size=10, after=None, before=None, pit=None, keep_alive='5m'):
+    """
+    Build the search for one page of results after or before a cursor.
+    :param s: elasticsearch_dsl Search with the query.
+    :param id_field: keyword field holding the document id, used to break ties in score.
+    :param size: number of hits per page.
+    :param after: sort values of the last hit on the previous page, to page forwards.
+    :param before: sort values of the first hit on the next page, to page backwards.
+    :param pit: optional point in time id to search.
+    :param keep_alive: how long the point in time is kept alive after this search.
+    :return: elasticsearch_dsl Search for the page.
+    """
+    backwards = before is not None
+    tiebreak = {id_field: {'order': 'desc' if backwards else 'asc', 'unmapped_type': 'keyword'}}
+    page = s.sort({'_score': {'order': 'asc' if backwards else 'desc'}}, tiebreak).extra(size=size, track_scores=True)
+
+    cursor = before if backwards else after
+    if cursor is not None:
+        page = page.extra(search_after=cursor)
+
+    if pit:
+        # A point in time search names its index through the point in time.
+        page = page.index().extra(pit={'id': pit, 'keep_alive': keep_alive})
+
+    return page
+
+
+def page_hits(response, before=None):
+    """
+    :param response: response to a search built by page_search.
+    :param before: the before cursor the search was built with, if any.
+    :return: (hits in page order, point in time id to use for the next page or None)
+    """
+    hits = list(response.hits)
+    if before is not None:
+        hits.reverse()
+    return hits, response.to_dict().get('pit_id')
@@ -1,38 +1,73 @@
 '''
 Author: Kristen Sheets
 
-This module creates a  relationship .csv file using SciSpacy\'s dependency parser.
-The csv output file to which CORD-NER protein entity-containing relations will be written
-has the following header: doc_id,sent,doi,triple,analysis
+This module creates a relationship file using SciSpacy\'s dependency parser.
+The output file to which CORD-NER protein entity-containing relations will be written is a Parquet (.parquet)
+or Arrow IPC (.arrow) file with the columns doc_id,sent,doi,predicate,arguments,analysis described in
+relations_store.py, or a .csv file with the header: doc_id,sent,doi,triple,analysis
 
 '''
 import argparse
-import csv
+from functools import partial
 
 from tqdm import tqdm
 import jsonlines
 import spacy
 
+from ner_cache import NerCache
+from relations_store import RelationWriter
+from scheduler import Latency, pipe_by_length
+
 # Command line arguments.
-parser = argparse.ArgumentParser(description='Create relationship .csv file using'
+parser = argparse.ArgumentParser(description='Create relationship file using'
                                              ' SciSpacy\'s dependency parses.')
 
 parser.add_argument('--in_file', type=str,
                     default='data/CORD-NER-PROTEIN-corpus.jsonl',
                     help='Filepath to jsonl file which contain the sentences to create relations from.')
-parser.add_argument('--out_file', type=str, default='data/relations.csv',
-                    help='csv output file to which CORD-NER protein entity-containing relations '
-                         'will be written (header: doc_id,sent,doi,triple,analysis)')
+parser.add_argument('--out_file', type=str, default='data/relations.parquet',
+                    help='.parquet, .arrow or .csv output file to which CORD-NER protein entity-containing relations '
+                         'will be written')
+parser.add_argument('--chunk_rows', type=int, default=10000,
+                    help='Number of relations per chunk written to a .parquet or .arrow output file.')
+parser.add_argument('--batch_size', type=int, default=256,
+                    help='Number of sentences spaCy parses per batch.')
+parser.add_argument('--n_process', type=int, default=1,
+                    help='Number of processes spaCy uses for parsing.')
+parser.add_argument('--bucket_window', type=int, default=4096,
+                    help='Number of sentences sorted by length together so batches hold similarly sized sentences.')
+parser.add_argument('--max_sent_chars', type=int, default=0,
+                    help='Skip sentences longer than this many characters (0 parses every sentence).')
+parser.add_argument('--slow_threshold', type=float, default=None,
+                    help='Seconds above which a sentence is reported as slow. Slow sentences are still parsed.')
+parser.add_argument('--slow_log', type=str, default=None,
+                    help='Optional jsonl file to which slow sentences are appended.')
+parser.add_argument('--ner_cache', type=str, default='data/ner_cache.sqlite',
+                    help='SQLite file which caches parses across runs and scripts.')
+parser.add_argument('--ner_cache_mb', type=int, default=2048,
+                    help='Size in megabytes the parse cache may grow to before evicting old entries.')
+parser.add_argument('--no_ner_cache', action='store_true',
+                    help='Parse every sentence without consulting the cache.')
 args = parser.parse_args()
 fi = args.in_file
 fo = args.out_file
 
 nlp = spacy.load('en_ner_jnlpba_md')
+# Triples only need the tagger (lemmas, POS) and the parser (dependencies), so ner is switched off
+# when parsing without the cache. The cache tags with the full pipeline, so that its entries are shared.
+disabled_pipes = [name for name in nlp.pipe_names if name == 'ner']
+
+# Cache of previously parsed sentences.
+ner_cache = None
+if not args.no_ner_cache:
+    ner_cache = NerCache(args.ner_cache, nlp, max_bytes=args.ner_cache_mb * 1024 ** 2)
+
+# Per-sentence parsing latencies.
+latency = Latency(slow_threshold=args.slow_threshold, slow_log=args.slow_log)
 
 def open_ner_data(fi):
     with jsonlines.open(fi) as reader:
-        data = [line for line in tqdm(reader, desc="Opening file")]
-    return data
+        yield from tqdm(reader, desc="Parsing sentences")
 
 def create_string(tokenized_sent):
     return  ' '.join(tokenized_sent)
@@ -43,13 +78,24 @@ def create_text_doc(data):
     return text
 
 def extract_text(data):
-    return [(doc['doc_id'], doc['sent'], doc['doi']) for doc in data]
+    return ((doc['doc_id'], doc['sent'], doc['doi']) for doc in data)
+
+def parse_docs(text, batch_size=1, n_process=1, window=1, max_sent_chars=0):
+    texts = ((sent, (doc_id, sent, doi)) for (doc_id, sent, doi) in text
+             if not max_sent_chars or len(sent) <= max_sent_chars)
+    if ner_cache is not None:
+        pipe = partial(ner_cache.pipe, as_tuples=True, batch_size=batch_size, n_process=n_process)
+    else:
+        pipe = partial(nlp.pipe, as_tuples=True, batch_size=batch_size, n_process=n_process, disable=disabled_pipes)
+    # Sorting sentences by length keeps a few very long ones from slowing down whole batches.
+    return pipe_by_length(pipe, texts, window, latency, key=lambda context: [context[0], context[1][:80]],
+                          batch_size=batch_size)
 
-def parse(data):
-    triples = []
+def parse(data, batch_size=1, n_process=1, window=1, max_sent_chars=0):
     text = extract_text(data)
-    for (doc_id, sent, doi) in tqdm(text, desc="Parsing sentences"):
-        doc = nlp(sent)
+    docs = parse_docs(text, batch_size=batch_size, n_process=n_process, window=window, max_sent_chars=max_sent_chars)
+    for doc, (doc_id, sent, doi) in docs:
+        triples = []
         triple = {}
         for token in doc:
             if token.dep_ == "ROOT":
@@ -89,14 +135,27 @@ def parse(data):
                         dep_relations.append(span_lst)
                     triple.update({'analysis': dep_relations})
                     triples.append(triple)
-    return triples
+        # Yield once the whole sentence is processed, since every ROOT updates the same triple.
+        yield from triples
+
+def write_relations(triples, fo, chunk_rows=10000):
+    num_relations = 0
+    with RelationWriter(fo, chunk_rows=chunk_rows) as writer:
+        for relation in triples:
+            writer.write(relation)
+            num_relations += 1
+    return num_relations
 
 if __name__ == '__main__':
     data = open_ner_data(fi)
-    triples = parse(data)
-    with open(fo, 'w', encoding='utf-8') as output_file:
-        fieldnames = list(triples[0].keys())
-        writer = csv.DictWriter(output_file, fieldnames=fieldnames, quotechar='"', quoting=csv.QUOTE_ALL)
-        writer.writeheader()
-        for relation in tqdm(triples, desc="Writing file"):
-            writer.writerow(relation)
+    triples = parse(data, batch_size=args.batch_size, n_process=args.n_process,
+                    window=args.bucket_window, max_sent_chars=args.max_sent_chars)
+    num_relations = write_relations(triples, fo, chunk_rows=args.chunk_rows)
+    print(f'Wrote {num_relations} relations to {fo}')
+
+    latency.report()
+    latency.close()
+
+    if ner_cache is not None:
+        ner_cache.report()
+        ner_cache.close()
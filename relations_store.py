@@ -0,0 +1,232 @@
+'''
+This module stores the relations extracted by relation_extraction.py in a typed columnar file,
+either Parquet (.parquet) or Arrow IPC (.arrow), and reads them back for index.py.
+Both formats have the following schema:
+doc_id: string
+sent: string
+doi: string
+predicate: string
+arguments: list<string>
+analysis: list<list<struct<text: string, dep: string, head: string>>>
+
+analysis holds one list per element of the triple. The predicate's list has a single (text, dep, head) entry
+and each argument's list has an entry for every token of its span.
+
+Relations are written in chunks of rows, and .arrow files are read through a memory map.
+Files ending in .csv are read and written in the original relations.csv format.
+
+The stable ids of relations and the journal and year of their papers are also derived here, so that index.py and
+embedded_search.py index relations alike without importing each other.
+
+'''
+import ast
+import csv
+import hashlib
+import json
+import re
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+__all__ = ['RelationWriter', 'read_relations', 'relation_id', 'load_paper_metadata']
+
+token_type = pa.struct([('text', pa.string()), ('dep', pa.string()), ('head', pa.string())])
+
+schema = pa.schema([
+    ('doc_id', pa.string()),
+    ('sent', pa.string()),
+    ('doi', pa.string()),
+    ('predicate', pa.string()),
+    ('arguments', pa.list_(pa.string())),
+    ('analysis', pa.list_(pa.list_(token_type))),
+])
+
+
+def to_row(relation):
+    """
+    Convert a relation produced by relation_extraction.parse to a row of the columnar schema.
+    :param relation: dictionary with doc_id, sent, doi, triple and analysis keys.
+    :return: dictionary with the schema's columns as keys.
+    """
+    predicate_analysis, *argument_analyses = relation['analysis']
+    analysis = [[dict(zip(('text', 'dep', 'head'), predicate_analysis))]]
+    for span in argument_analyses:
+        analysis.append([dict(zip(('text', 'dep', 'head'), token)) for token in span])
+
+    return {
+        'doc_id': relation['doc_id'],
+        'sent': relation['sent'],
+        'doi': relation['doi'],
+        'predicate': relation['triple'][0],
+        'arguments': list(relation['triple'][1:]),
+        'analysis': analysis,
+    }
+
+
+class RelationWriter:
+    """
+    Writes relations to a .parquet, .arrow or .csv file in chunks of rows.
+    """
+
+    def __init__(self, filename, chunk_rows=10000):
+        """
+        :param filename: output filepath. Its extension picks the format.
+        :param chunk_rows: number of relations buffered before a chunk is written.
+        """
+        self.filename = filename
+        self.chunk_rows = chunk_rows
+        self.rows = []
+        self.num_rows = 0
+
+        if filename.endswith('.csv'):
+            self.format = 'csv'
+            self.fp = open(filename, 'w', encoding='utf-8')
+            self.writer = None
+        elif filename.endswith('.arrow'):
+            self.format = 'arrow'
+            self.sink = pa.OSFile(filename, 'wb')
+            self.writer = pa.ipc.new_file(self.sink, schema)
+        else:
+            self.format = 'parquet'
+            self.writer = pq.ParquetWriter(filename, schema)
+
+    def write(self, relation):
+        """
+        Add a relation to the file.
+        :param relation: dictionary produced by relation_extraction.parse.
+        :return: None
+        """
+        self.num_rows += 1
+        if self.format == 'csv':
+            if self.writer is None:
+                self.writer = csv.DictWriter(self.fp, fieldnames=list(relation.keys()),
+                                             quotechar='"', quoting=csv.QUOTE_ALL)
+                self.writer.writeheader()
+            self.writer.writerow(relation)
+            return
+
+        self.rows.append(to_row(relation))
+        if len(self.rows) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered relations as one chunk.
+        :return: None
+        """
+        if self.format == 'csv' or not self.rows:
+            return
+
+        table = pa.Table.from_pylist(self.rows, schema=schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        """
+        Write any buffered relations and close the file.
+        :return: None
+        """
+        if self.format == 'csv':
+            self.fp.close()
+            return
+
+        self.flush()
+        self.writer.close()
+        if self.format == 'arrow':
+            self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_csv_relations(filename):
+    """
+    Read relations from the original relations.csv format, where triple and analysis are stringified lists.
+    :param filename: csv filepath.
+    :return: generator of dictionaries with doc_id, sent, doi, predicate and arguments keys.
+    """
+    with open(filename, newline='', encoding='utf-8') as fp:
+        for row in csv.DictReader(fp):
+            predicate, *arguments = ast.literal_eval(row['triple'])
+            yield {
+                'doc_id': row['doc_id'],
+                'sent': row['sent'],
+                'doi': row['doi'],
+                'predicate': predicate,
+                'arguments': arguments,
+            }
+
+
+def read_batches(filename, columns=None, batch_rows=10000):
+    """
+    Read record batches from a .parquet or .arrow relations file.
+    :param filename: relations filepath.
+    :param columns: optional list of column names to read.
+    :param batch_rows: number of rows per batch when reading Parquet.
+    :return: generator of pyarrow RecordBatches.
+    """
+    if filename.endswith('.arrow'):
+        with pa.memory_map(filename, 'r') as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if columns:
+                    batch = pa.RecordBatch.from_arrays([batch.column(batch.schema.get_field_index(c)) for c in columns],
+                                                       names=columns)
+                yield batch
+    else:
+        parquet_file = pq.ParquetFile(filename, memory_map=True)
+        yield from parquet_file.iter_batches(batch_size=batch_rows, columns=columns)
+
+
+def read_relations(filename, columns=('doc_id', 'sent', 'doi', 'predicate', 'arguments')):
+    """
+    Read relations one at a time from a .parquet, .arrow or .csv relations file.
+    :param filename: relations filepath.
+    :param columns: columns to read. Ignored for csv files.
+    :return: generator of dictionaries with the requested columns as keys.
+    """
+    if filename.endswith('.csv'):
+        yield from read_csv_relations(filename)
+        return
+
+    for batch in read_batches(filename, list(columns)):
+        yield from batch.to_pylist()
+
+
+def load_paper_metadata(metadata_file):
+    """
+    Read the journal and publication year of each paper in a CORD-19 metadata file.
+    :param metadata_file: CORD-19 metadata.csv, or a json file with one paper per line, or None.
+    :return: dictionary mapping lowercased DOIs to dictionaries with journal and publish_year keys.
+    """
+    papers = {}
+    if metadata_file is None:
+        return papers
+
+    with open(metadata_file, encoding='utf-8', newline='') as f:
+        rows = csv.DictReader(f) if metadata_file.endswith('.csv') else (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            doi = row.get('doi')
+            if not isinstance(doi, str) or not doi:
+                continue
+            journal = row.get('journal')
+            match = re.search(r'\d{4}', str(row.get('publish_time') or ''))
+            papers[doi.lower()] = {
+                'journal': journal if isinstance(journal, str) and journal else None,
+                'publish_year': int(match.group(0)) if match else None,
+            }
+
+    return papers
+
+
+def relation_id(relation):
+    """
+    :param relation: relation dictionary read from the relations file.
+    :return: stable document id derived from the relation's doc_id, sentence and triple.
+    """
+    key = json.dumps([relation['doc_id'], relation['sent'], relation['predicate'], relation['arguments']])
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
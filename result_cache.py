@@ -0,0 +1,201 @@
+"""
+This module caches rendered search results for web_app.py.
+
+Results are kept in an in-process LRU cache whose entries expire after a TTL. An optional shared backend,
+such as a redis client or the DictBackend stand-in below, is consulted on local misses so that several web app
+processes can share results.
+
+Keys are the normalized query plus the name of the physical index the search alias points to, and the marker
+index.py --delta leaves in that index's mapping when it updates the index in place.
+When index.py swaps the alias to a new version or updates the current one, the local cache is cleared and new keys
+no longer match entries cached for the old version.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from index_versions import updated_marker
+
+
+def normalize_query(predicate, args, search_type, page_num, cursor=''):
+    """
+    Normalize a query so that equivalent queries share a cache key.
+    Whitespace is collapsed and empty arguments dropped. Case is kept, since query_string operators are case sensitive.
+    :param predicate: predicate query string.
+    :param args: list of argument query strings.
+    :param search_type: 'and' or 'or'.
+    :param page_num: page of results.
+    :param cursor: cursor the page was found from, if it isn't the first page.
+    :return: string key.
+    """
+    predicate = ' '.join(predicate.split())
+    args = [' '.join(arg.split()) for arg in args]
+    return json.dumps([predicate, [arg for arg in args if arg], search_type.lower(), int(page_num), cursor])
+
+
+class DictBackend:
+    """
+    An in-memory stand-in for a shared redis backend, with the subset of the redis client interface the cache uses.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.data.get(key, (None, 0))
+            if expires < time.time():
+                self.data.pop(key, None)
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.data[key] = (value, time.time() + ex if ex else float('inf'))
+
+
+class AliasVersion:
+    """
+    The physical index an alias points to and when it was last updated in place, looked up at most once every
+    interval seconds.
+    """
+
+    def __init__(self, client, alias, interval=5.0):
+        """
+        :param client: Elasticsearch client.
+        :param alias: alias to look up.
+        :param interval: seconds between lookups.
+        """
+        self.client = client
+        self.alias = alias
+        self.interval = interval
+        self.version = None
+        self.checked = 0.0
+
+    def get(self):
+        """
+        :return: name of the index the alias points to, followed by its update marker if it was updated in place,
+                 or the alias itself if it can't be looked up.
+        """
+        now = time.monotonic()
+        if now - self.checked >= self.interval:
+            try:
+                versions = []
+                for name, mapping in sorted(self.client.indices.get_mapping(index=self.alias).items()):
+                    marker = updated_marker(mapping)
+                    versions.append(f'{name}@{marker}' if marker else name)
+                self.version = ','.join(versions)
+            except Exception:
+                self.version = self.alias
+            self.checked = now
+        return self.version
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache with a TTL, backed by an optional shared backend.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, backend=None, version=None):
+        """
+        :param max_size: maximum number of entries kept in process.
+        :param ttl: seconds an entry stays valid.
+        :param backend: optional shared backend with redis's get(key) and set(key, value, ex=ttl) methods.
+                        Values are stored as json.
+        :param version: optional function returning the current index version. A new version clears the cache.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self.version = version
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.current_version = None
+
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _versioned(self, key):
+        version = self.version() if self.version else None
+        if version != self.current_version:
+            with self.lock:
+                if self.current_version is not None:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.current_version = version
+        return f'{version}:{key}'
+
+    def get(self, key):
+        """
+        :param key: normalized query.
+        :return: cached value, or None on a miss.
+        """
+        key = self._versioned(key)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+
+        if self.backend is not None:
+            stored = self.backend.get(key)
+            if stored is not None:
+                value = json.loads(stored)
+                self._store(key, value, now)
+                with self.lock:
+                    self.backend_hits += 1
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """
+        :param key: normalized query.
+        :param value: json-serializable value to cache.
+        :return: None
+        """
+        key = self._versioned(key)
+        self._store(key, value, time.monotonic())
+        if self.backend is not None:
+            self.backend.set(key, json.dumps(value), ex=self.ttl)
+
+    def _store(self, key, value, now):
+        with self.lock:
+            self.entries[key] = (value, now + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        :return: dictionary of the cache's hit/miss metrics.
+        """
+        with self.lock:
+            lookups = self.hits + self.backend_hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'version': self.current_version,
+                'hits': self.hits,
+                'backend_hits': self.backend_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.backend_hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
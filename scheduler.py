@@ -0,0 +1,208 @@
+'''
+This module schedules texts through spaCy's nlp.pipe for cord_ner_filter.py and relation_extraction.py.
+
+- split_sents packs the sentences of a CORD-NER document into pieces no longer than spaCy's max_length,
+  so that long papers are tagged piece by piece instead of being dropped.
+- pipe_by_length buffers a window of texts, runs them through a pipe sorted by length so that each batch
+  holds texts of similar size, and yields the results back in input order.
+- Latency records how long each text took in the pipe, along with its length, and reports the tail of that
+  distribution and the slowest texts. Texts slower than a threshold are counted and optionally logged to a
+  jsonl file so they can be inspected. Nothing is skipped; the threshold only picks what gets reported.
+
+spaCy tags a whole batch before the first of its results comes out, so with batch_size > 1 a text's own time
+can't be observed. pipe_by_length then measures each batch and splits its time over the batch's texts in
+proportion to their length, and the report says so. Run with a batch size of 1 to time every text exactly.
+
+'''
+
+import json
+import time
+from array import array
+from collections import deque
+
+
+def split_sents(sents, max_length):
+    """
+    Pack sentences into texts no longer than max_length, only breaking between sentences.
+    A single sentence longer than max_length can't be tagged, so it is left out.
+    :param sents: list of CORD-NER sentence dictionaries with a 'sent_tokens' key.
+    :param max_length: maximum number of characters per text.
+    :return: (texts, num_dropped) where texts is a list of strings and num_dropped the number of sentences left out.
+    """
+    texts = []
+    piece = []
+    piece_length = 0
+    num_dropped = 0
+    for sent in sents:
+        sent_text = ' '.join(sent['sent_tokens'])
+        if len(sent_text) > max_length:
+            num_dropped += 1
+            continue
+
+        # Sentences are joined with a single space, as in get_text_from_sents.
+        extra = len(sent_text) + (1 if piece else 0)
+        if piece and piece_length + extra > max_length:
+            texts.append(' '.join(piece))
+            piece = []
+            piece_length = 0
+            extra = len(sent_text)
+
+        piece.append(sent_text)
+        piece_length += extra
+
+    if piece:
+        texts.append(' '.join(piece))
+
+    return texts, num_dropped
+
+
+class Latency:
+    """
+    Per-item latencies of a pipe, with an optional threshold above which items are reported as slow.
+    """
+
+    def __init__(self, slow_threshold=None, slow_log=None, keep=10):
+        """
+        :param slow_threshold: seconds above which an item counts as slow, or None.
+        :param slow_log: optional jsonl filepath to which slow items are appended.
+        :param keep: number of slowest items to remember for the report.
+        """
+        self.slow_threshold = slow_threshold
+        self.slow_log = open(slow_log, 'a', encoding='utf-8') if slow_log else None
+        self.keep = keep
+
+        self.seconds = array('d')
+        self.slowest = []
+        self.num_slow = 0
+        # Number of items per measured batch, set by pipe_by_length. Above 1, latencies are estimates.
+        self.batch_size = 1
+
+    def add(self, key, length, seconds):
+        """
+        Record the latency of an item.
+        :param key: json-serializable identifier of the item.
+        :param length: length of the item's text in characters.
+        :param seconds: time the item took.
+        :return: None
+        """
+        self.seconds.append(seconds)
+
+        self.slowest.append((seconds, length, key))
+        if len(self.slowest) > self.keep * 4:
+            self.slowest = sorted(self.slowest, key=lambda s: s[0], reverse=True)[:self.keep]
+
+        if self.slow_threshold is not None and seconds > self.slow_threshold:
+            self.num_slow += 1
+            if self.slow_log:
+                self.slow_log.write(json.dumps({'key': key, 'length': length, 'seconds': seconds,
+                                                'batch_size': self.batch_size}) + '\n')
+
+    def percentile(self, q):
+        """
+        :param q: percentile between 0 and 100.
+        :return: the latency at that percentile, in seconds.
+        """
+        if not self.seconds:
+            return 0.0
+        ordered = sorted(self.seconds)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+    def report(self):
+        """
+        Print the latency distribution and the slowest items.
+        :return: None
+        """
+        if self.batch_size > 1:
+            print(f'Latencies are estimated from the time of each batch of {self.batch_size} items, split in '
+                  'proportion to item length. Use a batch size of 1 to time items exactly.')
+        print(f'Latency over {len(self.seconds)} items: p50 {self.percentile(50) * 1000:.1f} ms, '
+              f'p90 {self.percentile(90) * 1000:.1f} ms, p99 {self.percentile(99) * 1000:.1f} ms, '
+              f'max {self.percentile(100) * 1000:.1f} ms')
+        if self.slow_threshold is not None:
+            print(f'{self.num_slow} items took longer than {self.slow_threshold} s')
+        for seconds, length, key in sorted(self.slowest, key=lambda s: s[0], reverse=True)[:self.keep]:
+            print(f'  {seconds * 1000:.1f} ms  {length} chars  {key}')
+
+    def close(self):
+        if self.slow_log:
+            self.slow_log.close()
+
+
+def pipe_by_length(pipe, items, window, latency=None, key=None, batch_size=1):
+    """
+    Run (text, context) items through a pipe in length-sorted windows, yielding results in input order.
+    The pipe is called once, so a pipe such as nlp.pipe, or NerCache.pipe while misses are frequent, only starts its
+    worker processes once.
+    Latencies are measured per batch of batch_size results, from the pipe yielding the result before the batch to
+    it yielding the batch's last result, and split over the batch's items in proportion to their length.
+    With a batch size of 1 that is exactly each item's processing time.
+    :param pipe: function taking an iterable of (text, context) tuples and returning (doc, context) tuples in order,
+                 such as functools.partial(nlp.pipe, as_tuples=True).
+    :param items: iterable of (text, context) tuples.
+    :param window: number of items sorted together. A window of 1 keeps the input order.
+    :param latency: optional Latency which records each item's latency.
+    :param key: function mapping a context to the identifier recorded with its latency.
+    :param batch_size: number of texts the pipe processes per batch.
+    :return: generator of (doc, context) tuples.
+    """
+    # Windows which have been fed to the pipe, with the order their items were fed in.
+    windows = deque()
+
+    def sorted_items():
+        buffer = []
+        for item in items:
+            buffer.append(item)
+            if len(buffer) == window:
+                yield from _sort_window(buffer, windows)
+                buffer = []
+
+        if buffer:
+            yield from _sort_window(buffer, windows)
+
+    if latency is not None:
+        latency.batch_size = batch_size
+    # (key, length) of the items of the batch being timed, and the time it has taken so far.
+    batch = []
+    batch_seconds = 0.0
+
+    results = iter(pipe(sorted_items()))
+    start_time = time.perf_counter()
+    for first in results:
+        # The pipe keeps its input order, so the first result always belongs to the oldest window.
+        buffer, order = windows.popleft()
+        ordered = [None] * len(buffer)
+        for n, i in enumerate(order):
+            result = first if n == 0 else next(results)
+
+            now = time.perf_counter()
+            if latency is not None:
+                text, context = buffer[i]
+                batch.append((key(context) if key else None, len(text)))
+                batch_seconds += now - start_time
+                if len(batch) == batch_size:
+                    _add_batch(latency, batch, batch_seconds)
+                    batch, batch_seconds = [], 0.0
+            start_time = now
+
+            ordered[i] = result
+
+        yield from ordered
+        # Don't count the time the caller spent on this window.
+        start_time = time.perf_counter()
+
+    if batch:
+        _add_batch(latency, batch, batch_seconds)
+
+
+def _add_batch(latency, batch, seconds):
+    total_length = sum(max(length, 1) for _, length in batch)
+    for item_key, length in batch:
+        latency.add(item_key, length, seconds * max(length, 1) / total_length)
+
+
+def _sort_window(buffer, windows):
+    order = sorted(range(len(buffer)), key=lambda i: len(buffer[i][0]))
+    windows.append((buffer, order))
+
+    for i in order:
+        yield buffer[i]
@@ -0,0 +1,84 @@
+"""
+This module is the search service layer between web_app.py and elasticsearch.
+
+It owns one pooled, tuned client, which is also registered as the default elasticsearch_dsl connection,
+so that every request thread shares the same keep-alive connections instead of opening new ones.
+Searches which make up one page are sent together in a single msearch request and documents are fetched with mget.
+
+The pinned elasticsearch client (7.6) has no asyncio transport, so the async methods run the same calls on a thread
+pool sized to the connection pool. They can be awaited from asyncio code such as benchmark_search.py.
+
+The host is read from the ES_HOST environment variable, so the apps and benchmark can be pointed at a local
+Elasticsearch or OpenSearch stand-in.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import Elasticsearch
+from elasticsearch_dsl import MultiSearch
+from elasticsearch_dsl.connections import connections
+
+
+class SearchService:
+    """
+    Pooled elasticsearch client with msearch and mget helpers and their async counterparts.
+    """
+
+    def __init__(self, hosts=None, pool_size=25, timeout=10, max_retries=2, register=True):
+        """
+        :param hosts: list of elasticsearch hosts. Defaults to ES_HOST, or 127.0.0.1.
+        :param pool_size: number of connections kept open to each host, and threads used by the async methods.
+        :param timeout: seconds before a request times out.
+        :param max_retries: retries of a request which timed out or failed to connect.
+        :param register: register the client as the default elasticsearch_dsl connection.
+        """
+        hosts = hosts or [os.environ.get('ES_HOST', '127.0.0.1')]
+        self.client = Elasticsearch(hosts, maxsize=pool_size, timeout=timeout, max_retries=max_retries,
+                                    retry_on_timeout=True, http_compress=True)
+        if register:
+            connections.add_connection('default', self.client)
+
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def msearch(self, searches):
+        """
+        Execute several searches in one round trip.
+        :param searches: list of elasticsearch_dsl Searches. Each names its own index, or a point in time.
+        :return: list of responses, in the order of the searches.
+        """
+        multi_search = MultiSearch(using=self.client)
+        for s in searches:
+            multi_search = multi_search.add(s)
+        return list(multi_search.execute())
+
+    def mget(self, index, ids, source=None):
+        """
+        Fetch documents by id in one round trip.
+        :param index: index or alias holding the documents.
+        :param ids: list of document ids.
+        :param source: optional list of fields to return.
+        :return: list of source dictionaries, with None for ids which weren't found, in the order of the ids.
+        """
+        if not ids:
+            return []
+        params = {'_source_includes': ','.join(source)} if source else {}
+        response = self.client.mget(body={'ids': list(ids)}, index=index, params=params)
+        return [doc.get('_source') if doc.get('found') else None for doc in response['docs']]
+
+    async def amsearch(self, searches):
+        """
+        Awaitable msearch.
+        """
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.msearch, searches)
+
+    async def amget(self, index, ids, source=None):
+        """
+        Awaitable mget.
+        """
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.mget, index, ids, source)
+
+    def close(self):
+        self.executor.shutdown()
+        self.client.transport.close()
@@ -0,0 +1,90 @@
+import os
+import sys
+
+import pytest
+
+# The modules under test are scripts at the top of the repository rather than an installed package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeIndices:
+    """
+    Stands in for an Elasticsearch client's indices namespace, holding index names with their aliases and mappings.
+    """
+
+    def __init__(self, indices):
+        self.indices = {name: set(aliases) for name, aliases in indices.items()}
+        self.mappings = {name: {'mappings': {'properties': {}}} for name in self.indices}
+
+    def resolve(self, index):
+        return [name for name, aliases in self.indices.items() if index == name or index in aliases]
+
+    def exists(self, index):
+        return index in self.indices
+
+    def exists_alias(self, name):
+        return any(name in aliases for aliases in self.indices.values())
+
+    def get_alias(self, name):
+        return {index: {'aliases': {name: {}}} for index, aliases in self.indices.items() if name in aliases}
+
+    def get(self, index):
+        prefix = index.rstrip('*')
+        return {name: {} for name in self.indices if name.startswith(prefix)}
+
+    def delete(self, index):
+        del self.indices[index]
+        del self.mappings[index]
+
+    def update_aliases(self, body):
+        for action in body['actions']:
+            (op_type, params), = action.items()
+            if op_type == 'add':
+                self.indices[params['index']].add(params['alias'])
+            elif op_type == 'remove':
+                self.indices[params['index']].discard(params['alias'])
+            else:
+                self.delete(params['index'])
+
+    def get_mapping(self, index):
+        return {name: self.mappings[name] for name in self.resolve(index)}
+
+    def put_mapping(self, index, body):
+        for name in self.resolve(index):
+            self.mappings[name]['mappings'].update(body)
+
+
+class FakeTransport:
+    """
+    Answers requests with a fixed response, or raises a fixed error, recording the requests.
+    """
+
+    def __init__(self, response=None, error=None):
+        self.response = response
+        self.error = error
+        self.requests = []
+
+    def perform_request(self, method, url, params=None, body=None):
+        self.requests.append((method, url, body))
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class FakeClient:
+    """
+    Stands in for an Elasticsearch client, with an indices namespace and a transport.
+    """
+
+    def __init__(self, indices=(), response=None, error=None):
+        self.indices = FakeIndices(dict(indices))
+        self.transport = FakeTransport(response, error)
+
+
+@pytest.fixture
+def fake_client():
+    """
+    :return: FakeClient, to be called with a dictionary mapping index names to their aliases,
+             and the response or error of the transport.
+    """
+    return FakeClient
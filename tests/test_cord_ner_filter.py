@@ -0,0 +1,102 @@
+import importlib
+import json
+import os
+import sys
+
+import pytest
+import spacy
+
+import checkpoint
+
+
+def protein_tagger(name):
+    """
+    Stands in for en_ner_jnlpba_md: a blank English pipeline whose 'parser' splits sentences
+    and whose 'ner' tags a few protein names.
+    """
+    nlp = spacy.blank('en')
+    patterns = [{'label': 'PROTEIN', 'pattern': protein} for protein in ('ACE2', 'TMPRSS2', 'spike')]
+    if spacy.__version__ < '3':
+        nlp.add_pipe(nlp.create_pipe('sentencizer'), name='parser')
+        ruler = nlp.create_pipe('entity_ruler')
+        ruler.add_patterns(patterns)
+        nlp.add_pipe(ruler, name='ner')
+    else:
+        nlp.add_pipe('sentencizer', name='parser')
+        nlp.add_pipe('entity_ruler', name='ner').add_patterns(patterns)
+    return nlp
+
+
+@pytest.fixture(scope='module')
+def cord_ner_filter():
+    # The module loads its model and parses its command line when it is imported.
+    load, argv = spacy.load, sys.argv
+    spacy.load = protein_tagger
+    sys.argv = ['cord_ner_filter.py', '--no_ner_cache', '--no_count', '--batch_size', '1', '--bucket_window', '1',
+                '--checkpoint_every', '2']
+    try:
+        yield importlib.import_module('cord_ner_filter')
+    finally:
+        spacy.load, sys.argv = load, argv
+
+
+def write_docs(doc_file, num_docs):
+    with open(doc_file, 'w', encoding='utf-8') as fp:
+        for n in range(num_docs):
+            sents = [{'sent_id': 0, 'sent_tokens': ['ACE2', 'binds', f'ligand{n}', '.']},
+                     {'sent_id': 1, 'sent_tokens': ['Nothing', 'here', '.']}]
+            fp.write(json.dumps({'doc_id': f'd{n}', 'sents': sents, 'doi': f'10.1/{n}'}) + '\n')
+
+
+def test_filter_to_shard_resumes(cord_ner_filter, tmp_path, monkeypatch):
+    doc_file = str(tmp_path / 'docs.jsonl')
+    write_docs(doc_file, 5)
+
+    monkeypatch.setattr(cord_ner_filter.args, 'shard_folder', str(tmp_path / 'expected'))
+    expected_shard = cord_ner_filter.filter_to_shard(doc_file, {}, str(tmp_path / 'expected.json'))
+    with open(expected_shard, encoding='utf-8') as fp:
+        expected = fp.read()
+    assert [json.loads(line)['doc_id'] for line in expected.splitlines()] == ['d0', 'd1', 'd2', 'd3', 'd4']
+
+    # Interrupt the run while the fourth document is read, after the second one was checkpointed
+    # and the third one written to the shard past the checkpoint.
+    monkeypatch.setattr(cord_ner_filter.args, 'shard_folder', str(tmp_path / 'shards'))
+    manifest_file = str(tmp_path / 'manifest.json')
+    read_jsonl = checkpoint.read_jsonl
+    read_offsets = []
+
+    def interrupted(doc_file, offset=0):
+        read_offsets.append(offset)
+        for n, record in enumerate(read_jsonl(doc_file, offset)):
+            if n == 3:
+                raise KeyboardInterrupt
+            yield record
+
+    monkeypatch.setattr(checkpoint, 'read_jsonl', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        cord_ner_filter.filter_to_shard(doc_file, {}, manifest_file)
+
+    manifest = checkpoint.load_manifest(manifest_file)
+    entry = manifest[doc_file]
+    assert (entry['docs'], entry['done']) == (2, False)
+    with open(doc_file, 'rb') as fp:
+        checkpointed = len(fp.readline()) + len(fp.readline())
+    assert entry['offset'] == checkpointed
+
+    def resumed(doc_file, offset=0):
+        read_offsets.append(offset)
+        return read_jsonl(doc_file, offset)
+
+    monkeypatch.setattr(checkpoint, 'read_jsonl', resumed)
+    shard_file = cord_ner_filter.filter_to_shard(doc_file, manifest, manifest_file, resume=True)
+
+    with open(shard_file, encoding='utf-8') as fp:
+        assert fp.read() == expected
+    manifest = checkpoint.load_manifest(manifest_file)
+    assert (manifest[doc_file]['docs'], manifest[doc_file]['done']) == (5, True)
+    assert manifest[doc_file]['offset'] == os.path.getsize(doc_file)
+
+    # A finished file is skipped.
+    assert cord_ner_filter.filter_to_shard(doc_file, manifest, manifest_file, resume=True) == shard_file
+    # The resumed run only read the documents after the checkpoint.
+    assert read_offsets == [0, checkpointed]
@@ -0,0 +1,94 @@
+import json
+
+from document_merge import HashSet, line_hash, merge
+
+
+def write_lines(path, docs, final_newline=True):
+    data = '\n'.join(json.dumps(doc) for doc in docs) + ('\n' if final_newline else '')
+    path.write_bytes(data.encode('utf-8'))
+    return str(path)
+
+
+def read_ids(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line)['id'] for line in f]
+
+
+def test_hash_set_repeated_keys():
+    seen = HashSet()
+
+    assert seen.add(5)
+    assert not seen.add(5)
+    # 0 marks an empty slot, so it shares its slot with 1.
+    assert seen.add(0)
+    assert not seen.add(0)
+    assert not seen.add(1)
+    assert seen.count == 2
+
+
+def test_hash_set_grows():
+    seen = HashSet(capacity=4)
+    assert len(seen.slots) == 8
+
+    # Hashes which share their low bits probe into each other's slots, before and after the set grows.
+    keys = [n << 16 for n in range(1, 101)] + list(range(2, 102))
+    assert all(seen.add(key) for key in keys)
+
+    assert seen.count == len(keys)
+    assert len(seen.slots) == 512
+    assert not any(seen.add(key) for key in keys)
+
+
+def test_line_hash_ignores_other_fields():
+    line = json.dumps({'id': 'a', 'text': 'spike', 'label': 'x'})
+    assert line_hash(line) == line_hash(json.dumps({'text': 'spike', 'id': 'a'}))
+    assert line_hash(line) != line_hash(json.dumps({'id': 'b', 'text': 'spike'}))
+
+
+def test_concatenate(tmp_path):
+    first = write_lines(tmp_path / 'first.jsonl', [{'id': 'a', 'text': 'x'}], final_newline=False)
+    empty = tmp_path / 'empty.jsonl'
+    empty.write_bytes(b'')
+    second = write_lines(tmp_path / 'second.jsonl', [{'id': 'b', 'text': 'y'}, {'id': 'a', 'text': 'x'}])
+    out_file = tmp_path / 'out' / 'covid.jsonl'
+
+    merge([first, str(empty), second], str(out_file))
+
+    assert out_file.read_bytes() == (tmp_path / 'first.jsonl').read_bytes() + b'\n' + \
+        (tmp_path / 'second.jsonl').read_bytes()
+    # Merging again replaces the output.
+    merge([first, str(empty), second], str(out_file))
+    assert read_ids(out_file) == ['a', 'b', 'a']
+
+
+def test_dedup(tmp_path):
+    first = write_lines(tmp_path / 'first.jsonl', [{'id': 'a', 'text': 'x'}, {'id': 'b', 'text': 'y'},
+                                                   {'id': 'a', 'text': 'x'}])
+    # The last line of a file without a final newline is still a line of its own.
+    second = write_lines(tmp_path / 'second.jsonl', [{'id': 'a', 'text': 'changed'}, {'id': 'b', 'text': 'y'},
+                                                     {'id': 'c', 'text': 'z'}], final_newline=False)
+    out_file = str(tmp_path / 'covid.jsonl')
+
+    merge([first, second], out_file, dedup=True, workers=1)
+
+    with open(out_file, encoding='utf-8') as f:
+        docs = [json.loads(line) for line in f]
+    assert [(doc['id'], doc['text']) for doc in docs] == [('a', 'x'), ('b', 'y'), ('a', 'changed'), ('c', 'z')]
+
+
+def test_seeded_split(tmp_path):
+    docs = [{'id': str(n), 'text': f'text {n}'} for n in range(20)]
+    first = write_lines(tmp_path / 'first.jsonl', docs[:10])
+    second = write_lines(tmp_path / 'second.jsonl', docs[10:] + docs[:2], final_newline=False)
+
+    def split(name, seed):
+        out_file = str(tmp_path / name / 'covid.jsonl')
+        merge([first, second], out_file, dedup=True, test_fraction=0.25, seed=seed, workers=1)
+        return read_ids(tmp_path / name / 'covid_train.jsonl'), read_ids(tmp_path / name / 'covid_test.jsonl')
+
+    train, test = split('a', seed=1)
+    assert (len(train), len(test)) == (15, 5)
+    assert sorted(train + test, key=int) == [doc['id'] for doc in docs]
+
+    assert split('b', seed=1) == (train, test)
+    assert split('c', seed=2) != (train, test)
@@ -0,0 +1,165 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import document_parser
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'document_parser.py')
+
+
+def write_release(directory, papers):
+    """
+    Write a CORD-19 release holding papers, a dictionary mapping folder names to dictionaries mapping
+    paper ids to their paragraphs.
+    """
+    for dirname, folder_papers in papers.items():
+        os.makedirs(os.path.join(directory, dirname))
+        for paper_id, paragraphs in folder_papers.items():
+            with open(os.path.join(directory, dirname, paper_id + '.json'), 'w') as f:
+                json.dump({'paper_id': paper_id, 'body_text': [{'text': text} for text in paragraphs]}, f)
+    return str(directory) + '/'
+
+
+def run(*args):
+    subprocess.run([sys.executable, script, '--workers', '1', *args], check=True, capture_output=True)
+
+
+def read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+first_release = {
+    'comm_use_subset': {
+        'kept': ['Spike protein binds receptor.'],
+        'changed': ['Remdesivir inhibits polymerase.'],
+        'dropped': ['Masks reduce transmission.', 'Ventilation reduces transmission.'],
+    },
+}
+
+second_release = {
+    'comm_use_subset': {
+        'kept': ['Spike protein binds receptor.'],
+        'changed': ['Remdesivir inhibits viral polymerase.'],
+        'added': ['Vaccines induce antibodies.'],
+    },
+}
+
+
+@pytest.fixture
+def parsed(tmp_path):
+    """
+    Parse the first release in full.
+    """
+    out_folder = str(tmp_path / 'tmnt') + '/'
+    os.makedirs(out_folder)
+    run('--directory', write_release(tmp_path / 'first', first_release), '--out_folder', out_folder)
+    return out_folder
+
+
+def test_incremental_merge_only(tmp_path, parsed):
+    dataset = parsed + '_comm_use_subset.jsonl'
+    manifest_file = parsed + 'parse_manifest.json'
+    pending_file = parsed + 'parse_manifest.pending.json'
+    with open(manifest_file) as f:
+        first_manifest = json.load(f)
+    assert sorted(first_manifest['papers']) == ['changed', 'dropped', 'kept']
+    first_docs = read_jsonl(dataset)
+
+    run('--directory', write_release(tmp_path / 'second', second_release), '--out_folder', parsed, '--incremental')
+
+    # The delta only holds the changed and added papers, and marks the changed and dropped ones deleted.
+    delta = read_jsonl(parsed + '_comm_use_subset.delta.jsonl')
+    assert [(doc['id'], doc.get('deleted', False)) for doc in delta] == \
+        [('changed', True), ('dropped', True), ('added', False), ('changed', False)]
+    # Until the delta is merged, the dataset and the manifest are left as they were.
+    assert read_jsonl(dataset) == first_docs
+    with open(manifest_file) as f:
+        assert json.load(f) == first_manifest
+    with open(pending_file) as f:
+        pending = json.load(f)
+    assert sorted(pending['papers']) == ['added', 'changed', 'kept']
+    assert pending['papers']['kept'] == first_manifest['papers']['kept']
+    assert pending['papers']['changed']['hash'] != first_manifest['papers']['changed']['hash']
+
+    run('--out_folder', parsed, '--merge_only')
+
+    assert [(doc['id'], doc['text']) for doc in read_jsonl(dataset)] == [
+        ('kept', 'spike protein binds receptor'),
+        ('added', 'vaccines induce antibodies'),
+        ('changed', 'remdesivir inhibits viral polymerase'),
+    ]
+    del pending['deltas']
+    with open(manifest_file) as f:
+        assert json.load(f) == pending
+    assert not os.path.exists(pending_file)
+
+    # There is nothing left to merge.
+    with pytest.raises(subprocess.CalledProcessError):
+        run('--out_folder', parsed, '--merge_only')
+
+
+def test_version_bump(tmp_path, parsed):
+    dataset = parsed + '_comm_use_subset.jsonl'
+    manifest_file = parsed + 'parse_manifest.json'
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    manifest['version'] = document_parser.preprocess_version - 1
+    document_parser.save_manifest(manifest, manifest_file)
+
+    # An older preprocess version keeps its paper ids, so every paper is re-parsed and its old paragraphs replaced.
+    manifest = document_parser.load_manifest(manifest_file)
+    assert manifest['version'] == document_parser.preprocess_version
+    assert manifest['papers'] == {paper_id: {'hash': None, 'label': 'comm_use_subset'}
+                                  for paper_id in first_release['comm_use_subset']}
+
+    folder = str(tmp_path / 'first' / 'comm_use_subset') + '/'
+    folder_papers = {'comm_use_subset': [(folder + name, 'comm_use_subset') for name in sorted(os.listdir(folder))]}
+    changed, deleted = document_parser.diff_release(folder_papers, manifest)
+
+    assert [os.path.basename(filepath) for filepath, _ in changed['comm_use_subset']] == \
+        ['changed.json', 'dropped.json', 'kept.json']
+    assert sorted(deleted['comm_use_subset']) == ['changed', 'dropped', 'kept']
+    assert manifest['papers'] == {}
+
+    delta = parsed + '_comm_use_subset.delta.jsonl'
+    document_parser.parse_folder(changed['comm_use_subset'], 'comm_use_subset', delta, manifest,
+                                 deleted=deleted['comm_use_subset'])
+    before = read_jsonl(dataset)
+    document_parser.merge_delta(dataset, delta)
+
+    # The release didn't change, so re-parsing it gives back the same paragraphs.
+    assert sorted(read_jsonl(dataset), key=json.dumps) == sorted(before, key=json.dumps)
+    assert sorted(manifest['papers']) == ['changed', 'dropped', 'kept']
+
+
+def remove_boilerplate_sequentially(text):
+    for b in [document_parser.cc, document_parser.perp, document_parser.avail, document_parser.ch,
+              document_parser.doi, document_parser.pr]:
+        text = text.replace(b, '')
+    return text
+
+
+medrxiv_footer = ('The copyright holder for this preprint (which was not peer-reviewed) is the author/funder, who has '
+                  'granted medRxiv a license to display the preprint in perpetuity. It is made available under a '
+                  'CC-BY-NC-ND 4.0 International license . https://doi.org/10.1101/2020.03.03.20030593 doi: medRxiv '
+                  'preprint')
+
+
+@pytest.mark.parametrize('text', [
+    'The spike protein of SARS-CoV-2 binds ACE2 with higher affinity than that of SARS-CoV (Fig. 2).',
+    '',
+    medrxiv_footer,
+    'Patients were followed for 28 days [12, 13]. ' + medrxiv_footer + ' Mortality was 4.3% (95% CI 2.1-6.5).',
+    medrxiv_footer + medrxiv_footer,
+    document_parser.ch + document_parser.avail + document_parser.ch,
+    # Removing the inner string joins its neighbours into one, which the sequential replaces remove if they
+    # haven't passed it yet, and keep otherwise.
+    'doi: medRxiv CC-BY-NC-ND 4.0 International licensepreprint',
+    'It is made avail(which was not peer-reviewed)able under a CC-BY-NC-ND 4.0 International license.',
+])
+def test_remove_boilerplate_matches_sequential_replaces(text):
+    assert document_parser.remove_boilerplate(text) == remove_boilerplate_sequentially(text)
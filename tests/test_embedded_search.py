@@ -0,0 +1,71 @@
+import pytest
+
+import embedded_search
+from relations_store import RelationWriter
+
+
+@pytest.mark.parametrize('word, stem', [
+    # Stems produced by Lucene's PorterStemFilter, which covid_predicate_analyzer's stemmer filter uses.
+    ('is', 'is'),
+    ('as', 'as'),
+    ('us', 'us'),
+    ('visibly', 'visibl'),
+    ('enzymology', 'enzymolog'),
+    ('binds', 'bind'),
+    ('binding', 'bind'),
+    ('inhibited', 'inhibit'),
+    ('activation', 'activ'),
+    ('generalization', 'gener'),
+    ('ponies', 'poni'),
+    ('caresses', 'caress'),
+    ('news', 'new'),
+])
+def test_stem(word, stem):
+    assert embedded_search.stem(word) == stem
+
+
+@pytest.fixture
+def index(tmp_path):
+    relations_file = str(tmp_path / 'relations.csv')
+    with RelationWriter(relations_file) as writer:
+        for n in range(25):
+            # Every relation binds, so each scores the same for the predicate and ties are broken by relation id.
+            writer.write({'doc_id': f'd{n}', 'sent': f'Protein {n} binds.', 'doi': '',
+                          'triple': ['bind', f'protein {n}'], 'analysis': []})
+        writer.write({'doc_id': 'd0', 'sent': 'Protein 0 binds.', 'doi': '',
+                      'triple': ['bind', 'protein 0'], 'analysis': []})
+    index_dir = str(tmp_path / 'index')
+    assert embedded_search.build_index(relations_file, index_dir) == 25
+    return embedded_search.EmbeddedIndex(index_dir)
+
+
+def test_page(index):
+    scores = index.match('bind', [], 'and')
+    expected = sorted((-score, index.rel_ids[doc]) for doc, score in scores.items())
+
+    pages = []
+    after = None
+    while True:
+        hits = index.page(scores, size=10, after=after)
+        if not hits:
+            break
+        pages.append([(-score, rel_id) for score, rel_id, doc in hits])
+        after = hits[-1][:2]
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [hit for page in pages for hit in page] == expected
+
+    score, rel_id = expected[20]
+    previous = index.page(scores, size=10, before=[-score, rel_id])
+    assert [(-score, rel_id) for score, rel_id, doc in previous] == pages[1]
+
+
+def test_page_cursor_between_ids(index):
+    scores = index.match('bind', [], 'and')
+    expected = sorted((-score, index.rel_ids[doc]) for doc, score in scores.items())
+
+    # A cursor from another version of the index holds a relation id which isn't in this one.
+    score, rel_id = expected[4]
+    hits = index.page(scores, size=3, after=[-score, rel_id + '0'])
+    assert [(-score, rel_id) for score, rel_id, doc in hits] == expected[5:8]
+    hits = index.page(scores, size=3, before=[-score, rel_id + '0'])
+    assert [(-score, rel_id) for score, rel_id, doc in hits] == expected[2:5]
@@ -0,0 +1,162 @@
+import json
+
+import pytest
+from elasticsearch import Elasticsearch, Transport
+
+import index
+from relations_store import RelationWriter
+
+relations = [
+    {'doc_id': 'd1', 'sent': 'ACE2 binds the spike protein.', 'doi': '10.1/ABC',
+     'triple': ['bind', 'ACE2', 'the spike protein'], 'analysis': [[['binds', 'ROOT', 'binds']]]},
+    {'doc_id': 'd1', 'sent': 'Camostat inhibits TMPRSS2.', 'doi': '10.1/ABC',
+     'triple': ['inhibit', 'Camostat', 'TMPRSS2'], 'analysis': [[['inhibits', 'ROOT', 'inhibits']]]},
+    {'doc_id': 'd2', 'sent': 'Interferon activates STAT1.', 'doi': '',
+     'triple': ['activate', 'Interferon', 'STAT1'], 'analysis': [[['activates', 'ROOT', 'activates']]]},
+]
+
+
+class FakeTransport(Transport):
+    """
+    Answers bulk requests in place of an elasticsearch server, recording the documents they send.
+    Documents whose predicate is in reject are answered with a 400 mapping error.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reject = set()
+        self.indexed = {}
+        self.deleted = []
+        self.num_requests = 0
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        assert (method, url) == ('POST', '/_bulk')
+        self.num_requests += 1
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        items = []
+        while lines:
+            (op_type, meta), = lines.pop(0).items()
+            if op_type == 'delete':
+                self.deleted.append(meta['_id'])
+                items.append({op_type: {'_index': meta['_index'], '_id': meta['_id'], 'status': 200}})
+                continue
+
+            source = lines.pop(0)
+            if source['predicate'] in self.reject:
+                items.append({op_type: {'_index': meta['_index'], '_id': meta['_id'], 'status': 400,
+                                        'error': {'type': 'mapper_parsing_exception'}}})
+                continue
+
+            self.indexed[meta['_id']] = source
+            items.append({op_type: {'_index': meta['_index'], '_id': meta['_id'], 'status': 201}})
+
+        errors = any(result['status'] >= 300 for item in items for result in item.values())
+        return {'took': 1, 'errors': errors, 'items': items}
+
+
+def fake_client(reject=()):
+    """
+    :param reject: predicates whose documents fail to index.
+    :return: Elasticsearch client whose requests are answered by a FakeTransport.
+    """
+    client = Elasticsearch(transport_class=FakeTransport)
+    client.transport.reject = set(reject)
+    return client
+
+
+@pytest.fixture
+def relations_file(tmp_path):
+    filename = str(tmp_path / 'relations.csv')
+    with RelationWriter(filename) as writer:
+        for relation in relations:
+            writer.write(relation)
+    return filename
+
+
+def test_relation_actions(relations_file):
+    papers = {'10.1/abc': {'journal': 'Cell', 'publish_year': 2020}}
+    actions = list(index.relation_actions(relations_file, 'test_index', papers=papers))
+
+    assert [action['predicate'] for action in actions] == ['bind', 'inhibit', 'activate']
+    assert actions[0]['arguments'] == ['ACE2', 'the spike protein']
+    assert all(action['_index'] == 'test_index' for action in actions)
+    assert all(action['_id'] == action['rel_id'] for action in actions)
+    assert len({action['_id'] for action in actions}) == len(actions)
+    # Journal and year are looked up by lowercased DOI.
+    assert (actions[0]['journal'], actions[0]['publish_year']) == ('Cell', 2020)
+    assert (actions[2]['journal'], actions[2]['publish_year']) == (None, None)
+
+    # Ids and fingerprints only depend on the relations, so they are the same on every run.
+    again = list(index.relation_actions(relations_file, 'test_index', papers=papers))
+    assert [(a['_id'], a['fingerprint']) for a in again] == [(a['_id'], a['fingerprint']) for a in actions]
+    without_papers = list(index.relation_actions(relations_file, 'test_index'))
+    assert without_papers[0]['_id'] == actions[0]['_id']
+    assert without_papers[0]['fingerprint'] != actions[0]['fingerprint']
+
+
+def test_relation_actions_skip_unchanged(relations_file):
+    actions = list(index.relation_actions(relations_file, 'test_index'))
+    existing = {action['_id']: action['fingerprint'] for action in actions}
+    existing[actions[1]['_id']] = 'changed'
+    existing['gone'] = 'deleted'
+
+    changed = list(index.relation_actions(relations_file, 'test_index', existing=existing))
+
+    assert [action['_id'] for action in changed] == [actions[1]['_id']]
+    assert existing == {'gone': 'deleted'}
+
+
+def test_relation_actions_skip_repeats(tmp_path, relations_file):
+    filename = str(tmp_path / 'repeated.csv')
+    with RelationWriter(filename) as writer:
+        for relation in relations + relations[:1]:
+            writer.write(relation)
+    actions = list(index.relation_actions(relations_file, 'test_index'))
+    existing = {action['_id']: action['fingerprint'] for action in actions}
+
+    # A full build indexes the repeat again under the same id.
+    assert [action['_id'] for action in index.relation_actions(filename, 'test_index')] == \
+        [action['_id'] for action in actions + actions[:1]]
+    # A delta indexes a new relation once, even if it is repeated.
+    assert [action['_id'] for action in index.relation_actions(filename, 'test_index', {})] == \
+        [action['_id'] for action in actions]
+    # Once indexed, a repeated relation is unchanged like any other.
+    assert list(index.delta_actions(filename, 'test_index', existing)) == []
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_bulk_load(relations_file, threads):
+    client = fake_client()
+    actions = list(index.relation_actions(relations_file, 'test_index'))
+
+    result = index.bulk_load(client, iter(actions), chunk_size=2, threads=threads)
+
+    assert result == (3, 0)
+    assert client.transport.num_requests == 2
+    assert set(client.transport.indexed) == {action['_id'] for action in actions}
+    indexed = client.transport.indexed[actions[0]['_id']]
+    assert indexed['predicate'] == 'bind'
+    assert '_id' not in indexed and '_index' not in indexed
+
+
+def test_bulk_load_failures(relations_file, capsys):
+    client = fake_client(reject={'inhibit'})
+
+    result = index.bulk_load(client, index.relation_actions(relations_file, 'test_index'), threads=1,
+                             max_errors=1)
+
+    assert result == (2, 1)
+    assert 'mapper_parsing_exception' in capsys.readouterr().out
+
+
+def test_delta_actions(relations_file):
+    client = fake_client()
+    actions = list(index.relation_actions(relations_file, 'test_index'))
+    existing = {action['_id']: action['fingerprint'] for action in actions[1:]}
+    existing['gone'] = 'deleted'
+
+    result = index.bulk_load(client, index.delta_actions(relations_file, 'test_index', existing), threads=1)
+
+    assert result == (2, 0)
+    assert list(client.transport.indexed) == [actions[0]['_id']]
+    assert client.transport.deleted == ['gone']
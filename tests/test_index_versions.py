@@ -0,0 +1,33 @@
+from index_versions import delete_old_versions, swap_alias, versioned_name
+
+
+def test_versioned_name():
+    names = [versioned_name('docs') for _ in range(100)]
+
+    assert len(set(names)) == len(names)
+    assert all(name.startswith('docs-') for name in names)
+    # Names start with their timestamp, so they sort by age.
+    assert sorted(names, key=lambda name: name.split('-')[1]) == names
+
+
+def test_swap_alias(fake_client):
+    client = fake_client({'docs-1': {'docs'}, 'docs-2': set()})
+
+    swap_alias(client, 'docs', 'docs-2')
+
+    assert client.indices.indices == {'docs-1': set(), 'docs-2': {'docs'}}
+
+
+def test_swap_alias_replaces_unversioned_index(fake_client):
+    client = fake_client({'docs': set(), 'docs-1': set()})
+
+    swap_alias(client, 'docs', 'docs-1')
+
+    assert client.indices.indices == {'docs-1': {'docs'}}
+
+
+def test_delete_old_versions(fake_client):
+    client = fake_client({'docs-1': set(), 'docs-2': set(), 'docs-3': set(), 'docs-4': {'docs'}})
+
+    assert delete_old_versions(client, 'docs', keep=1) == ['docs-1', 'docs-2']
+    assert set(client.indices.indices) == {'docs-3', 'docs-4'}
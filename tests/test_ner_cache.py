@@ -0,0 +1,78 @@
+from itertools import islice
+
+import pytest
+import spacy
+
+from ner_cache import NerCache
+
+
+@pytest.fixture
+def nlp():
+    nlp = spacy.blank('en')
+    patterns = [{'label': 'PROTEIN', 'pattern': 'ACE2'}]
+    if spacy.__version__ < '3':
+        ruler = nlp.create_pipe('entity_ruler')
+        ruler.add_patterns(patterns)
+        nlp.add_pipe(ruler, name='ner')
+    else:
+        nlp.add_pipe('entity_ruler', name='ner').add_patterns(patterns)
+    return nlp
+
+
+@pytest.fixture
+def pipe_calls(nlp, monkeypatch):
+    """
+    Makes nlp.pipe tag a whole batch before yielding any of it, like a statistical model does,
+    and records the texts each nlp.pipe call was given.
+    """
+    calls = []
+    pipe = nlp.pipe
+
+    def batched(texts, batch_size, **kwargs):
+        calls.append([])
+        texts = iter(texts)
+        batch = list(islice(texts, batch_size))
+        while batch:
+            calls[-1].extend(batch)
+            yield from list(pipe(batch, batch_size=batch_size, **kwargs))
+            batch = list(islice(texts, batch_size))
+
+    monkeypatch.setattr(nlp, 'pipe', batched)
+    return calls
+
+
+def test_pipe_tags_misses_in_one_pipe(nlp, pipe_calls, tmp_path):
+    cache = NerCache(str(tmp_path / 'cache.sqlite'), nlp)
+    cache.parse('ACE2 text 3')
+    cache.parse('text 10')
+
+    texts = [f'ACE2 text {n}' if n % 3 == 0 else f'text {n}' for n in range(40)]
+    results = list(cache.pipe(((text, n) for n, text in enumerate(texts)), as_tuples=True, batch_size=2,
+                              max_pending=100))
+
+    assert [context for _, context in results] == list(range(40))
+    assert [doc.text for doc, _ in results] == texts
+    assert [[ent.text for ent in doc.ents] for doc, _ in results] == [['ACE2'] if n % 3 == 0 else []
+                                                                    for n in range(40)]
+    # Every miss went through a single nlp.pipe, and the cached texts weren't tagged again.
+    assert pipe_calls == [[text for text in texts if text not in ('ACE2 text 3', 'text 10')]]
+    assert (cache.hits, cache.misses) == (2, 40)
+
+    assert [doc.text for doc in cache.pipe(texts, batch_size=2)] == texts
+    assert len(pipe_calls) == 1
+    assert cache.hits == 42
+    cache.close()
+
+
+def test_pipe_bounds_pending_texts(nlp, pipe_calls, tmp_path):
+    cache = NerCache(str(tmp_path / 'cache.sqlite'), nlp)
+    texts = [f'text {n}' for n in range(30)]
+    for text in texts[1:]:
+        if text != 'text 20':
+            cache.parse(text)
+
+    # With misses this rare, the first nlp.pipe is left to finish once five texts are waiting behind
+    # 'text 0', and a second one tags 'text 20'.
+    assert [doc.text for doc in cache.pipe(texts, batch_size=2, max_pending=5)] == texts
+    assert pipe_calls == [['text 0'], ['text 20']]
+    cache.close()
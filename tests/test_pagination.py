@@ -0,0 +1,44 @@
+import pytest
+from elasticsearch.exceptions import ConnectionError, NotFoundError, TransportError
+
+from pagination import close_pit, decode_cursor, encode_cursor, open_pit, pit_expired
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor([1.5, 'abc'])) == [1.5, 'abc']
+    assert decode_cursor('') is None
+    assert decode_cursor('not a cursor') is None
+
+
+def test_open_pit(fake_client):
+    client = fake_client(response={'id': 'pit-1'})
+
+    assert open_pit(client, 'relations') == 'pit-1'
+    assert client.transport.requests == [('POST', '/relations/_pit', None)]
+
+
+@pytest.mark.parametrize('status', [400, 405])
+def test_open_pit_unsupported(fake_client, status):
+    assert open_pit(fake_client(error=TransportError(status, 'illegal_argument_exception')), 'relations') is None
+
+
+def test_open_pit_transient_error(fake_client):
+    with pytest.raises(ConnectionError):
+        open_pit(fake_client(error=ConnectionError('N/A', 'timed out')), 'relations')
+
+
+def test_close_pit(fake_client):
+    client = fake_client(response={'succeeded': True})
+    close_pit(client, 'pit-1')
+    assert client.transport.requests == [('DELETE', '/_pit', {'id': 'pit-1'})]
+
+    # An expired point in time is already closed.
+    close_pit(fake_client(error=NotFoundError(404, 'search_context_missing_exception')), 'pit-1')
+
+
+def test_pit_expired():
+    assert pit_expired(NotFoundError(404, 'search_context_missing_exception'))
+    # msearch reports the error of each search with a status of N/A.
+    assert pit_expired(TransportError('N/A', 'search_context_missing_exception'))
+    assert not pit_expired(TransportError('N/A', 'parsing_exception'))
+    assert not pit_expired(ConnectionError('N/A', 'timed out'))
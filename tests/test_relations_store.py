@@ -0,0 +1,60 @@
+import pytest
+
+from relations_store import RelationWriter, read_relations, relation_id
+
+relations = [
+    {'doc_id': 'd0', 'sent': 'ACE2 binds the spike protein.', 'doi': '10.1/0',
+     'triple': ['binds', 'ACE2', 'the spike protein'],
+     'analysis': [['binds', 'ROOT', 'binds'], [['ACE2', 'nsubj', 'binds']],
+                  [['the', 'det', 'protein'], ['spike', 'compound', 'protein'], ['protein', 'dobj', 'binds']]]},
+    {'doc_id': 'd0', 'sent': 'TMPRSS2 primes "S".', 'doi': '10.1/0',
+     'triple': ['primes', 'TMPRSS2', '"S"'],
+     'analysis': [['primes', 'ROOT', 'primes'], [['TMPRSS2', 'nsubj', 'primes']], [['"S"', 'dobj', 'primes']]]},
+    {'doc_id': 'd1', 'sent': 'Remdesivir inhibits RdRp, in vitro.', 'doi': '',
+     'triple': ['inhibits', 'Remdesivir', 'RdRp', 'in vitro'],
+     'analysis': [['inhibits', 'ROOT', 'inhibits'], [['Remdesivir', 'nsubj', 'inhibits']],
+                  [['RdRp', 'dobj', 'inhibits']], [['in', 'prep', 'inhibits'], ['vitro', 'pobj', 'in']]]},
+]
+
+expected = [{'doc_id': r['doc_id'], 'sent': r['sent'], 'doi': r['doi'], 'predicate': r['triple'][0],
+             'arguments': r['triple'][1:]} for r in relations]
+
+
+@pytest.mark.parametrize('extension', ['.csv', '.arrow', '.parquet'])
+def test_round_trip(tmp_path, extension):
+    filename = str(tmp_path / f'relations{extension}')
+    # Two rows per chunk, so the columnar files hold more than one chunk.
+    with RelationWriter(filename, chunk_rows=2) as writer:
+        for relation in relations:
+            writer.write(relation)
+    assert writer.num_rows == len(relations)
+
+    assert list(read_relations(filename)) == expected
+    # Ids don't depend on the format the relations went through.
+    assert [relation_id(r) for r in read_relations(filename)] == [relation_id(r) for r in expected]
+
+
+@pytest.mark.parametrize('extension', ['.arrow', '.parquet'])
+def test_analysis_column(tmp_path, extension):
+    filename = str(tmp_path / f'relations{extension}')
+    with RelationWriter(filename) as writer:
+        writer.write(relations[2])
+
+    analysis = next(read_relations(filename, columns=['analysis']))['analysis']
+    assert analysis == [[{'text': 'inhibits', 'dep': 'ROOT', 'head': 'inhibits'}],
+                        [{'text': 'Remdesivir', 'dep': 'nsubj', 'head': 'inhibits'}],
+                        [{'text': 'RdRp', 'dep': 'dobj', 'head': 'inhibits'}],
+                        [{'text': 'in', 'dep': 'prep', 'head': 'inhibits'},
+                         {'text': 'vitro', 'dep': 'pobj', 'head': 'in'}]]
+
+
+def test_relation_id():
+    relation = dict(expected[0])
+    rel_id = relation_id(relation)
+    # Ids are stored in existing indices, so they must not change between releases.
+    assert rel_id == 'adbbfb708abd75f5bfce2dd099d3247d'
+
+    assert relation_id(dict(relation, doi='10.1/other')) == rel_id
+    for key, value in [('doc_id', 'd1'), ('sent', 'ACE2 binds spike.'), ('predicate', 'bind'),
+                       ('arguments', ['the spike protein', 'ACE2'])]:
+        assert relation_id(dict(relation, **{key: value})) != rel_id
@@ -0,0 +1,24 @@
+from index_versions import mark_updated
+from result_cache import AliasVersion, ResultCache
+
+
+def test_alias_version_changes_on_update(fake_client):
+    client = fake_client({'relations-1': {'relations'}})
+    alias_version = AliasVersion(client, 'relations', interval=0)
+    cache = ResultCache(version=alias_version.get)
+
+    assert alias_version.get() == 'relations-1'
+    cache.put('query', ['result'])
+    assert cache.get('query') == ['result']
+
+    marker = mark_updated(client, 'relations-1')
+
+    assert alias_version.get() == f'relations-1@{marker}'
+    assert cache.get('query') is None
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_alias_version_falls_back_to_alias():
+    alias_version = AliasVersion(None, 'relations', interval=0)
+
+    assert alias_version.get() == 'relations'
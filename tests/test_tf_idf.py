@@ -0,0 +1,55 @@
+import json
+import random
+
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from document_parser import stop_words
+from tf_idf import read_shard, split_shards, tf_ifd_streaming
+
+words = ['spike', 'protein', 'receptor', 'binding', 'ace2', 'virus', 'cell', 'entry', 'antibody', 'vaccine',
+         'covid', 'patients', 'mortality', 'the', 'and', 'of']
+
+
+def read_texts(doc_files):
+    texts = []
+    for doc_file in doc_files:
+        with open(doc_file) as f:
+            texts.extend(json.loads(line)['text'] for line in f)
+    return texts
+
+
+@pytest.fixture
+def doc_files(tmp_path):
+    rng = random.Random(0)
+    doc_files = []
+    for n in range(2):
+        doc_file = str(tmp_path / f'docs{n}.jsonl')
+        with open(doc_file, 'w') as f:
+            for i in range(20):
+                text = ' '.join(rng.choice(words[:rng.randint(3, len(words))]) for _ in range(rng.randint(1, 12)))
+                f.write(json.dumps({'id': f'{n}-{i}', 'label': 'comm_use_subset', 'text': text}) + '\n')
+        doc_files.append(doc_file)
+    return doc_files
+
+
+def test_shards_cover_every_line_once(doc_files):
+    texts = read_texts(doc_files)
+
+    for shard_bytes in (1, 37, 100, 1 << 20):
+        shards = split_shards(doc_files, shard_bytes)
+        assert [text for shard in shards for text in read_shard(shard)] == texts
+
+
+def test_matches_tfidf_vectorizer(doc_files):
+    texts = read_texts(doc_files)
+    vectorizer = TfidfVectorizer(stop_words=stop_words, min_df=3, max_df=0.5)
+    weights = np.asarray(vectorizer.fit_transform(texts).mean(axis=0)).ravel()
+    expected = {term: weights[i] for term, i in vectorizer.vocabulary_.items()}
+    assert 3 < len(expected) < len(words)
+
+    ranked = tf_ifd_streaming(doc_files, top=len(words), min_df=3, max_df=0.5, shard_bytes=100, workers=2)
+
+    assert dict(ranked) == pytest.approx(expected)
+    assert [weight for _, weight in ranked] == pytest.approx(sorted(expected.values(), reverse=True))
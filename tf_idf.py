@@ -0,0 +1,132 @@
+'''
+This module ranks terms by mean TF-IDF weight over the parsed CORD-19 jsonl files written by document_parser.py,
+to find non-contentful high-frequency terms for the preprocessing stopword list.
+
+It computes the same ranking as document_parser.tf_ifd (CountVectorizer with min_df=3, max_df=0.5, followed by
+TfidfTransformer's smoothed idf and l2 normalization, averaged over documents) without building either matrix.
+The input files are split into byte-range shards and processed in parallel in two passes:
+the first counts document frequencies, the second sums each term's normalized TF-IDF weight.
+Memory is bounded by the vocabulary rather than the number of documents.
+
+'''
+import argparse
+import heapq
+import json
+import math
+import os
+from collections import Counter
+from multiprocessing import Pool
+
+from sklearn.feature_extraction.text import CountVectorizer
+from tqdm import tqdm
+
+from document_parser import stop_words
+
+parser = argparse.ArgumentParser(description='Rank terms by mean TF-IDF weight over parsed CORD-19 jsonl files.')
+parser.add_argument('--doc_files', type=str, nargs='+',
+                    default=['./data/tmnt/_biorxiv_medrxiv.jsonl',
+                             './data/tmnt/_comm_use_subset.jsonl',
+                             './data/tmnt/_noncomm_use_subset.jsonl'],
+                    help='List of jsonl files written by document_parser.py.')
+parser.add_argument('--top', type=int, default=50,
+                    help='Number of top-weighted terms to report.')
+parser.add_argument('--min_df', type=int, default=3,
+                    help='Ignore terms which appear in fewer documents than this.')
+parser.add_argument('--max_df', type=float, default=0.5,
+                    help='Ignore terms which appear in more than this fraction of documents.')
+parser.add_argument('--shard_mb', type=int, default=64,
+                    help='Size in megabytes of the byte-range shards the input files are split into.')
+parser.add_argument('--workers', type=int, default=None,
+                    help='Number of processes which process shards (defaults to the number of CPUs).')
+parser.add_argument('--out_file', type=str, default=None,
+                    help='Optional json file to which the ranked terms and weights are written.')
+
+# Same tokenization, lowercasing and stopword removal as the CountVectorizer in document_parser.tf_ifd.
+analyze = CountVectorizer(stop_words=stop_words).build_analyzer()
+
+# Term -> idf of the kept vocabulary, set in each worker for the second pass.
+idf = {}
+
+def split_shards(doc_files, shard_bytes):
+    shards = []
+    for doc_file in doc_files:
+        size = os.path.getsize(doc_file)
+        for start in range(0, max(size, 1), shard_bytes):
+            shards.append((doc_file, start, min(start + shard_bytes, size)))
+
+    return shards
+
+def read_shard(shard):
+    # A line belongs to the shard its first byte falls in.
+    doc_file, start, end = shard
+    with open(doc_file, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                yield json.loads(line)['text']
+
+def count_df(shard):
+    df = Counter()
+    num_docs = 0
+    for text in read_shard(shard):
+        df.update(set(analyze(text)))
+        num_docs += 1
+
+    return num_docs, df
+
+def set_idf(shared_idf):
+    global idf
+    idf = shared_idf
+
+def sum_weights(shard):
+    sums = Counter()
+    for text in read_shard(shard):
+        tf = Counter(term for term in analyze(text) if term in idf)
+        weights = {term: count * idf[term] for term, count in tf.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        if norm > 0:
+            for term, w in weights.items():
+                sums[term] += w / norm
+
+    return sums
+
+def tf_ifd_streaming(doc_files, top=50, min_df=3, max_df=0.5, shard_bytes=64 * 1024 ** 2, workers=None):
+    shards = split_shards(doc_files, shard_bytes)
+
+    num_docs = 0
+    df = Counter()
+    with Pool(workers) as pool:
+        for shard_docs, shard_df in tqdm(pool.imap_unordered(count_df, shards), desc='Counting df', total=len(shards)):
+            num_docs += shard_docs
+            df.update(shard_df)
+
+    # Prune the vocabulary the way CountVectorizer does, then use TfidfTransformer's smoothed idf.
+    max_doc_count = max_df * num_docs
+    vocabulary_idf = {term: math.log((1 + num_docs) / (1 + count)) + 1
+                      for term, count in df.items() if min_df <= count <= max_doc_count}
+    del df
+
+    sums = Counter()
+    with Pool(workers, initializer=set_idf, initargs=(vocabulary_idf,)) as pool:
+        for shard_sums in tqdm(pool.imap_unordered(sum_weights, shards), desc='Weighting', total=len(shards)):
+            sums.update(shard_sums)
+
+    return [(term, total / num_docs) for term, total in heapq.nlargest(top, sums.items(), key=lambda t: t[1])]
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    ranked = tf_ifd_streaming(args.doc_files, top=args.top, min_df=args.min_df, max_df=args.max_df,
+                              shard_bytes=args.shard_mb * 1024 ** 2, workers=args.workers)
+
+    for term, weight in ranked:
+        print(f'{term}\t{weight:.6f}')
+
+    if args.out_file:
+        with open(args.out_file, 'w') as f:
+            json.dump([{'term': term, 'weight': weight} for term, weight in ranked], f, indent=2)
@@ -8,20 +8,124 @@ index.py must be run before this file as the web app uses that module's output i
 View the web app in your browser with the link provided upon running this file.
 """
 
+import csv
+import io
+import json
+import os
+import re
+
 from flask import *
+from elasticsearch.exceptions import TransportError
 from elasticsearch_dsl import Search
-from elasticsearch_dsl.connections import connections
+
+from pagination import close_pit, decode_cursor, encode_cursor, open_pit, page_hits, page_search, pit_expired
+from result_cache import AliasVersion, ResultCache, normalize_query
+from search_service import SearchService
 
 
 app = Flask(__name__)
 
-# Connect to local host server
-connections.create_connection(hosts=['127.0.0.1'])
+# Pooled connection to the elasticsearch server at ES_HOST (defaults to the local host server).
+service = SearchService(pool_size=int(os.environ.get('ES_POOL_SIZE', 25)))
+
+# Number of values in each facet of the results page.
+facet_size = 10
+
+# Fields of each exported relation, and the number of relations fetched and written at a time.
+export_fields = ['doc_id', 'sent', 'doi', 'predicate', 'arguments']
+export_chunk = 1000
+
+
+class ElasticsearchBackend:
+    """
+    Searches the covid_relation_index alias built by index.py.
+    A search backend has the methods below. embedded_search.EmbeddedIndex is the other backend.
+    """
+
+    def __init__(self):
+        self.alias_version = AliasVersion(service.client, 'covid_relation_index')
+        # Set to False once the cluster turns out not to support point in time searches.
+        self.pit_supported = True
+
+    def version(self):
+        """
+        :return: version of the index, which keys the result cache.
+        """
+        return self.alias_version.get()
+
+    def open_pit(self):
+        """
+        Open a point in time over the relation index for paging past the first page.
+        :return: point in time id, or None if the cluster doesn't support points in time.
+        """
+        if not self.pit_supported:
+            return None
+        try:
+            pit = open_pit(service.client, 'covid_relation_index')
+        except TransportError:
+            # A timeout or an unavailable node may not happen on the next request, so only this one goes without.
+            return None
+        self.pit_supported = pit is not None
+        return pit
 
+    def close_pit(self, pit):
+        """
+        Close a point in time opened by open_pit.
+        :param pit: point in time id.
+        :return: None
+        """
+        close_pit(service.client, pit)
 
-g_predicate = ''
-g_args = []
-g_search_type = 'and'
+    def search(self, predicate, args, search_type, after=None, before=None, pit=None):
+        """
+        :return: a page of results, as returned by search_relations.
+        """
+        return search_relations(predicate, args, search_type, after, before, pit)
+
+    def scan(self, predicate, args, search_type):
+        """
+        Read every match with the scroll API, export_chunk relations at a time.
+        :return: generator of relation dictionaries with the export_fields.
+        """
+        s = relation_search(predicate, args, search_type).source(export_fields)
+        s = s.params(scroll='5m', size=export_chunk)
+        return (hit.to_dict() for hit in s.scan())
+
+
+def search_backend():
+    """
+    The backend relations are searched with, set with the SEARCH_BACKEND environment variable:
+    elasticsearch (the default), or embedded to search an embedded_search.py index at EMBEDDED_INDEX in process,
+    without an elasticsearch server.
+    :return: search backend.
+    """
+    if os.environ.get('SEARCH_BACKEND', 'elasticsearch') == 'embedded':
+        from embedded_search import EmbeddedIndex
+        return EmbeddedIndex(os.environ.get('EMBEDDED_INDEX', 'data/relation_index'))
+    return ElasticsearchBackend()
+
+
+backend = search_backend()
+
+
+def cache_backend():
+    """
+    Optional shared backend for the result cache, set with the RESULT_CACHE_REDIS environment variable.
+    :return: a redis client, or None to only cache in process.
+    """
+    url = os.environ.get('RESULT_CACHE_REDIS')
+    if not url:
+        return None
+    import redis
+    return redis.Redis.from_url(url)
+
+
+# Cache of result pages, cleared whenever index.py swaps the alias to a new version of the index
+# or updates the current version in place.
+result_cache = ResultCache(max_size=int(os.environ.get('RESULT_CACHE_SIZE', 1024)),
+                           ttl=float(os.environ.get('RESULT_CACHE_TTL', 300)),
+                           backend=cache_backend(),
+                           version=backend.version)
 
 
 @app.route('/')
@@ -30,7 +134,7 @@ def search_page():
     Render the homepage of the UI. Users query here.
     :return: the rendered root page.
     """
-    return render_template('page_query.html', search_label=g_search_type)
+    return render_template('page_query.html', search_label='and')
 
 
 @app.route('/results', defaults={'page_num': 1}, methods=['GET', 'POST'])
@@ -40,29 +144,171 @@ def results_page(page_num):
 
     :return: rendered SERP page.
     """
-    global g_predicate, g_args, g_search_type
-
     # Convert the <page_num> parameter in url to integer.
     if type(page_num) is not int:
         page_num = int(page_num.encode('utf-8'))
 
-    # Get form info.
-    if request.method == 'POST':
-        predicate = request.form['predicate']
-        # Get all the arguments to the predicate.
-        # There are len(request.form)-2 arguments by the structure of the form.
-        args = [request.form[f'arg{arg_num + 1}'] for arg_num in range(len(request.form) - 2)]
+    # The query is read from the request on every page, so no state is kept between requests
+    # and any worker process or thread can serve any page.
+    predicate, args, search_type = query_params(request.values)
+
+    # Pages after the first are found from a cursor on the neighbouring page rather than an offset.
+    after = request.values.get('after', '')
+    before = request.values.get('before', '')
+    pit = request.values.get('pit') or None
+
+    cursor = f'after:{after}' if after else f'before:{before}' if before else ''
+    cache_key = normalize_query(predicate, args, search_type, page_num, cursor=cursor)
+    cached = result_cache.get(cache_key)
+    if cached is None:
+        # A point in time is only opened for a page which is actually searched, and carried over to the next pages.
+        opened = None
+        if (after or before) and pit is None:
+            pit = opened = backend.open_pit()
+        try:
+            cached, pit = backend.search(predicate, args, search_type, decode_cursor(after), decode_cursor(before),
+                                         pit)
+        except Exception:
+            if opened:
+                backend.close_pit(opened)
+            raise
+        result_cache.put(cache_key, cached)
+    result_list, num_results, first_cursor, last_cursor, facets = cached
+
+    # Set args to be two empty strings so that the values can be set in the form.
+    if len(args) == 0:
+        args = ['', '']
+
+    # Parameters which carry the query over to the previous and next pages.
+    params = [('predicate', predicate)] + [(f'arg{arg_num + 1}', arg) for arg_num, arg in enumerate(args)] + \
+             [('search-type', search_type)]
+
+    if pit:
+        params.append(('pit', pit))
 
-        search_type = request.form['search-type']
+    # Links which narrow the search to a top predicate or argument.
+    facet_links = {
+        'predicates': [facet_url(phrase(key), args, search_type) for key, count in facets['predicates']],
+        'arguments': [facet_url(predicate, args + [phrase(key)], search_type) for key, count in facets['arguments']],
+    }
+
+    return render_template('page_results.html', num_results=num_results, result_list=result_list,
+                           predicate=predicate, args=args, search_label=search_type, page_num=page_num,
+                           params=params, first_cursor=first_cursor, last_cursor=last_cursor,
+                           facets=facets, facet_links=facet_links)
+
+
+def phrase(text):
+    """
+    :param text: predicate or argument.
+    :return: query_string phrase matching the text.
+    """
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def facet_url(predicate, args, search_type):
+    """
+    :return: url of the first results page for a query.
+    """
+    values = {'predicate': predicate, 'search-type': search_type}
+    values.update({f'arg{arg_num + 1}': arg for arg_num, arg in enumerate(arg for arg in args if arg)})
+    return url_for('results_page', **values)
 
-        g_predicate = predicate
-        g_args = args
-        g_search_type = search_type
+
+def query_params(values):
+    """
+    Read a query from url or form parameters.
+    :param values: request parameters with a predicate, arguments arg1, arg2, ... and a search-type.
+    :return: (predicate, list of arguments in order, search type)
+    """
+    predicate = values.get('predicate', '')
+    arg_nums = sorted(int(name[3:]) for name in values if re.fullmatch(r'arg\d+', name))
+    args = [values[f'arg{arg_num}'] for arg_num in arg_nums]
+    search_type = values.get('search-type', 'and')
+    if search_type not in ('and', 'or'):
+        search_type = 'and'
+
+    return predicate, args, search_type
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    """
+    :return: json hit/miss metrics of the result cache.
+    """
+    return jsonify(result_cache.stats())
+
+
+@app.route('/export')
+def export():
+    """
+    Stream every relation matching a query as NDJSON or CSV.
+    The query is given with the same parameters as /results, plus format=ndjson (default) or format=csv.
+    Matches are read from the search backend and written out a chunk at a time, so memory doesn't grow with their number.
+    :return: streamed response.
+    """
+    predicate, args, search_type = query_params(request.values)
+    export_format = request.values.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        abort(400)
+
+    relations = backend.scan(predicate, args, search_type)
+
+    if export_format == 'csv':
+        body, mimetype = csv_lines(relations), 'text/csv'
     else:
-        predicate = g_predicate
-        args = g_args
-        search_type = g_search_type
+        body, mimetype = ndjson_lines(relations), 'application/x-ndjson'
+
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=relations.{export_format}'})
+
+
+def ndjson_lines(relations):
+    """
+    :param relations: iterable of relation dictionaries.
+    :return: generator of NDJSON strings, each holding up to export_chunk relations.
+    """
+    chunk = []
+    for relation in relations:
+        chunk.append(json.dumps({field: relation.get(field) for field in export_fields}) + '\n')
+        if len(chunk) == export_chunk:
+            yield ''.join(chunk)
+            chunk = []
+
+    if chunk:
+        yield ''.join(chunk)
+
 
+def csv_lines(relations):
+    """
+    :param relations: iterable of relation dictionaries.
+    :return: generator of CSV strings, starting with a header. Each holds up to export_chunk relations,
+             with arguments written as a json list.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(export_fields)
+    num_rows = 0
+    for relation in relations:
+        writer.writerow([json.dumps(relation.get(field)) if field == 'arguments' else relation.get(field)
+                         for field in export_fields])
+        num_rows += 1
+        if num_rows % export_chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def relation_search(predicate, args, search_type):
+    """
+    Build the search for a relation query.
+    :param predicate: predicate query string.
+    :param args: list of argument query strings.
+    :param search_type: 'and' or 'or'.
+    :return: elasticsearch_dsl Search over the relation index.
+    """
     # Query over form info.
     s = Search(index='covid_relation_index')
 
@@ -81,32 +327,81 @@ def results_page(page_num):
                     fields=['arguments'],
                     default_operator=search_type)
 
-    # determine the subset of results to display (based on current <page> value)
-    start = 0 + (page_num - 1) * 10
-    end = 10 + (page_num - 1) * 10
+    return s
+
+
+def facet_search(s):
+    """
+    Build the search for the total and facets over every match of a query.
+    It returns no hits, so the shard request cache can answer it for every page of the same query.
+    :param s: elasticsearch_dsl Search with the query.
+    :return: size 0 elasticsearch_dsl Search with the facet aggregations.
+    """
+    s = s.extra(size=0, track_total_hits=True).params(request_cache=True)
+    s.aggs.bucket('predicates', 'terms', field='predicate.keyword', size=facet_size)
+    s.aggs.bucket('arguments', 'terms', field='arguments.keyword', size=facet_size)
+    s.aggs.bucket('dois', 'terms', field='doi', size=facet_size)
+    s.aggs.bucket('journals', 'terms', field='journal', size=facet_size)
+    s.aggs.bucket('years', 'histogram', field='publish_year', interval=1, min_doc_count=1)
+    return s
+
+
+def search_relations(predicate, args, search_type, after=None, before=None, pit=None):
+    """
+    Query the relation index for a page of results.
+    :param predicate: predicate query string.
+    :param args: list of argument query strings.
+    :param search_type: 'and' or 'or'.
+    :param after: sort values of the last result on the previous page, or None.
+    :param before: sort values of the first result on the next page, or None.
+    :param pit: optional point in time id to search.
+    :return: ((dictionary of results for the page keyed by document id, total number of results,
+              cursor of the page's first result, cursor of its last result, dictionary of facets),
+              point in time id for the next page)
+    """
+    s = relation_search(predicate, args, search_type)
+
+    # The page and the total and facets are sent in one msearch round trip.
+    page = s.extra(track_total_hits=False)
+    try:
+        response, facet_response = service.msearch([page_search(page, 'rel_id', size=10, after=after, before=before,
+                                                                pit=pit), facet_search(s)])
+    except TransportError as e:
+        if not pit or not pit_expired(e):
+            raise
+        # The point in time has expired. The cursor doesn't depend on it, so carry on from the live index.
+        response, facet_response = service.msearch([page_search(page, 'rel_id', size=10, after=after,
+                                                                before=before), facet_search(s)])
+    hits, pit = page_hits(response, before)
+    if pit and len(hits) < 10:
+        # Paging has reached the end of the results, so the point in time is no longer needed.
+        close_pit(service.client, pit)
+        pit = None
 
     # Use query results to pass a result-list into the template.
-    response = s[start:end].execute()
     result_list = {}
-    for hit in response.hits:
+    for hit in hits:
         result = {
             'score': hit.meta.score,
             'doi': hit.doi,
             'sent': hit.sent,
             'predicate': hit.predicate,
-            'arguments': hit.arguments,
+            'arguments': list(hit.arguments),
         }
 
         result_list[hit.meta.id] = result
 
-    num_results = response.hits.total['value']
+    num_results = facet_response.hits.total['value']
 
-    # Set args to be two empty strings so that the values can be set in the form.
-    if len(args) == 0:
-        args = ['', '']
+    first_cursor = encode_cursor(list(hits[0].meta.sort)) if hits else ''
+    last_cursor = encode_cursor(list(hits[-1].meta.sort)) if hits else ''
 
-    return render_template('page_results.html', num_results=num_results, result_list=result_list,
-                           predicate=predicate, args=args, search_label=search_type, page_num=page_num)
+    aggregations = facet_response.aggregations
+    facets = {name: [[bucket.key, bucket.doc_count] for bucket in aggregations[name].buckets]
+              for name in ('predicates', 'arguments', 'dois', 'journals')}
+    facets['years'] = [[int(bucket.key), bucket.doc_count] for bucket in aggregations.years.buckets]
+
+    return (result_list, num_results, first_cursor, last_cursor, facets), pit
 
 
 if __name__ == '__main__':